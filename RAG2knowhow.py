@@ -1,12 +1,14 @@
-import openai
 import glob
-import os
 import numpy as np
-from dotenv import load_dotenv
-
-load_dotenv()
-api_key = os.getenv("API_KEY")
-openai.api_key = api_key
+import sys
+from embed_cache import EmbeddingCache, embed_texts
+from ann_index import make_index
+from answer_cache import AnswerCache
+from context_assembler import assemble_context
+from corpus import line_store
+from openai_client import default_client
+from streaming import chat, format_timing
+from tracing import tracer
 
 CHAT_MODEL = "gpt-4.1"
 EMBED_MODEL = "text-embedding-3-large"
@@ -14,44 +16,128 @@ EMBED_MODEL = "text-embedding-3-large"
 GROUP_SIZE = 4   # 何行で1チャンクにするか
 MARGIN     = 3   # ヒットしたチャンクの前後何行を追加するか
 TOPN       = 5   # 参照するRAG上位チャンク数
+CONTEXT_TOKEN_BUDGET = 6000  # コンテキストのトークン数上限（None なら無制限）。スコアの低い区間から落とす
 BATCH_SIZE = 500 # Embeddingリクエストのバッチ数
+INDEX_TYPE = "exact"  # 検索方式: "exact"（全件） / "ivf"（近似。大規模コーパス向け）
+IVF_PARAMS = {"n_probe": 8}  # IVFの調整値（n_lists, n_probe, n_jobs）。ann_index.py で recall を測って決める
+ANSWER_CACHE_THRESHOLD = 0.92 # 過去の質問とのコサイン類似度がこれ以上なら、その回答を再利用
+STREAM     = True # Trueなら回答をトークンが届いた順に表示する
 
 # ----- 全ファイルをロード ----------
-all_chunks = []      # 各チャンクのテキスト
-chunk_meta  = []     # (fname, start_line, end_line, full_lines)
-
-for fname in sorted(glob.glob("2024-10-*.txt")):
-    with open(fname, encoding="utf-8") as f:
-        lines = [l.strip() for l in f if l.strip()]
-    n = len(lines)
-    i = 0
-    while i < n:
-        start = i
-        end   = min(i + GROUP_SIZE, n)
-        text  = "\n".join(lines[start:end])
-        if text:  # 空でなければ登録
-            all_chunks.append(text)
-            chunk_meta.append((fname, start, end-1, lines))
-        i += GROUP_SIZE
-
-print(f"総チャンク数: {len(all_chunks)}")
+def load_chunks(pattern="2024-10-*.txt", group_size=None):
+    """
+    全書き起こしを GROUP_SIZE 行（group_size を指定すればその行数）ずつのチャンクに分ける
+    戻り値: (各チャンクのテキスト, (fname, start_line, end_line, n_lines) のリスト)
+    """
+    all_chunks = []      # 各チャンクのテキスト
+    chunk_meta  = []     # (fname, start_line, end_line, n_lines)　本文は line_store から引く
+    group_size = group_size or GROUP_SIZE
+
+    for fname in sorted(glob.glob(pattern)):
+        lines = line_store.lines(fname)
+        n = len(lines)
+        i = 0
+        while i < n:
+            start = i
+            end   = min(i + group_size, n)
+            text  = "\n".join(lines[start:end])
+            if text:  # 空でなければ登録
+                all_chunks.append(text)
+                chunk_meta.append((fname, start, end-1, n))
+            i += group_size
+    return all_chunks, chunk_meta
 
 # ----- Embedding ----------
-def get_embeddings(texts):
+def get_embeddings(texts, client=None):
     print("Embedding中...")
-
-    embs = []
-    for i in range(0, len(texts), BATCH_SIZE):
-        batch = texts[i:i+BATCH_SIZE]
-        resp = openai.embeddings.create(model=EMBED_MODEL, input=batch)
-        for e in resp.data:
-            embs.append(np.array(e.embedding))
-    return np.stack(embs)
-
-line_embeddings = get_embeddings(all_chunks)
+    return embed_texts(texts, EMBED_MODEL, client, BATCH_SIZE)
+
+# ----- コーパス一式 ----------
+class RAGCorpus:
+    """
+    チャンク・Embedding・検索エンジン・回答キャッシュをまとめて一度だけ用意する
+    （対話ループでもサーバでも、これを作って使い回す）
+    """
+
+    def __init__(self, client=None):
+        self.client = client or default_client()
+        with tracer.span("rag.load"):
+            with tracer.span("rag.load_chunks") as s:
+                self.chunks, self.chunk_meta = load_chunks()
+                s.set(chunks=len(self.chunks))
+            print(f"総チャンク数: {len(self.chunks)}")
+
+            # 変更のないチャンクはキャッシュから読み、新規・変更分だけ埋め込む
+            with tracer.span("rag.embed_corpus"):
+                embed_cache = EmbeddingCache(EMBED_MODEL, GROUP_SIZE)
+                self.embeddings = embed_cache.get_or_embed(self.chunks, lambda t: get_embeddings(t, self.client))
+            with tracer.span("rag.build_index", kind=INDEX_TYPE):
+                self.search_engine = make_index(INDEX_TYPE, self.embeddings, **(IVF_PARAMS if INDEX_TYPE == "ivf" else {}))
+        self.answer_cache = AnswerCache(
+            "rag", threshold=ANSWER_CACHE_THRESHOLD,
+            extra=f"{CHAT_MODEL} {EMBED_MODEL} {GROUP_SIZE} {MARGIN} {TOPN}",
+        )
+
+    def embed_query(self, query):
+        resp = self.client.embeddings.create(
+            model=EMBED_MODEL,
+            input=[query]
+        )
+        tracer.record_llm(EMBED_MODEL, resp.usage)
+        return np.array(resp.data[0].embedding)
+
+    def embed_queries(self, queries):
+        """
+        複数の質問をまとめて埋め込む（BATCH_SIZE 件ずつ1リクエスト）
+        """
+        return embed_texts(list(queries), EMBED_MODEL, self.client, BATCH_SIZE)
+
+    def build_context(self, q_emb):
+        with tracer.span("rag.search"):
+            top_indices, scores = self.search_engine.search(q_emb, TOPN)
+        return self.assemble(top_indices, scores)
+
+    def assemble(self, top_indices, scores):
+        # ----- ヒット行 + 前後MARGIN行をコンテキストに ----------
+        # 同じファイルで重なる・隣接する区間は1つにまとめ、スコア順に予算まで並べる
+        spans = []
+        for idx, score in zip(top_indices, scores):
+            fname, s, e, n_lines = self.chunk_meta[idx]
+            spans.append((fname, max(0, s - MARGIN), min(n_lines, e + MARGIN + 1), float(score)))
+        with tracer.span("rag.assemble") as span:
+            context, info = assemble_context(spans, line_store.text, budget=CONTEXT_TOKEN_BUDGET)
+            span.set(**info)
+        return context
+
+    def answer(self, query, stream=False, out=sys.stdout, record=True):
+        """
+        質問1件に回答する。戻り値: (回答, キャッシュから返したか)
+        record=False なら RAGresult.txt に記録しない（並列に呼ぶ時用）
+        各段階の時間とLLMのトークン数は tracing のスパン（rag.*）に記録する
+        """
+        with tracer.span("rag.answer", stream=stream) as span:
+            with tracer.span("rag.embed_query"):
+                q_emb = self.embed_query(query)
+
+            # 似た質問に回答済みならキャッシュから返す
+            with tracer.span("rag.cache_lookup"):
+                cached = self.answer_cache.lookup(q_emb)
+            if cached is not None:
+                span.set(cached=True)
+                return cached, True
+
+            with tracer.span("rag.build_context"):
+                context = self.build_context(q_emb)
+            answer = generate_answer(query, context, stream=stream, client=self.client, out=out, record=record)
+            self.answer_cache.store(query, q_emb, answer)
+            return answer, False
 
 # ----- 回答生成 ----------
-def generate_answer(usr_query, context):
+def generate_answer(usr_query, context, stream=False, client=None, out=sys.stdout, record=True):
+    """
+    record=False なら RAGresult.txt への記録と時間の表示をしない（一括処理で並列に呼ぶ時用）
+    """
+    client = client or default_client()
     prompt = f"""
 あなたはデジタル工房機器のサポートAIです。
 
@@ -64,20 +150,47 @@ def generate_answer(usr_query, context):
 {context}
 """
 
-    with open("RAGresult.txt", "w", encoding="utf-8") as f:
-        f.write(prompt)
+    if record:
+        with open("RAGresult.txt", "w", encoding="utf-8") as f:
+            f.write(prompt)
     
-    resp = openai.chat.completions.create(
-        model=CHAT_MODEL,
-        messages=[
-            {"role": "system", "content": "あなたはデジタル工房機器のサポートAIです。"},
-            {"role": "user", "content": prompt}
-        ],
-    )
-    return resp.choices[0].message.content
+    if stream:
+        out.write("\n=== 回答 ===\n\n")
+    with tracer.span("rag.chat") as s:
+        answer, timing = chat(
+            client,
+            CHAT_MODEL,
+            [
+                {"role": "system", "content": "あなたはデジタル工房機器のサポートAIです。"},
+                {"role": "user", "content": prompt}
+            ],
+            stream=stream,
+            out=out,
+        )
+        s.set(ttft_ms=None if timing["ttft"] is None else round(timing["ttft"] * 1000, 3))
+    if record:
+        with open("RAGresult.txt", "a", encoding="utf-8") as f:
+            f.write(f"\n【回答】（{format_timing(timing)}）\n{answer}\n")
+        print(f"\n（{format_timing(timing)}）")
+    return answer
 
 # --- メイン処理 ----------
-def main():
+def ask(rag, user_query, stream=STREAM):
+    """
+    質問1件に回答して表示する
+    """
+    answer, from_cache = rag.answer(user_query, stream=stream)
+    if from_cache:
+        print("\n=== 回答（キャッシュ） ===\n")
+        print(answer)
+    elif not stream:
+        print("\n=== 回答 ===\n")
+        print(answer)
+    print(f"\n回答キャッシュ: {rag.answer_cache.stats()}")
+    return answer
+
+def main(stream=STREAM, client=None):
+    rag = RAGCorpus(client)
     while True:
         user_query = input("ご質問はありますか？（終了するには'exit'と入力）：\n")
         if user_query.lower() == 'exit':                                                                                             
@@ -85,33 +198,7 @@ def main():
         elif not user_query.strip():
             print("質問が入力されていません。")
         else:
-            q_emb = openai.embeddings.create(
-                model=EMBED_MODEL,
-                input=[user_query]
-            ).data[0].embedding
-            q_emb = np.array(q_emb)
-
-            def cosine_sim(a, b):
-                return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
-
-            scores = [cosine_sim(q_emb, e) for e in line_embeddings]
-            topN = TOPN
-            top_indices = np.argsort(scores)[::-1][:topN]
-
-            # ----- ヒット行 + 前後4行をコンテキストに ----------
-            hit_contexts = []
-            for idx in top_indices:
-                fname, s, e, lines = chunk_meta[idx]
-                start = max(0, s - MARGIN)
-                end = min(len(lines), e + MARGIN + 1)
-                context_block = "\n".join(lines[start:end])
-                hit_contexts.append(f"【{fname} 行{s}-{e} 周辺】\n{context_block}")
-
-            context = "\n---\n".join(hit_contexts)
-
-            answer = generate_answer(user_query, context)
-            print("\n=== 回答 ===\n")
-            print(answer)
+            ask(rag, user_query, stream)
 
 if __name__ == "__main__":
     main()
@@ -1,23 +1,37 @@
-import openai
 import re
 import json
 import os
 import glob
-from dotenv import load_dotenv
-
-load_dotenv()
-api_key = os.getenv("API_KEY")
-openai.api_key = api_key
+import hashlib
+import threading
+from contextlib import nullcontext
+from llm_pool import RateLimiter, call_with_backoff, run_concurrent
+from openai_client import default_client
+from tracing import tracer
 
 base_txt = "2024-10-02_13_11_31.txt" # タグ分けのベースになるtxtファイル
 
-with open(base_txt, encoding="utf-8") as f:
-    lines = [l.strip() for l in f if l.strip()]
+CONCURRENCY = 4   # add_tag_allで同時に処理するファイル数
+RPM_LIMIT   = 500 # 1分あたりのリクエスト上限（Noneで無制限）
+TPM_LIMIT   = 30000 # 1分あたりのトークン上限（Noneで無制限）
+MANIFEST_PATH = "tag_manifest.json" # タグ付け済みファイルの記録（内容・タグ語彙のハッシュ）
+WINDOW_LINES   = 300 # これより長い書き起こしは、この行数の窓に分けて並列にタグ付けする（Noneなら常に一括）
+WINDOW_OVERLAP = 60  # 隣り合う窓で重ねる行数（境界の工程は重なりの中央で継ぎ合わせる）
+WINDOW_CONCURRENCY = 4 # 1ファイル内で同時に投げる窓の数（LLMへの同時リクエスト数は add_tag_all の concurrency で頭打ち）
+REPAIR_ROUNDS  = 3   # 検証で見つかった問題を部分的に直す問い合わせの最大回数
+REPAIR_MARGIN  = 5   # 修正依頼に添える、問題の区間の前後の行数
 
 # 行番号付きでLLMに渡す用のテキスト作成
-line_txt = "\n".join([f"{i}: {line}" for i, line in enumerate(lines)])
+def transcript_lines(fname):
+    with open(fname, encoding="utf-8") as f:
+        return [l.strip() for l in f if l.strip()]
+
+def numbered_text(fname, lines=None, start=0, end=None):
+    lines = transcript_lines(fname) if lines is None else lines
+    end = len(lines) if end is None else end
+    return "\n".join([f"{i}: {lines[i]}" for i in range(start, end)])
 
-def make_prompt(user_prompt=""):
+def make_prompt(line_txt, user_prompt=""):
     base = f"""
 以下は作業実践中の会話書き起こしです。
 会話全体を俯瞰し、「どこからどこまでが同じ“作業工程（フェーズ）”なのか」を抽出し、工程ごとにタグ名をつけて、区切り・対応範囲を明示してください。
@@ -37,133 +51,594 @@ def make_prompt(user_prompt=""):
 """
     return base
 
-user_prompt = ""
+# --- タグ付けマニフェスト ---------
+def sha256_of(data):
+    return hashlib.sha256(data).hexdigest()
+
+def blocks_path(fname):
+    return f"phase_blocks_{os.path.splitext(fname)[0]}.json"
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest):
+    tmp = MANIFEST_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, MANIFEST_PATH)
+
+def manifest_entry(fname, tags_hash, base_block_count):
+    """
+    このファイルのタグ付け結果が有効であるための条件（内容・タグ語彙・工程数）
+    """
+    with open(fname, "rb") as f:
+        content_hash = sha256_of(f.read())
+    return {"content_hash": content_hash, "tags_hash": tags_hash, "base_block_count": base_block_count}
+# --- ここまでタグ付けマニフェスト ---------
 
 # --- ここから、全ファイルのタグ付け処理 ---------
-def add_tag_all():
-    # 1. phase_tags.txtを読み込む
+def load_phase_tags():
     with open("phase_tags.txt", encoding="utf-8") as f:
-        fixed_tags = [l.strip() for l in f if l.strip()]
+        return [l.strip() for l in f if l.strip()]
 
-    tag_list_str = "・" + "\n・".join(fixed_tags)
-    tag_instr = f"これは「phase_tags.txt」です。記載されているタグのみを使い、タグ付けしてください。ここに記載されているタグは遵守し、追記・削除は絶対に行わないでください:\n{tag_list_str}"
+def parse_blocks(output):
+    blocks = []
+    for m in re.finditer(r"(\d+)[行目～]*(\d+)行目：(.+)", output):
+        start = int(m.group(1))
+        end = int(m.group(2))
+        tag = m.group(3).strip()
+        blocks.append({"start_line": start, "end_line": end, "tag": tag})
+    return blocks
 
-    # --- base_txtの区間数を取得 ---
-    base_blocks_path = f"phase_blocks_{os.path.splitext(base_txt)[0]}.json"
-    with open(base_blocks_path, encoding="utf-8") as f:
-        base_blocks = json.load(f)
-    base_block_count = len(base_blocks)
+# --- 構造化出力と検証 ----------
+def blocks_format(tags):
+    """
+    {"blocks": [{"start_line", "end_line", "tag"}, ...]} の JSON Schema（タグは語彙に限定）を指定する response_format
+    """
+    block = {
+        "type": "object",
+        "properties": {
+            "start_line": {"type": "integer"},
+            "end_line": {"type": "integer"},
+            "tag": {"type": "string", "enum": list(tags)},
+        },
+        "required": ["start_line", "end_line", "tag"],
+        "additionalProperties": False,
+    }
+    schema = {
+        "type": "object",
+        "properties": {"blocks": {"type": "array", "items": block}},
+        "required": ["blocks"],
+        "additionalProperties": False,
+    }
+    return {"type": "json_schema", "json_schema": {"name": "phase_blocks", "strict": True, "schema": schema}}
 
-    # 2. 他の2024-10-*.txtについてもphase_tag.txtをベースにタグ分け
-    txt_files = sorted(glob.glob("2024-10-*.txt"))
+def parse_json_blocks(output):
+    """
+    構造化出力の応答をブロックのリストにする。JSONでなければ従来の「a行目～b行目：タグ」形式として読む
+    """
+    try:
+        data = json.loads(output)
+        return [{"start_line": int(b["start_line"]), "end_line": int(b["end_line"]), "tag": str(b["tag"]).strip()}
+                for b in data["blocks"]]
+    except (ValueError, KeyError, TypeError):
+        return parse_blocks(output)
+
+def validate_blocks(blocks, start, end, tags, count=None):
+    """
+    blocks が start～end-1 行目を隙間・重なりなく順に覆い、タグが語彙内で、数が count（None なら問わない）かを調べる
+    戻り値: 問題のリスト [{"kind", "start", "end", "message"}]（空なら正しい）
+    kind は range（行番号が範囲外・逆順）/ tag / gap / overlap / count。count 以外は問題のある行区間を持つ
+    """
+    problems = []
+    ordered = sorted(blocks, key=lambda b: (b["start_line"], b["end_line"]))
+    for b in ordered:
+        if b["end_line"] < b["start_line"] or b["start_line"] < start or b["end_line"] >= end:
+            lo, hi = sorted((b["start_line"], b["end_line"]))
+            problems.append({"kind": "range", "start": min(end - 1, max(start, lo)), "end": max(start, min(end - 1, hi)),
+                             "message": f"{b['start_line']}-{b['end_line']} は範囲外です"})
+        if b["tag"] not in tags:
+            problems.append({"kind": "tag", "start": b["start_line"], "end": b["end_line"],
+                             "message": f"タグ「{b['tag']}」は語彙にありません"})
+    covered = start - 1  # ここまでの行は覆われている
+    for b in ordered:
+        if b["start_line"] > covered + 1:
+            problems.append({"kind": "gap", "start": covered + 1, "end": b["start_line"] - 1,
+                             "message": f"{covered + 1}-{b['start_line'] - 1} 行目がどの工程にも入っていません"})
+        elif b["start_line"] <= covered:
+            problems.append({"kind": "overlap", "start": b["start_line"], "end": min(covered, b["end_line"]),
+                             "message": f"{b['start_line']}-{min(covered, b['end_line'])} 行目が複数の工程に入っています"})
+        covered = max(covered, b["end_line"])
+    if covered < end - 1:
+        problems.append({"kind": "gap", "start": covered + 1, "end": end - 1,
+                         "message": f"{covered + 1}-{end - 1} 行目がどの工程にも入っていません"})
+    if count is not None and len(blocks) != count:
+        problems.append({"kind": "count", "start": None, "end": None,
+                         "message": f"工程数が {len(blocks)} 個です（期待: {count} 個）"})
+    return problems
+
+def problem_ranges(problems, n_lines, margin=REPAIR_MARGIN):
+    """
+    区間を持つ問題を前後 margin 行広げ、重なる・隣接するものをまとめた [(start, end), ...]（end は含まない）
+    """
+    ranges = sorted((max(0, p["start"] - margin), min(n_lines, p["end"] + margin + 1))
+                    for p in problems if p["start"] is not None)
+    merged = []
+    for lo, hi in ranges:
+        if merged and lo <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
 
-    for fname in txt_files:
-        if fname == base_txt: # 1件目はすでに処理済みなので省略
+def splice_blocks(blocks, lo, hi, replacement):
+    """
+    lo～hi-1 行目を replacement で置き換え、はみ出したブロックは切り詰める。隣り合う同じタグは1つにまとめる
+    """
+    out = []
+    for b in sorted(blocks, key=lambda b: b["start_line"]):
+        if b["end_line"] < lo or b["start_line"] >= hi:
+            out.append(dict(b))
             continue
-        with open(fname, encoding="utf-8") as f:
-            lines = [l.strip() for l in f if l.strip()]
-        line_txt = "\n".join([f"{i}: {line}" for i, line in enumerate(lines)])
+        if b["start_line"] < lo:
+            out.append({**b, "end_line": lo - 1})
+        if b["end_line"] >= hi:
+            out.append({**b, "start_line": hi})
+    out.extend({**b, "start_line": max(lo, b["start_line"]), "end_line": min(hi - 1, b["end_line"])}
+               for b in replacement if b["start_line"] < hi and b["end_line"] >= lo)
+    out.sort(key=lambda b: (b["start_line"], b["end_line"]))
+    coalesced = []
+    for b in out:
+        if coalesced and coalesced[-1]["tag"] == b["tag"] and b["start_line"] <= coalesced[-1]["end_line"] + 1:
+            coalesced[-1]["end_line"] = max(coalesced[-1]["end_line"], b["end_line"])
+        else:
+            coalesced.append(b)
+    return coalesced
 
-        for attempt in range(3):  # 最大3回試行
-            prompt = f"""
-以下は作業実践中の会話書き起こしです。
-会話全体を俯瞰し、「どこからどこまでが同じ“作業工程（フェーズ）”なのか」を抽出し、
-工程ごとにタグ名をつけて、区切り・対応範囲を明示してください。
+def check_all(pattern="phase_blocks_*.json"):
+    """
+    保存済みの phase_blocks_*.json を、書き起こしの行数・phase_tags.txt・ベースファイルの工程数でオフライン検証する
+    戻り値: {ファイル名: 問題のリスト}（問題のあるファイルだけ）
+    """
+    tags = load_phase_tags()
+    with open(blocks_path(base_txt), encoding="utf-8") as f:
+        count = len(json.load(f))
+    report = {}
+    for path in sorted(glob.glob(pattern)):
+        fname = path[len("phase_blocks_"):-len(".json")] + ".txt"
+        with open(path, encoding="utf-8") as f:
+            blocks = json.load(f)
+        problems = validate_blocks(blocks, 0, len(transcript_lines(fname)), tags, count)
+        if problems:
+            report[path] = problems
+            for p in problems:
+                print(f"{path}: [{p['kind']}] {p['message']}")
+    print(f"{len(glob.glob(pattern))} 件中 {len(report)} 件に問題があります")
+    return report
+# --- ここまで構造化出力と検証 ----------
 
-【出力フォーマット例】
-1. 0行目～12行目：TAG1
-2. 13行目～41行目：TAG2
-3. 42行目～100行目：TAG3
-...
+def save_blocks(fname, blocks):
+    outname = blocks_path(fname)
+    with open(outname, "w", encoding="utf-8") as f:
+        json.dump(blocks, f, ensure_ascii=False, indent=2)
+    print(f"{outname} に保存しました")
 
-- タグ名は「phase_tags.txtに記載のもののみ」を必ず使ってください。他の表記は禁止です。
-- タグ数は必ず{base_block_count}個にしてください。
-{tag_instr}
+def chat_request(client, prompt, limiter=None, label="", response_format=None, slots=None):
+    """
+    gpt-4.1 に1回問い合わせる（429/5xxは指数バックオフで再送）
+    response_format を渡すと構造化出力（JSON Schema）で応答させる
+    slots（セマフォ）を渡すと、応答を待つ間その1枠を占有する（ファイル並列・窓並列をまたいで同時リクエスト数を抑える）
+    """
+    extra = {"response_format": response_format} if response_format else {}
 
-【会話データ】
-{line_txt}
-"""
-            # 3. 同様にタグ付け処理
-            response = openai.chat.completions.create(
+    def request():
+        if limiter:
+            # 日本語はほぼ1文字1トークンなので、文字数を見積もりに使う
+            limiter.acquire(len(prompt))
+        with slots or nullcontext():
+            return client.chat.completions.create(
                 model="gpt-4.1",
                 messages=[
                     {"role": "system", "content": "あなたは作業会話の工程分析エキスパートです。"},
                     {"role": "user", "content": prompt}
                 ],
+                **extra,
                 #max_tokens=2000,
                 #temperature=0,
             )
-            output = response.choices[0].message.content
-            print(f"\n==== {fname} のタグ付け結果 ====")
-            print(output)
-
-            blocks = []
-            for m in re.finditer(r"(\d+)[行目～]*(\d+)行目：(.+)", output):
-                start = int(m.group(1))
-                end = int(m.group(2))
-                tag = m.group(3).strip()
-                blocks.append({"start_line": start, "end_line": end, "tag": tag})
-
-            if len(blocks) == base_block_count:
-                outname = f"phase_blocks_{os.path.splitext(fname)[0]}.json"
-                with open(outname, "w", encoding="utf-8") as f:
-                    json.dump(blocks, f, ensure_ascii=False, indent=2)
-                print(f"{outname} に保存しました")
-                break
-            else:
-                print(f"タグ付け結果の工程数が不正です。再試行します... (期待: {base_block_count}, 実際: {len(blocks)})")
-        else:
-            print(f"3回試行しても工程数が一致しませんでした。Something Went Wrong ってやつです。: {fname}")
-# ---------------------------------------
 
-while True:
-    prompt = make_prompt(user_prompt)
-    response = openai.chat.completions.create(
-        model="gpt-4.1",
-        messages=[
-            {"role": "system", "content": "あなたは作業会話の工程分析エキスパートです。"},
-            {"role": "user", "content": prompt}
-        ],
-        #max_tokens=2000,
-        #temperature=0,
+    response = call_with_backoff(
+        request,
+        on_retry=lambda n, e, d: print(f"{label}: {type(e).__name__} のため {d:.1f}秒後に再送します ({n}回目)"),
     )
-    output = response.choices[0].message.content
-    print(output)
+    tracer.record_llm("gpt-4.1", response.usage)
+    return response.choices[0].message.content
+
+def tag_file(fname, tag_instr, base_block_count, client=None, limiter=None, tags=None, window_lines=WINDOW_LINES,
+             slots=None):
+    """
+    1ファイルをタグ分けして phase_blocks_*.json に保存する
+    JSON（構造化出力）で受け取り、範囲・隙間・重なり・タグ語彙・工程数を検証する。
+    問題があれば、その区間の行だけ（工程数だけの問題なら区切りの前後だけ）を送って直させる（最大 REPAIR_ROUNDS 回）。
+    応答をまったく解析できなかった時だけ全文を送り直す（最大3回）
+    書き起こしが window_lines 行より長ければ窓ごとに並列でタグ付けする
+    """
+    client = client or default_client()
+    tags = tags or load_phase_tags()
+    lines = transcript_lines(fname)
+    if window_lines is not None and len(lines) > window_lines:
+        return tag_file_windowed(fname, lines, tags, tag_instr, base_block_count, client, limiter, window_lines,
+                                 slots=slots)
+    line_txt = numbered_text(fname, lines)
+
+    for attempt in range(3):  # 最大3回試行
+        prompt = f"""
+以下は作業実践中の会話書き起こしです（全{len(lines)}行、行頭の数字が行番号）。
+会話全体を俯瞰し、「どこからどこまでが同じ“作業工程（フェーズ）”なのか」を抽出し、
+工程ごとにタグ名をつけて、区切り・対応範囲を明示してください。
+
+【出力形式】
+{{"blocks": [{{"start_line": 0, "end_line": 12, "tag": "TAG1"}}, {{"start_line": 13, "end_line": 41, "tag": "TAG2"}}, ...]}}
+
+- 0行目から{len(lines) - 1}行目までを、隙間も重なりもなく順に覆ってください。
+- タグ名は「phase_tags.txtに記載のもののみ」を必ず使ってください。他の表記は禁止です。
+- タグ数は必ず{base_block_count}個にしてください。
+{tag_instr}
+
+【会話データ】
+{line_txt}
+"""
+        # 3. 同様にタグ付け処理（429/5xxは指数バックオフで再送）
+        with tracer.span("add_tag.request", file=fname, attempt=attempt + 1):
+            output = chat_request(client, prompt, limiter, fname, blocks_format(tags), slots)
+        print(f"\n==== {fname} のタグ付け結果 ====")
+        print(output)
+
+        blocks = parse_json_blocks(output)
+        if not blocks:
+            print(f"{fname}: 応答を解析できませんでした。再試行します...")
+            continue
+        blocks = repair(fname, lines, blocks, tags, base_block_count, client, limiter, slots=slots)
+        if blocks is not None:
+            save_blocks(fname, blocks)
+            return blocks
+        break
+    print(f"タグ付け結果を修正しきれませんでした。Something Went Wrong ってやつです。: {fname}")
+    return None
+
+def repair(fname, lines, blocks, tags, count, client, limiter=None, start=0, end=None, slots=None):
+    """
+    validate_blocks で見つかった問題を、部分的な問い合わせで直す。直しきれなければ None
+    - 範囲・隙間・重なり・タグの問題: その区間（前後 REPAIR_MARGIN 行を含む）の行だけを送り、区間内を区切り直させる
+    - 工程数だけの問題: 現在の区切りと、各区切りの前後の行だけを送り、count 個に合わせさせる
+    """
+    end = len(lines) if end is None else end
+    for round_ in range(REPAIR_ROUNDS + 1):
+        # 範囲外にはみ出した部分は手元で切り落とす（逆順・範囲外だけのブロックは捨て、空いた行は隙間として直させる）
+        blocks = [{**b, "start_line": max(start, b["start_line"]), "end_line": min(end - 1, b["end_line"])}
+                  for b in blocks
+                  if b["start_line"] <= b["end_line"] and b["end_line"] >= start and b["start_line"] < end]
+        problems = validate_blocks(blocks, start, end, tags, count)
+        if not problems:
+            return blocks
+        if round_ == REPAIR_ROUNDS:
+            break
+        for p in problems:
+            print(f"{fname}: [{p['kind']}] {p['message']}")
+        ranges = [(max(lo, start), min(hi, end)) for lo, hi in problem_ranges(problems, len(lines))]
+        if ranges:
+            for lo, hi in ranges:
+                with tracer.span("add_tag.repair", file=fname, kind="range", start=lo, end=hi, round=round_ + 1):
+                    fixed = parse_json_blocks(chat_request(
+                        client, repair_range_prompt(fname, lines, blocks, lo, hi), limiter, fname, blocks_format(tags), slots))
+                if fixed:
+                    blocks = splice_blocks(blocks, lo, hi, fixed)
+        else:
+            with tracer.span("add_tag.repair", file=fname, kind="count", blocks=len(blocks), round=round_ + 1):
+                fixed = parse_json_blocks(chat_request(
+                    client, repair_count_prompt(fname, lines, blocks, count), limiter, fname, blocks_format(tags), slots))
+            if fixed:
+                blocks = fixed
+    return None
+
+def repair_range_prompt(fname, lines, blocks, lo, hi):
+    before = [b for b in blocks if b["end_line"] < lo]
+    after = [b for b in blocks if b["start_line"] >= hi]
+    prev_tag = max(before, key=lambda b: b["end_line"])["tag"] if before else "なし"
+    next_tag = min(after, key=lambda b: b["start_line"])["tag"] if after else "なし"
+    return f"""
+以下は会話書き起こし（{fname}、全{len(lines)}行）のうち {lo}行目～{hi - 1}行目です。
+この範囲の工程の区切りに誤り（隙間・重なり・語彙にないタグなど）があったため、この範囲だけを区切り直してください。
+直前の工程: {prev_tag} / 直後の工程: {next_tag}
+
+【出力形式】
+{{"blocks": [{{"start_line": {lo}, "end_line": ..., "tag": "..."}}, ...]}}
 
+- {lo}行目から{hi - 1}行目までを、隙間も重なりもなく順に覆ってください。
+- タグ名は「phase_tags.txtに記載のもののみ」を使ってください。
+
+【会話データ】
+{numbered_text(fname, lines, lo, hi)}
+"""
+
+def repair_count_prompt(fname, lines, blocks, count):
+    excerpts = []
+    for b in blocks[1:]:
+        lo, hi = max(0, b["start_line"] - REPAIR_MARGIN), min(len(lines), b["start_line"] + REPAIR_MARGIN)
+        excerpts.append(f"--- {b['start_line']}行目の区切りの前後 ---\n{numbered_text(fname, lines, lo, hi)}")
+    excerpt_txt = "\n".join(excerpts)
+    return f"""
+会話書き起こし（{fname}、全{len(lines)}行）を工程ごとに区切った結果が {len(blocks)} 個ありますが、工程数は必ず{count}個にしてください。
+境界の近い区切りを統合する・長い工程を分けるなどして、{count}個に直してください。
+
+【現在の区切り】
+{json.dumps({"blocks": blocks}, ensure_ascii=False)}
+
+【出力形式】
+{{"blocks": [{{"start_line": 0, "end_line": ..., "tag": "..."}}, ...]}}
+
+- 0行目から{len(lines) - 1}行目までを、隙間も重なりもなく順に覆う{count}個のブロックにしてください。
+- タグ名は「phase_tags.txtに記載のもののみ」を使ってください。
+
+【各区切りの前後の会話】
+{excerpt_txt}
+"""
+
+# --- 窓ごとの並列タグ付け ----------
+def make_windows(n_lines, window_lines=WINDOW_LINES, overlap=WINDOW_OVERLAP):
+    """
+    [(start, end), ...]（end は含まない）。隣り合う窓は overlap 行ずつ重なる
+    """
+    step = max(1, window_lines - overlap)
+    windows = []
+    start = 0
+    while True:
+        end = min(n_lines, start + window_lines)
+        windows.append((start, end))
+        if end == n_lines:
+            return windows
+        start += step
+
+def window_labels(output, start, end, tags):
+    """
+    窓1つ分の応答を、行ごとのタグ（窓の外の行は無視、どのブロックにも入らない行は None）にする
+    解析できない・ブロックが1つもない応答は None（その窓だけ再送する）
+    語彙にないタグはそのまま残し、継ぎ合わせた後の検証で該当区間だけを直させる
+    """
+    blocks = parse_json_blocks(output)
+    if not blocks:
+        return None
+    labels = [None] * (end - start)
+    for b in blocks:
+        for i in range(max(start, b["start_line"]), min(end, b["end_line"] + 1)):
+            labels[i - start] = b["tag"]
+    if all(l is None for l in labels):
+        return None
+    return labels
+
+def reconcile(n_lines, windows, labels):
+    """
+    窓ごとの行タグを1本にまとめる。重なりの行は、重なりの中央より前なら前の窓、後なら後ろの窓の結果を使う
+    （窓の端の行は前後の文脈が足りず判断がぶれやすいので、窓の内側寄りの判断を採る）
+    どの窓でもタグのつかなかった行は None のまま残す（隙間として検証・修正に回す）
+    """
+    merged = [None] * n_lines
+    for k, (start, end) in enumerate(windows):
+        lo = start if k == 0 else (start + windows[k - 1][1]) // 2
+        hi = end if k == len(windows) - 1 else (windows[k + 1][0] + end) // 2
+        for i in range(lo, hi):
+            merged[i] = labels[k][i - start]
+    return merged
+
+def runs_of(labels):
+    """
+    行ごとのタグを同じタグの連続ごとのブロックにする（タグが None の行はどのブロックにも入れない）
+    """
     blocks = []
-    for m in re.finditer(r"(\d+)[行目～]*(\d+)行目：(.+)", output):
-        start = int(m.group(1))
-        end = int(m.group(2))
-        tag = m.group(3).strip()
-        blocks.append({"start_line": start, "end_line": end, "tag": tag})
+    for i, tag in enumerate(labels):
+        if tag is None:
+            continue
+        if blocks and blocks[-1]["tag"] == tag and blocks[-1]["end_line"] == i - 1:
+            blocks[-1]["end_line"] = i
+        else:
+            blocks.append({"start_line": i, "end_line": i, "tag": tag})
+    return blocks
 
-    tags = sorted({b["tag"] for b in blocks})
-    print("\n=== 以下のようにタグ分けしました ===")
-    for t in tags:
-        print(t)
-    print("======================\n")
-
-    yn = input("このタグ分けで問題ないですか？ [Y/N]: ").strip().lower()
-    if yn == "y":
-        # jsonに保存
-        outname = f"phase_blocks_{os.path.splitext(base_txt)[0]}.json"
-        with open(outname, "w", encoding="utf-8") as f:
-            json.dump(blocks, f, ensure_ascii=False, indent=2)
-        # .txtに保存（出現順に書かれるよう処理）
-        tags_in_order = []
+def enforce_block_count(blocks, count):
+    """
+    工程数が count を超えていれば、いちばん短いブロックを長い方の隣に吸収させることを繰り返す
+    （窓の境界で生じる数行だけの工程の揺れを消す）。count より少なければ None
+    """
+    blocks = [dict(b) for b in blocks]
+    while len(blocks) > count:
+        k = min(range(len(blocks)), key=lambda j: blocks[j]["end_line"] - blocks[j]["start_line"])
+        neighbors = [j for j in (k - 1, k + 1) if 0 <= j < len(blocks)]
+        j = max(neighbors, key=lambda j: blocks[j]["end_line"] - blocks[j]["start_line"])
+        blocks[j]["start_line"] = min(blocks[j]["start_line"], blocks[k]["start_line"])
+        blocks[j]["end_line"] = max(blocks[j]["end_line"], blocks[k]["end_line"])
+        del blocks[k]
+        # 吸収で同じタグが隣り合ったら1つにする
+        coalesced = []
         for b in blocks:
-            t = b["tag"]
-            if t not in tags_in_order:
-                tags_in_order.append(t)
-        with open("phase_tags.txt", "w", encoding="utf-8") as f:
-            for t in tags_in_order:
-                f.write(t + "\n")
-        print("他のファイルについても、同様にタグ分けを行います")
-        add_tag_all()
-        print("全ファイルのタグ分けが完了しました")
-        break
-    else:
-        # ユーザーから追加指示を受けて再試行
-        add = input("プロンプトに追加する指示（例：『大まかに分類してください』など）: ").strip()
-        user_prompt = add
-        print("改めてタグ分け中です...\n")
\ No newline at end of file
+            if coalesced and coalesced[-1]["tag"] == b["tag"]:
+                coalesced[-1]["end_line"] = b["end_line"]
+            else:
+                coalesced.append(b)
+        blocks = coalesced
+    return blocks if len(blocks) == count else None
+
+def tag_file_windowed(fname, lines, tags, tag_instr, base_block_count, client, limiter=None,
+                      window_lines=WINDOW_LINES, overlap=WINDOW_OVERLAP, concurrency=WINDOW_CONCURRENCY, slots=None):
+    """
+    書き起こしを重なりのある窓に分け、窓ごとに並列でタグ付けしてから継ぎ合わせる
+    1回の問い合わせは窓の長さで頭打ちになるので、長い書き起こしでもレイテンシ・トークン数は増えない。
+    解析できなかった窓だけを最大3回まで送り直し、最後に工程数を base_block_count に合わせる
+    （継ぎ合わせた結果の隙間・語彙外のタグはその区間だけを送って直させ、
+      短い工程の吸収で工程数が合わなければ区切りの前後だけを送って直させる）
+    """
+    windows = make_windows(len(lines), window_lines, overlap)
+
+    def tag_window(k):
+        start, end = windows[k]
+        prompt = f"""
+以下は作業実践中の会話書き起こしの一部（全{len(lines)}行のうち {start}行目～{end - 1}行目）です。
+前後の工程が途中から始まったり、途中で終わったりしていてもかまいません。
+この範囲について「どこからどこまでが同じ“作業工程（フェーズ）”なのか」を抽出し、
+工程ごとにタグ名をつけて、区切り・対応範囲を明示してください。
+
+【出力形式】
+{{"blocks": [{{"start_line": {start}, "end_line": {start + 12}, "tag": "TAG1"}}, {{"start_line": {start + 13}, "end_line": {start + 41}, "tag": "TAG2"}}, ...]}}
+
+- 行番号は会話データに書かれている番号をそのまま使ってください。
+- タグ名は「phase_tags.txtに記載のもののみ」を必ず使ってください。他の表記は禁止です。
+{tag_instr}
+
+【会話データ】
+{numbered_text(fname, lines, start, end)}
+"""
+        for attempt in range(3):
+            with tracer.span("add_tag.window", file=fname, window=k, start=start, end=end, attempt=attempt + 1) as span:
+                output = chat_request(client, prompt, limiter, f"{fname} 窓{k}", blocks_format(tags), slots)
+                labels = window_labels(output, start, end, tags)
+                span.set(ok=labels is not None)
+            if labels is not None:
+                return labels
+            print(f"{fname} 窓{k}（{start}-{end - 1}行目）: 応答を解析できませんでした。この窓だけ再試行します...")
+        raise ValueError(f"{fname} 窓{k}（{start}-{end - 1}行目）を3回試行してもタグ付けできませんでした")
+
+    results = run_concurrent(list(range(len(windows))), tag_window, concurrency,
+                             label=lambda k: f"{fname} 窓{k + 1}/{len(windows)}")
+    failed = [k for k, r in results.items() if isinstance(r, Exception)]
+    if failed:
+        print(f"{fname}: タグ付けできなかった窓があります: {failed}")
+        return None
+
+    labels = reconcile(len(lines), windows, [results[k] for k in range(len(windows))])
+    # 隙間・語彙外のタグを先に直してから、工程数を合わせる
+    blocks = repair(fname, lines, runs_of(labels), tags, None, client, limiter, slots=slots)
+    if blocks is not None:
+        blocks = enforce_block_count(blocks, base_block_count) or blocks
+        blocks = repair(fname, lines, blocks, tags, base_block_count, client, limiter, slots=slots)
+    if blocks is None:
+        print(f"{fname}: 継ぎ合わせた結果を修正しきれませんでした (期待する工程数: {base_block_count})")
+        return None
+    print(f"\n==== {fname} のタグ付け結果（{len(windows)}窓） ====")
+    for n, b in enumerate(blocks, 1):
+        print(f"{n}. {b['start_line']}行目～{b['end_line']}行目：{b['tag']}")
+    save_blocks(fname, blocks)
+    return blocks
+# --- ここまで窓ごとの並列タグ付け ----------
+
+def add_tag_all(concurrency=CONCURRENCY, rpm=RPM_LIMIT, tpm=TPM_LIMIT, client=None, force=False):
+    """
+    base_txt以外の全2024-10-*.txtを、phase_tags.txtのタグで並列にタグ分けする
+    concurrency=1 なら従来どおり1ファイルずつ処理する
+    マニフェストと内容・タグ語彙・工程数が一致するファイルはスキップする（force=Trueで全件やり直し）
+    """
+    # 1. phase_tags.txtを読み込む
+    fixed_tags = load_phase_tags()
+
+    tag_list_str = "・" + "\n・".join(fixed_tags)
+    tag_instr = f"これは「phase_tags.txt」です。記載されているタグのみを使い、タグ付けしてください。ここに記載されているタグは遵守し、追記・削除は絶対に行わないでください:\n{tag_list_str}"
+
+    # --- base_txtの区間数を取得 ---
+    with open(blocks_path(base_txt), encoding="utf-8") as f:
+        base_blocks = json.load(f)
+    base_block_count = len(base_blocks)
+
+    # 2. 他の2024-10-*.txtについてもphase_tag.txtをベースにタグ分け
+    txt_files = [f for f in sorted(glob.glob("2024-10-*.txt")) if f != base_txt] # 1件目はすでに処理済みなので省略
+
+    # 新規・変更ファイルだけを処理対象にする（phase_tags.txtが変われば全件やり直し）
+    tags_hash = sha256_of("\n".join(fixed_tags).encode("utf-8"))
+    manifest = {f: e for f, e in load_manifest().items() if f in txt_files}
+    entries = {f: manifest_entry(f, tags_hash, base_block_count) for f in txt_files}
+    todo = [
+        f for f in txt_files
+        if force or manifest.get(f) != entries[f] or not os.path.exists(blocks_path(f))
+    ]
+    if len(todo) < len(txt_files):
+        print(f"変更のない {len(txt_files) - len(todo)} 件はスキップします")
+    save_manifest(manifest)
+
+    limiter = RateLimiter(rpm=rpm, tpm=tpm)
+    # 長い書き起こしは窓ごとにも並列に投げるので、LLMへの同時リクエスト数はファイルと窓で共有する枠で抑える
+    slots = threading.BoundedSemaphore(concurrency)
+    manifest_lock = threading.Lock()
+
+    def run(fname):
+        with tracer.span("add_tag.file", file=fname) as span:
+            blocks = tag_file(fname, tag_instr, base_block_count, client=client, limiter=limiter, tags=fixed_tags,
+                              slots=slots)
+            span.set(ok=blocks is not None)
+        if blocks is not None:
+            with manifest_lock:
+                manifest[fname] = entries[fname]
+                save_manifest(manifest)
+        return blocks
+
+    with tracer.span("add_tag.all", files=len(todo), skipped=len(txt_files) - len(todo), concurrency=concurrency):
+        results = run_concurrent(todo, run, concurrency=concurrency)
+    failed = [f for f, r in results.items() if not isinstance(r, list)]
+    if failed:
+        print(f"タグ分けできなかったファイル: {', '.join(sorted(failed))}")
+    return results
+# ---------------------------------------
+
+def main(client=None):
+    client = client or default_client()
+    user_prompt = ""
+    line_txt = numbered_text(base_txt)
+
+    while True:
+        prompt = make_prompt(line_txt, user_prompt)
+        response = client.chat.completions.create(
+            model="gpt-4.1",
+            messages=[
+                {"role": "system", "content": "あなたは作業会話の工程分析エキスパートです。"},
+                {"role": "user", "content": prompt}
+            ],
+            #max_tokens=2000,
+            #temperature=0,
+        )
+        output = response.choices[0].message.content
+        print(output)
+
+        blocks = parse_blocks(output)
+
+        tags = sorted({b["tag"] for b in blocks})
+        print("\n=== 以下のようにタグ分けしました ===")
+        for t in tags:
+            print(t)
+        print("======================\n")
+
+        yn = input("このタグ分けで問題ないですか？ [Y/N]: ").strip().lower()
+        if yn == "y":
+            # jsonに保存
+            outname = blocks_path(base_txt)
+            with open(outname, "w", encoding="utf-8") as f:
+                json.dump(blocks, f, ensure_ascii=False, indent=2)
+            # .txtに保存（出現順に書かれるよう処理）
+            tags_in_order = []
+            for b in blocks:
+                t = b["tag"]
+                if t not in tags_in_order:
+                    tags_in_order.append(t)
+            with open("phase_tags.txt", "w", encoding="utf-8") as f:
+                for t in tags_in_order:
+                    f.write(t + "\n")
+            print("他のファイルについても、同様にタグ分けを行います")
+            add_tag_all(client=client)
+            print("全ファイルのタグ分けが完了しました")
+            break
+        else:
+            # ユーザーから追加指示を受けて再試行
+            add = input("プロンプトに追加する指示（例：『大まかに分類してください』など）: ").strip()
+            user_prompt = add
+            print("改めてタグ分け中です...\n")
+
+if __name__ == "__main__":
+    main()
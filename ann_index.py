@@ -0,0 +1,205 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from vector_search import VectorSearch, topk
+
+ASSIGN_BLOCK = 4096  # k-means の割り当てで一度に行列積に載せる行数
+
+# --- 球面k-means（粗量子化器の学習） ----------
+def _assign(x, centroids):
+    """
+    各行を内積最大のセントロイドに割り当てる（行列積をブロックに分けて実行）
+    """
+    labels = np.empty(x.shape[0], dtype=np.int64)
+    for s in range(0, x.shape[0], ASSIGN_BLOCK):
+        labels[s:s + ASSIGN_BLOCK] = np.argmax(x[s:s + ASSIGN_BLOCK] @ centroids.T, axis=1)
+    return labels
+
+def spherical_kmeans(x, n_clusters, n_iter=20, seed=0):
+    """
+    正規化済みベクトル x を n_clusters 個に分ける球面k-means
+    戻り値: 正規化済みのセントロイド (n_clusters, dim)
+    """
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(x.shape[0], n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = _assign(x, centroids)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=n_clusters)
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        sums = np.add.reduceat(x[order], starts, axis=0)
+        centroids[nonempty] = sums
+        # 空クラスタはランダムな点で再初期化
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = x[rng.choice(x.shape[0], len(empty), replace=False)]
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+# --- ここまで球面k-means ----------
+
+# --- プロセスプール用ワーカ ----------
+_worker_index = None
+
+def _init_worker(index):
+    global _worker_index
+    _worker_index = index
+
+def _worker_search(queries, k, n_probe):
+    # n_probe はプール作成後に変わりうるので、呼び出しごとに受け取る
+    return _worker_index._search_serial(queries, k, n_probe)
+# --- ここまでプロセスプール用ワーカ ----------
+
+# --- IVF近似最近傍インデックス ----------
+class IVFIndex:
+    """
+    k-meansの粗量子化による転置リスト（IVF）近似検索
+    VectorSearch と同じ search / search_batch を持つ。
+    - n_lists: リスト（クラスタ）数。多いほど1リストが小さく速いが、取りこぼしが増える
+    - n_probe: 1質問で走査するリスト数。大きいほど再現率が上がり、遅くなる
+    - n_jobs : 2以上でバッチ検索の質問をプロセスプールに分割して走査する
+    """
+
+    def __init__(self, embeddings, n_lists=None, n_probe=8, n_iter=20,
+                 train_size=100_000, n_jobs=1, seed=0):
+        x = VectorSearch._normalize(embeddings)
+        n = x.shape[0]
+        rng = np.random.default_rng(seed)
+        sample = x if n <= train_size else x[rng.choice(n, train_size, replace=False)]
+        self.n_lists = min(n_lists or max(1, int(np.sqrt(n))), sample.shape[0])
+        self.n_probe = n_probe
+        self.n_jobs = n_jobs
+        self._pool = None
+
+        self.centroids = spherical_kmeans(sample, self.n_lists, n_iter=n_iter, seed=seed)
+
+        # リストごとに行を並べ替え、各リストを連続領域として走査できるようにする
+        labels = _assign(x, self.centroids)
+        self.order = np.argsort(labels, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=self.n_lists))])
+        self.matrix = x[self.order]
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def _search_serial(self, q, k, n_probe=None):
+        n_probe = self.n_probe if n_probe is None else n_probe
+        k = min(k, len(self))
+        indices = np.full((q.shape[0], k), -1, dtype=np.int64)
+        scores = np.full((q.shape[0], k), -np.inf, dtype=np.float32)
+        list_order = np.argsort(-(q @ self.centroids.T), axis=1)
+        sizes = np.diff(self.offsets)
+        for qi in range(q.shape[0]):
+            # n_probe 本を走査。候補がk件に満たなければ次に近いリストも足す
+            lists = []
+            n_cand = 0
+            for l in list_order[qi]:
+                if len(lists) >= n_probe and n_cand >= k:
+                    break
+                if sizes[l]:
+                    lists.append(l)
+                    n_cand += sizes[l]
+            pos = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+            sc = np.concatenate([self.matrix[self.offsets[l]:self.offsets[l + 1]] @ q[qi] for l in lists])
+            top, top_sc = topk(sc[None, :], k)
+            indices[qi, :top.shape[1]] = self.order[pos[top[0]]]
+            scores[qi, :top.shape[1]] = top_sc[0]
+        return indices, scores
+
+    def search(self, query, k):
+        idx, sc = self.search_batch([query], k)
+        return idx[0], sc[0]
+
+    def search_batch(self, queries, k):
+        q = VectorSearch._normalize(queries)
+        if self.n_jobs <= 1 or q.shape[0] < 2 * self.n_jobs:
+            return self._search_serial(q, k)
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.n_jobs, initializer=_init_worker, initargs=(self,)
+            )
+        shards = np.array_split(q, self.n_jobs)
+        results = list(self._pool.map(_worker_search, shards, [k] * len(shards), [self.n_probe] * len(shards)))
+        return (np.concatenate([r[0] for r in results]),
+                np.concatenate([r[1] for r in results]))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+# --- ここまでIVF近似最近傍インデックス ----------
+
+# --- インデックス生成 ----------
+def make_index(kind, embeddings, **params):
+    """
+    kind="exact" なら全件検索、"ivf" ならIVF近似検索のインデックスを返す
+    """
+    if kind == "exact":
+        return VectorSearch(embeddings)
+    if kind == "ivf":
+        return IVFIndex(embeddings, **params)
+    raise ValueError(f"未対応のインデックス種別です: {kind}")
+# --- ここまでインデックス生成 ----------
+
+# --- 再現率の計測 ----------
+def evaluate_recall(index, exact, queries, k=5):
+    """
+    全件検索 exact を正解として、index の recall@k と1質問あたりの検索時間を測る
+    """
+    t0 = time.perf_counter()
+    true_idx, _ = exact.search_batch(queries, k)
+    t1 = time.perf_counter()
+    approx_idx, _ = index.search_batch(queries, k)
+    t2 = time.perf_counter()
+    hits = sum(len(set(a) & set(t)) for a, t in zip(approx_idx.tolist(), true_idx.tolist()))
+    n = len(queries)
+    return {
+        f"recall@{k}": hits / (n * true_idx.shape[1]),
+        "exact_ms_per_query": (t1 - t0) * 1000 / n,
+        "ann_ms_per_query": (t2 - t1) * 1000 / n,
+    }
+# --- ここまで再現率の計測 ----------
+
+# --- 設定探索（Embeddingキャッシュ上で実行） ----------
+def main():
+    import argparse
+    from embed_cache import store_dir
+
+    parser = argparse.ArgumentParser(description="IVFの n_lists / n_probe ごとの recall@k と検索時間を測る")
+    parser.add_argument("--model", default="text-embedding-3-large")
+    parser.add_argument("--group-size", default="4", help="RAG2knowhow.py の GROUP_SIZE")
+    parser.add_argument("--n-lists", type=int, nargs="*", default=[0])
+    parser.add_argument("--n-probe", type=int, nargs="*", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--n-queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    args = parser.parse_args()
+
+    path = os.path.join(store_dir(args.model, args.group_size), "vectors.npy")
+    emb = np.load(path, mmap_mode="r")
+    exact = VectorSearch(emb)
+    # コーパスの行にノイズを足したものを質問ベクトルとして使う
+    rng = np.random.default_rng(0)
+    queries = exact.matrix[rng.choice(len(exact), min(args.n_queries, len(exact)), replace=False)]
+    queries = queries + rng.normal(scale=0.02, size=queries.shape).astype(np.float32)
+
+    print(f"チャンク数: {len(exact)}  次元: {exact.matrix.shape[1]}")
+    for n_lists in args.n_lists:
+        t0 = time.perf_counter()
+        index = IVFIndex(emb, n_lists=n_lists or None, n_jobs=args.n_jobs)
+        print(f"\nn_lists={index.n_lists} 構築 {time.perf_counter() - t0:.2f}s")
+        for n_probe in args.n_probe:
+            index.n_probe = n_probe
+            r = evaluate_recall(index, exact, queries, args.k)
+            print(f"  n_probe={n_probe:3d}  recall@{args.k}={r[f'recall@{args.k}']:.3f}"
+                  f"  exact={r['exact_ms_per_query']:.2f}ms  ivf={r['ann_ms_per_query']:.2f}ms")
+        index.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import numpy as np
+
+CACHE_DIR = ".answer_cache"  # 回答キャッシュの保存先
+CORPUS_PATTERNS = ("2024-10-*.txt", "phase_blocks_*.json", "phase_tags.txt", "phase_digests.json")
+
+# --- コーパスの指紋 ----------
+def corpus_fingerprint(patterns=CORPUS_PATTERNS, extra=""):
+    """
+    書き起こし・タグ付け結果・タグ一覧の (ファイル名, サイズ, 更新時刻) から作るハッシュ
+    どれかが変われば値が変わり、キャッシュ済みの回答は無効になる
+    """
+    h = hashlib.sha256(extra.encode("utf-8"))
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            st = os.stat(path)
+            h.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8"))
+    return h.hexdigest()
+# --- ここまでコーパスの指紋 ----------
+
+# --- 意味的回答キャッシュ ----------
+class AnswerCache:
+    """
+    質問Embeddingをキーにした回答キャッシュ
+    コサイン類似度が threshold 以上の過去の質問があれば、その回答を返す。
+    max_entries を超えたら最後に使われたのが古いものから捨て（LRU）、ttl 秒を過ぎた回答は使わない。
+    コーパスの指紋が変わると全件破棄する。
+    """
+
+    def __init__(self, namespace, threshold=0.92, max_entries=500, ttl=7 * 24 * 3600,
+                 extra="", cache_dir=CACHE_DIR, check_interval=5.0):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.extra = extra  # 回答に影響する設定値（TOPNなど）。変えると別の指紋になる
+        self.check_interval = check_interval
+        self.entries_path = os.path.join(cache_dir, f"{namespace}.json")
+        self.vectors_path = os.path.join(cache_dir, f"{namespace}.npy")
+        self.entries = []  # {"question", "answer", "created", "last_used"}
+        self.vectors = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._last_check = None
+        self.fingerprint = corpus_fingerprint(extra=extra)
+        self._load()
+
+    def _load(self):
+        if not (os.path.exists(self.entries_path) and os.path.exists(self.vectors_path)):
+            return
+        with open(self.entries_path, encoding="utf-8") as f:
+            data = json.load(f)
+        vectors = np.load(self.vectors_path)
+        if data.get("fingerprint") != self.fingerprint or len(data["entries"]) != len(vectors):
+            return  # コーパスが変わったので読み込まない（次の保存で上書きされる）
+        self.entries = data["entries"]
+        self.vectors = vectors if self.entries else None  # 空のキャッシュは (0, 0) で保存されている
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.entries_path), exist_ok=True)
+        vectors = self.vectors if self.vectors is not None else np.empty((0, 0), dtype=np.float32)
+        tmp = self.vectors_path + ".tmp.npy"
+        np.save(tmp, vectors)
+        os.replace(tmp, self.vectors_path)
+        tmp = self.entries_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": self.fingerprint, "entries": self.entries}, f, ensure_ascii=False)
+        os.replace(tmp, self.entries_path)
+
+    def _check_corpus(self):
+        now = time.monotonic()
+        if self._last_check is not None and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        fp = corpus_fingerprint(extra=self.extra)
+        if fp != self.fingerprint:
+            self.fingerprint = fp
+            self.entries, self.vectors = [], None
+            self._save()
+
+    def _drop(self, keep):
+        self.entries = [e for e, k in zip(self.entries, keep) if k]
+        self.vectors = self.vectors[np.asarray(keep, dtype=bool)] if self.entries else None
+
+    @staticmethod
+    def _normalize(q_emb):
+        q = np.asarray(q_emb, dtype=np.float32).ravel()
+        return q / max(float(np.linalg.norm(q)), 1e-12)
+
+    def lookup(self, q_emb):
+        """
+        似た質問の回答があれば返す（なければ None）
+        """
+        with self._lock:
+            self._check_corpus()
+            now = time.time()
+            if self.entries and self.ttl is not None:
+                alive = [now - e["created"] < self.ttl for e in self.entries]
+                if not all(alive):
+                    self._drop(alive)
+            if not self.entries:
+                self.misses += 1
+                return None
+            sims = self.vectors @ self._normalize(q_emb)
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[best]["last_used"] = now
+            return self.entries[best]["answer"]
+
+    def store(self, question, q_emb, answer):
+        with self._lock:
+            now = time.time()
+            q = self._normalize(q_emb)[None, :]
+            self.entries.append({"question": question, "answer": answer, "created": now, "last_used": now})
+            self.vectors = q if self.vectors is None else np.vstack([self.vectors, q])
+            if len(self.entries) > self.max_entries:
+                order = np.argsort([e["last_used"] for e in self.entries])
+                keep = np.ones(len(self.entries), dtype=bool)
+                keep[order[:len(self.entries) - self.max_entries]] = False
+                self._drop(keep)
+            self._save()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self.entries),
+        }
+# --- ここまで意味的回答キャッシュ ----------
@@ -0,0 +1,211 @@
+import json
+import os
+import threading
+import time
+from llm_pool import run_concurrent
+from tracing import tracer
+
+CONCURRENCY = 8  # 回答生成の同時実行数の上限
+
+# --- 入出力 ----------
+def read_questions(path):
+    """
+    1行1件のJSONLを読む（{"id": ..., "question": ...}。id を省略すると行番号。文字列だけの行も可）
+    """
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            obj = json.loads(line)
+            if isinstance(obj, str):
+                obj = {"question": obj}
+            items.append({"id": obj.get("id", n), "question": (obj.get("question") or "").strip()})
+    return items
+
+def write_results(path, results):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for r in results:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    os.replace(tmp, path)
+# --- ここまで入出力 ----------
+
+# --- 工程タグ経由 ----------
+class TagGroup:
+    """
+    同じ工程と推定された質問の組。ブロックは一度だけ読み、
+    原文が予算内に全部入る（＝質問によらない）コンテキストなら最初の1回だけ作って使い回す
+    """
+
+    def __init__(self, tag, sections):
+        self.tag = tag
+        self.sections = sections
+        self.lock = threading.Lock()
+        self.shared = None     # 使い回すコンテキスト (context, source_desc, info)
+        self.shareable = None  # 最初のコンテキストを作るまでは None
+        self.built = 0         # 作ったコンテキストの数
+
+    def context_for(self, question, client):
+        import tag2knowhow
+        if self.shareable is None:
+            with self.lock:
+                if self.shareable is None:
+                    ctx = tag2knowhow.build_context(question, self.tag, self.sections, client)
+                    info = ctx[2]
+                    self.shareable = not info["digest"] and info["raw"] == info["sections"]
+                    self.shared = ctx if self.shareable else None
+                    self.built += 1
+                    return ctx
+        if self.shareable:
+            return self.shared
+        with self.lock:
+            self.built += 1
+        return tag2knowhow.build_context(question, self.tag, self.sections, client)
+
+def answer_tag(questions, client, concurrency):
+    """
+    戻り値: ({質問: 結果}, 集計)
+    """
+    import tag2knowhow
+    from embed_cache import embed_texts
+
+    # 1) 全質問をまとめて埋め込み、回答キャッシュを引く
+    with tracer.span("batch.embed_query", n=len(questions)):
+        q_embs = embed_texts(questions, tag2knowhow.EMBED_MODEL, client)
+    cache = tag2knowhow.get_answer_cache()
+    results, todo = {}, []
+    for i, q in enumerate(questions):
+        cached = cache.lookup(q_embs[i])
+        if cached is not None:
+            results[q] = {"answer": cached, "cached": True}
+        else:
+            todo.append(i)
+
+    # 2) 工程タグをまとめて推定し、タグごとに組にする
+    with tracer.span("batch.estimate_phase", n=len(todo)):
+        phases = tag2knowhow.estimate_phases([questions[i] for i in todo], q_embs[todo], client, concurrency)
+    groups = {}
+    for i, (tag, method) in zip(todo, phases):
+        if tag is None:
+            results[questions[i]] = {"error": "工程タグを推定できませんでした", "method": method}
+            continue
+        if tag not in groups:
+            groups[tag] = TagGroup(tag, tag2knowhow.tag_sections(tag))
+        results[questions[i]] = {"tag": tag, "method": method}
+
+    # 3) 回答を並列に生成する
+    def answer_one(i):
+        q = questions[i]
+        group = groups[results[q]["tag"]]
+        if not group.sections:
+            raise ValueError("該当タグの会話データが見つかりませんでした。")
+        context, source_desc, _info = group.context_for(q, client)
+        answer, _timing = tag2knowhow.chat_answer(tag2knowhow.build_prompt(q, source_desc, context), client=client)
+        cache.store(q, q_embs[i], answer)
+        return answer
+
+    jobs = [i for i in todo if "tag" in results[questions[i]]]
+    answers = run_concurrent(jobs, answer_one, concurrency, label=lambda i: questions[i][:30])
+    for i, answer in answers.items():
+        key = "error" if isinstance(answer, Exception) else "answer"
+        results[questions[i]][key] = str(answer) if key == "error" else answer
+        results[questions[i]]["cached"] = False
+    stats = {
+        "tags": {g.tag: sum(1 for i in jobs if results[questions[i]]["tag"] == g.tag) for g in groups.values()},
+        "contexts_built": sum(g.built for g in groups.values()),
+        "llm_tag_estimates": sum(1 for _tag, m in phases if m == "llm"),
+    }
+    return results, stats
+# --- ここまで工程タグ経由 ----------
+
+# --- RAG経由 ----------
+def answer_rag(questions, client, concurrency):
+    import RAG2knowhow
+
+    rag = RAG2knowhow.RAGCorpus(client)
+    with tracer.span("batch.embed_query", n=len(questions)):
+        q_embs = rag.embed_queries(questions)
+    results, todo = {}, []
+    for i, q in enumerate(questions):
+        cached = rag.answer_cache.lookup(q_embs[i])
+        if cached is not None:
+            results[q] = {"answer": cached, "cached": True}
+        else:
+            todo.append(i)
+
+    # 検索もまとめて1回で行う
+    with tracer.span("batch.search", n=len(todo)):
+        top_indices, scores = rag.search_engine.search_batch(q_embs[todo], RAG2knowhow.TOPN) if todo else ([], [])
+    contexts = {i: rag.assemble(top_indices[k], scores[k]) for k, i in enumerate(todo)}
+
+    def answer_one(i):
+        q = questions[i]
+        answer = RAG2knowhow.generate_answer(q, contexts[i], client=client, record=False)
+        rag.answer_cache.store(q, q_embs[i], answer)
+        return answer
+
+    answers = run_concurrent(todo, answer_one, concurrency, label=lambda i: questions[i][:30])
+    for i, answer in answers.items():
+        if isinstance(answer, Exception):
+            results[questions[i]] = {"error": str(answer), "cached": False}
+        else:
+            results[questions[i]] = {"answer": answer, "cached": False}
+    return results, {"chunks": len(rag.chunks)}
+# --- ここまでRAG経由 ----------
+
+# --- 一括回答 ----------
+def run_batch(items, route="tag", client=None, concurrency=CONCURRENCY):
+    """
+    質問のリスト（read_questions の戻り値）にまとめて回答する
+    同じ文面の質問は1回だけ回答し、入力と同じ順に {"id", "question", "route", "answer" / "error", ...} を返す
+    埋め込みは一括リクエスト、回答生成は最大 concurrency 並列なので、所要時間は質問数ではなく並列数で決まる
+    """
+    from openai_client import default_client
+    client = client or default_client()
+    questions = list(dict.fromkeys(it["question"] for it in items if it["question"]))
+    started = time.perf_counter()
+    with tracer.span("batch", route=route, questions=len(items), unique=len(questions)) as span:
+        if not questions:
+            results, stats = {}, {}
+        elif route == "tag":
+            results, stats = answer_tag(questions, client, concurrency)
+        elif route == "rag":
+            results, stats = answer_rag(questions, client, concurrency)
+        else:
+            raise ValueError(f"route は tag / rag のいずれかです: {route}")
+        span.set(**{k: v for k, v in stats.items() if not isinstance(v, dict)})
+    elapsed = time.perf_counter() - started
+
+    out = []
+    for it in items:
+        r = results.get(it["question"], {"error": "質問が空です"})
+        out.append({"id": it["id"], "question": it["question"], "route": route, **r})
+    summary = {
+        "questions": len(items),
+        "unique": len(questions),
+        "cached": sum(1 for q in questions if results[q].get("cached")),
+        "errors": sum(1 for r in out if "error" in r),
+        "elapsed": round(elapsed, 2),
+        "questions_per_sec": round(len(questions) / elapsed, 2) if elapsed > 0 else None,
+        **stats,
+    }
+    return out, summary
+# --- ここまで一括回答 ----------
+
+def main(argv=None, client=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="JSONLの質問にまとめて回答し、JSONLで書き出す")
+    parser.add_argument("input")
+    parser.add_argument("-o", "--output", default="batch_answers.jsonl")
+    parser.add_argument("--route", choices=("tag", "rag"), default="tag")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    args = parser.parse_args(argv)
+    results, summary = run_batch(read_questions(args.input), args.route, client, args.concurrency)
+    write_results(args.output, results)
+    print(f"\n{args.output} に {len(results)}件書き出しました")
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import json
+import os
+from collections import Counter
+import numpy as np
+from scipy import sparse
+from ngrams import NGRAM, char_ngrams
+from vector_search import topk
+
+# --- BM25（疎行列） ----------
+class BM25Index:
+    """
+    BM25の重みを (語彙数, 文書数) の疎行列に前計算しておき、
+    質問の語の出現回数ベクトルとの疎行列・ベクトル積1回で全文書のスコアを出す
+    （質問に出てくる語の行だけを読むので、文書数が数十万でも数ミリ秒で済む）
+    idf は負にならない log(1 + (N - df + 0.5) / (df + 0.5)) を使う
+    """
+
+    def __init__(self, texts=None, k1=1.5, b=0.75, n=NGRAM):
+        self.k1 = k1
+        self.b = b
+        self.n = n
+        self.vocab = {}
+        self.weights = None  # (語彙数, 文書数) の CSR
+        if texts is not None:
+            self.build(texts)
+
+    def build(self, texts):
+        self.vocab = {}
+        rows, cols, tfs = [], [], []
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for d, text in enumerate(texts):
+            counts = Counter(char_ngrams(text, self.n))
+            doc_len[d] = sum(counts.values())
+            for term, tf in counts.items():
+                rows.append(self.vocab.setdefault(term, len(self.vocab)))
+                cols.append(d)
+                tfs.append(tf)
+        rows = np.asarray(rows, dtype=np.int32)
+        cols = np.asarray(cols, dtype=np.int32)
+        tfs = np.asarray(tfs, dtype=np.float32)
+
+        n_docs = len(texts)
+        df = np.bincount(rows, minlength=len(self.vocab)).astype(np.float32)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+        avgdl = doc_len.mean() if n_docs else 1.0
+        norm = self.k1 * (1 - self.b + self.b * doc_len / max(avgdl, 1e-9))
+        data = idf[rows] * tfs * (self.k1 + 1) / (tfs + norm[cols])
+        self.weights = sparse.csr_matrix((data, (rows, cols)), shape=(len(self.vocab), n_docs), dtype=np.float32)
+        return self
+
+    def __len__(self):
+        return self.weights.shape[1]
+
+    def query_terms(self, query):
+        """
+        質問に出てくる既知の語の (語ID, 出現回数)（未知語は捨てる）
+        """
+        counts = Counter(t for t in char_ngrams(query, self.n) if t in self.vocab)
+        ids = np.fromiter((self.vocab[t] for t in counts), dtype=np.int32, count=len(counts))
+        return ids, np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+
+    def scores(self, query):
+        """
+        全文書のBM25スコア（長さ len(self) の float32 配列）
+        質問の語の行だけを取り出した疎行列と出現回数ベクトルの積1回で求める
+        """
+        ids, counts = self.query_terms(query)
+        if len(ids) == 0:
+            return np.zeros(len(self), dtype=np.float32)
+        return self.weights[ids].T @ counts
+
+    # --- 保存・読み込み ----------
+    def save(self, path):
+        """
+        path ディレクトリに重み行列（CSRの3配列）と語彙・パラメータを保存する
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ("data", "indices", "indptr"):
+            tmp = os.path.join(path, f"bm25_{name}.tmp.npy")
+            np.save(tmp, getattr(self.weights, name))
+            os.replace(tmp, os.path.join(path, f"bm25_{name}.npy"))
+        tmp = os.path.join(path, "bm25.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "n": self.n, "shape": list(self.weights.shape),
+                       "vocab": list(self.vocab)}, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(path, "bm25.json"))
+
+    @classmethod
+    def load(cls, path):
+        """
+        save() したものを読む。重み行列の配列はメモリマップで開く
+        """
+        with open(os.path.join(path, "bm25.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls(k1=meta["k1"], b=meta["b"], n=meta["n"])
+        index.vocab = {t: i for i, t in enumerate(meta["vocab"])}
+        arrays = [np.load(os.path.join(path, f"bm25_{name}.npy"), mmap_mode="r") for name in ("data", "indices", "indptr")]
+        index.weights = sparse.csr_matrix(tuple(arrays), shape=tuple(meta["shape"]), copy=False)
+        return index
+    # --- ここまで保存・読み込み ----------
+
+    def search(self, query, k):
+        """
+        上位k件の (indices, scores)
+        """
+        indices, scores = topk(self.scores(query)[None, :], k)
+        return indices[0], scores[0]
+# --- ここまでBM25（疎行列） ----------
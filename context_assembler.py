@@ -0,0 +1,101 @@
+from context_packer import split_by_tokens
+from token_cache import get_counter
+
+SEPARATOR = "\n---\n"
+
+# --- 区間のマージ ----------
+def merge_intervals(spans):
+    """
+    (source, start, end, score) の行区間（end は含まない）を、同じ source 内で重なる・隣接するものどうしまとめる
+    まとめた区間のスコアは最大値。戻り値はスコア降順（同点は source, start 順）の互いに素な区間
+    """
+    by_source = {}
+    for source, start, end, score in spans:
+        by_source.setdefault(source, []).append((start, end, score))
+
+    merged = []
+    for source, items in by_source.items():
+        items.sort()
+        cur_start, cur_end, cur_score = items[0]
+        for start, end, score in items[1:]:
+            if start <= cur_end:
+                cur_end = max(cur_end, end)
+                cur_score = max(cur_score, score)
+            else:
+                merged.append((source, cur_start, cur_end, cur_score))
+                cur_start, cur_end, cur_score = start, end, score
+        merged.append((source, cur_start, cur_end, cur_score))
+    merged.sort(key=lambda m: (-m[3], m[0], m[1]))
+    return merged
+# --- ここまで区間のマージ ----------
+
+# --- コンテキスト組み立て ----------
+def default_header(source, start, end):
+    return f"【{source} 行{start}-{end - 1}】"
+
+def assemble_context(spans, text_fn, budget=None, counter=None, header=default_header, separator=SEPARATOR):
+    """
+    ヒットの行区間をマージし、スコア順にテキストを並べてコンテキストを作る
+    - text_fn(source, start, end): 区間の本文
+    - budget: トークン数の上限（None なら無制限。counter 省略時は token_cache の共有カウンタで数える）。収まらない区間は捨てるが、最上位の区間だけは予算まで切り詰めて残す
+    戻り値: (コンテキスト, {"hits", "intervals", "raw_lines", "lines", "dropped", "tokens"})
+    raw_lines はマージ前の区間の行数の合計（重複を含む）で、lines と比べると削れた量がわかる
+    """
+    spans = list(spans)
+    if budget is not None and counter is None:
+        counter = get_counter()
+    parts = []
+    used = 0
+    lines = 0
+    dropped = 0
+    for source, start, end, _score in merge_intervals(spans):
+        block = f"{header(source, start, end)}\n{text_fn(source, start, end)}"
+        n = counter.count(block, cache=False) if budget is not None else 0
+        if budget is not None and used + n > budget:
+            if parts:
+                dropped += 1
+                continue
+            block = split_by_tokens(block, budget, counter)[0]
+            n = counter.count(block, cache=False)
+        parts.append(block)
+        used += n
+        lines += end - start
+    info = {
+        "hits": len(spans),
+        "intervals": len(parts),
+        "raw_lines": sum(end - start for _source, start, end, _score in spans),
+        "lines": lines,
+        "dropped": dropped,
+        "tokens": used if budget is not None else None,
+    }
+    return separator.join(parts), info
+# --- ここまでコンテキスト組み立て ----------
+
+# --- チャンク索引 ----------
+class ChunkIndex:
+    """
+    {doc_id, chunk_idx, text, start_line, end_line} のチャンク列から一度だけ作る索引
+    doc_id -> {chunk_idx: chunk} と、チャンク本文から復元した doc_id -> 行リストを持つ
+    （重なりのあるチャンクを連結しても同じ行が二重に入らないよう、本文は行区間で切り出す）
+    """
+
+    def __init__(self, chunks):
+        self.by_doc = {}
+        self.doc_lines = {}
+        for c in chunks:
+            self.by_doc.setdefault(c["doc_id"], {})[c["chunk_idx"]] = c
+            lines = self.doc_lines.setdefault(c["doc_id"], [])
+            if len(lines) < c["end_line"] + 1:
+                lines.extend([""] * (c["end_line"] + 1 - len(lines)))
+            lines[c["start_line"]:c["end_line"] + 1] = c["text"].split("\n")
+
+    def neighbors(self, doc_id, chunk_idx, window):
+        """
+        chunk_idx の前後 window 件のチャンク（chunk_idx 順）
+        """
+        chunks = self.by_doc.get(doc_id, {})
+        return [chunks[k] for k in range(chunk_idx - window, chunk_idx + window + 1) if k in chunks]
+
+    def text(self, doc_id, start, end):
+        return "\n".join(self.doc_lines[doc_id][start:end])
+# --- ここまでチャンク索引 ----------
@@ -0,0 +1,129 @@
+from concurrent.futures import ThreadPoolExecutor
+from llm_pool import call_with_backoff
+from ngrams import char_ngrams
+from openai_client import default_client
+from token_cache import get_counter
+from tracing import tracer
+
+SUMMARY_MODEL = "gpt-4.1-mini"
+SUMMARY_TOKENS = 400          # 要約1件の最大出力トークン数
+SUMMARY_INPUT_TOKENS = 6000   # 要約1回に渡す最大入力トークン数
+SUMMARY_RESERVE = 0.25        # 予算超過時、予算のうち要約に回す割合
+MAX_SUMMARY_INPUTS = 32       # 要約する断片数の上限（これを超える低関連の断片は捨てる）
+SEPARATOR = "\n\n---\n\n"
+SUMMARY_HEADER = "【その他のペアの要約】\n"
+
+# --- 関連度 ----------
+def lexical_relevance(question, text):
+    """
+    質問の文字bigramのうち、ブロックに現れるものの割合（日本語でも分かち書き不要）
+    """
+    q = set(char_ngrams(question))
+    if not q:
+        return 0.0
+    t = set(char_ngrams(text))
+    return sum(1 for g in q if g in t) / len(q)
+# --- ここまで関連度 ----------
+
+# --- 要約（map-reduce） ----------
+def summarize(question, text, client=None):
+    client = client or default_client()
+    prompt = f"""
+以下は作業会話の抜粋です。質問「{question}」に答えるのに役立つ手順・注意点・つまずきを、
+出典（【】内のファイル名）を残したまま箇条書きで簡潔に要約してください。
+
+{text}
+"""
+    resp = call_with_backoff(lambda: client.chat.completions.create(
+        model=SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": "あなたは作業会話の要約アシスタントです。"},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=SUMMARY_TOKENS,
+    ))
+    tracer.record_llm(SUMMARY_MODEL, resp.usage)
+    return resp.choices[0].message.content.strip()
+
+def split_by_tokens(text, max_tokens, counter):
+    """
+    行の区切りを保ったまま、max_tokens 以下の断片に分ける
+    """
+    pieces, buf, used = [], [], 0
+    for line in text.split("\n"):
+        n = counter.count(line, cache=False) + 1
+        if buf and used + n > max_tokens:
+            pieces.append("\n".join(buf))
+            buf, used = [], 0
+        buf.append(line)
+        used += n
+    if buf:
+        pieces.append("\n".join(buf))
+    return pieces
+
+def map_reduce_summaries(question, texts, budget, counter, client=None, max_workers=8):
+    """
+    texts を並列に要約し（map）、合計が budget を超える間はまとめて要約し直す（reduce）
+    戻り値: (要約テキスト, 上限超過で捨てた断片数)
+    """
+    pieces = [p for t in texts for p in split_by_tokens(t, SUMMARY_INPUT_TOKENS, counter)]
+    dropped = max(0, len(pieces) - MAX_SUMMARY_INPUTS)
+    pieces = pieces[:MAX_SUMMARY_INPUTS]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        summaries = list(pool.map(lambda p: summarize(question, p, client), pieces))
+        while len(summaries) > 1 and counter.count("\n".join(summaries), cache=False) > budget:
+            groups, buf, used = [], [], 0
+            for s in summaries:
+                n = counter.count(s, cache=False)
+                if buf and used + n > SUMMARY_INPUT_TOKENS:
+                    groups.append("\n".join(buf))
+                    buf, used = [], 0
+                buf.append(s)
+                used += n
+            groups.append("\n".join(buf))
+            summaries = list(pool.map(lambda g: summarize(question, g, client), groups))
+    text = "\n".join(summaries)
+    if counter.count(text, cache=False) > budget:
+        text = counter.enc.decode(counter.enc.encode(text)[:max(budget, 0)])
+    return text, dropped
+# --- ここまで要約（map-reduce） ----------
+
+# --- コンテキスト詰め込み ----------
+def pack_context(question, sections, budget, counter=None, client=None,
+                 rank_fn=lexical_relevance, max_workers=8):
+    """
+    sections（ブロックごとのテキスト）を budget トークン以内のコンテキストにまとめる
+    予算内なら全件をそのまま連結する。超える場合は質問との関連度が高い順に原文で入れ、
+    入りきらなかった分は並列に要約して末尾に付ける。
+    戻り値: (context, info)
+    """
+    counter = counter or get_counter()
+    sep = counter.count(SEPARATOR)
+    tokens = [n + sep for n in counter.count_many(sections, workers=1)]  # tools/tokenChecker.py で数え済みならキャッシュから
+    info = {"sections": len(sections), "raw": len(sections), "summarized": 0, "dropped": 0}
+
+    if sum(tokens) <= budget:
+        context = SEPARATOR.join(sections)
+    else:
+        order = sorted(range(len(sections)), key=lambda i: -rank_fn(question, sections[i]))
+        raw_budget = int(budget * (1 - SUMMARY_RESERVE))
+        chosen, overflow, used = [], [], 0
+        for i in order:
+            if used + tokens[i] <= raw_budget:
+                chosen.append(i)
+                used += tokens[i]
+            else:
+                overflow.append(i)
+        summary, dropped = map_reduce_summaries(
+            question, [sections[i] for i in overflow], budget - used - sep - counter.count(SUMMARY_HEADER),
+            counter, client=client, max_workers=max_workers,
+        )
+        parts = [sections[i] for i in sorted(chosen)]
+        parts.append(SUMMARY_HEADER + summary)
+        context = SEPARATOR.join(parts)
+        info.update(raw=len(chosen), summarized=len(overflow), dropped=dropped)
+
+    info["tokens"] = counter.count(context, cache=False)
+    counter.save()
+    return context, info
+# --- ここまでコンテキスト詰め込み ----------
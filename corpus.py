@@ -0,0 +1,89 @@
+import mmap
+import os
+import numpy as np
+
+INDEX_SUFFIX = ".lineidx.npz"  # 書き起こしtxtの隣に置く行オフセット索引の拡張子
+
+# --- 行オフセット索引 ----------
+def index_path(txtfile):
+    return os.path.splitext(txtfile)[0] + INDEX_SUFFIX
+
+def build_line_index(txtfile):
+    """
+    [l.strip() for l in f if l.strip()] と同じ行について、
+    strip後の本文が置かれているバイト範囲 [start, end) を返す（改行は \n / \r\n を想定）
+    """
+    offsets = []
+    pos = 0
+    with open(txtfile, "rb") as f:
+        for raw in f:
+            line = raw.decode("utf-8")
+            stripped = line.strip()
+            if stripped:
+                lead = len(line) - len(line.lstrip())
+                start = pos + len(line[:lead].encode("utf-8"))
+                offsets.append((start, start + len(stripped.encode("utf-8"))))
+            pos += len(raw)
+    return np.array(offsets, dtype=np.int64).reshape(-1, 2)
+
+def load_line_index(txtfile):
+    """
+    保存済みの索引を読む。txtのサイズ・更新時刻が変わっていれば作り直して保存する
+    """
+    st = os.stat(txtfile)
+    path = index_path(txtfile)
+    if os.path.exists(path):
+        with np.load(path) as z:
+            if int(z["size"]) == st.st_size and int(z["mtime_ns"]) == st.st_mtime_ns:
+                return z["offsets"]
+    offsets = build_line_index(txtfile)
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, offsets=offsets, size=st.st_size, mtime_ns=st.st_mtime_ns)
+    os.replace(tmp, path)
+    return offsets
+# --- ここまで行オフセット索引 ----------
+
+# --- 行ストア ----------
+class LineStore:
+    """
+    書き起こしtxtをメモリマップで開き、行オフセット索引から lines[start:end] を切り出す
+    ファイルごとの索引は最初のアクセスで一度だけ読み込む
+    """
+
+    def __init__(self):
+        self._files = {}  # txtfile -> (mmap or b"", offsets)
+
+    def _get(self, txtfile):
+        entry = self._files.get(txtfile)
+        if entry is None:
+            offsets = load_line_index(txtfile)
+            if os.path.getsize(txtfile) == 0:
+                buf = b""  # 空ファイルはmmapできない
+            else:
+                with open(txtfile, "rb") as f:
+                    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            entry = self._files[txtfile] = (buf, offsets)
+        return entry
+
+    def n_lines(self, txtfile):
+        return len(self._get(txtfile)[1])
+
+    def lines(self, txtfile, start=0, end=None):
+        """
+        空行を除いたstrip済みの行リストの lines[start:end] を返す
+        """
+        buf, offsets = self._get(txtfile)
+        return [buf[s:e].decode("utf-8") for s, e in offsets[start:end].tolist()]
+
+    def text(self, txtfile, start=0, end=None):
+        return "\n".join(self.lines(txtfile, start, end))
+
+    def refresh(self):
+        """
+        次のアクセスで索引を検証し直す（txt更新時に使う）
+        読み出し中の他スレッドがあっても壊れないよう、mmapは閉じずに参照を手放すだけにする
+        """
+        self._files = {}
+
+line_store = LineStore()  # スクリプト間で共有する既定のストア
+# --- ここまで行ストア ----------
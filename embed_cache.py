@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import numpy as np
+from openai_client import default_client
+from tracing import tracer
+
+CACHE_DIR = ".embed_cache"  # Embeddingキャッシュの保存先
+BATCH_SIZE = 500  # Embeddingリクエストのバッチ数
+
+# --- Embedding取得 ----------
+def embed_texts(texts, model, client=None, batch_size=BATCH_SIZE):
+    """
+    texts をバッチに分けて埋め込み、(len(texts), dim) の float32 行列で返す
+    """
+    client = client or default_client()
+    embs = []
+    for i in range(0, len(texts), batch_size):
+        resp = client.embeddings.create(model=model, input=texts[i:i+batch_size])
+        tracer.record_llm(model, resp.usage)
+        embs.extend(e.embedding for e in resp.data)
+    return np.asarray(embs, dtype=np.float32)
+# --- ここまでEmbedding取得 ----------
+
+# --- キー生成 ----------
+def chunk_key(model, text, group_size):
+    """
+    (モデル名, チャンク本文, GROUP_SIZE) から内容アドレスのキーを作る
+    """
+    h = hashlib.sha256()
+    h.update(f"{model}\0{group_size}\0".encode("utf-8"))
+    h.update(text.encode("utf-8"))
+    return h.hexdigest()
+# --- ここまでキー生成 ----------
+
+# --- Embeddingキャッシュ ----------
+def store_dir(model, group_size, cache_dir=CACHE_DIR):
+    """
+    (モデル, GROUP_SIZE) ごとに別のストアにする（用途の違うチャンク同士で上書きし合わないように）
+    """
+    return os.path.join(cache_dir, f"{model.replace('/', '_')}-{group_size}")
+
+class EmbeddingCache:
+    """
+    チャンクEmbeddingのディスクキャッシュ
+    keys.json（行順のキー一覧）と vectors.npy（float32行列）の組で保存し、
+    起動時は vectors.npy をメモリマップで開く。未登録のチャンクだけを埋め込む。
+    """
+
+    def __init__(self, model, group_size, cache_dir=CACHE_DIR):
+        self.model = model
+        self.group_size = group_size
+        self.dir = store_dir(model, group_size, cache_dir)
+        self.keys_path = os.path.join(self.dir, "keys.json")
+        self.vectors_path = os.path.join(self.dir, "vectors.npy")
+        self.keys = []
+        self.vectors = None
+        self._load()
+
+    def _load(self):
+        if not (os.path.exists(self.keys_path) and os.path.exists(self.vectors_path)):
+            return
+        with open(self.keys_path, encoding="utf-8") as f:
+            keys = json.load(f)
+        vectors = np.load(self.vectors_path, mmap_mode="r")
+        if vectors.ndim != 2 or len(keys) != vectors.shape[0]:
+            print("Embeddingキャッシュが壊れているため破棄します。")
+            return
+        self.keys = keys
+        self.vectors = vectors
+
+    def _save(self, keys, vectors):
+        os.makedirs(self.dir, exist_ok=True)
+        # 書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+        tmp_vec = self.vectors_path + ".tmp.npy"
+        np.save(tmp_vec, vectors)
+        os.replace(tmp_vec, self.vectors_path)
+        tmp_keys = self.keys_path + ".tmp"
+        with open(tmp_keys, "w", encoding="utf-8") as f:
+            json.dump(keys, f)
+        os.replace(tmp_keys, self.keys_path)
+
+    def get_or_embed(self, texts, embed_fn):
+        """
+        texts の Embedding を texts と同じ順で返す
+        キャッシュにないチャンクだけ embed_fn(list[str]) -> ndarray で埋め込み、
+        ストアを現在のコーパス順に書き直す（次回起動時はそのままメモリマップで使える）
+        """
+        keys = [chunk_key(self.model, t, self.group_size) for t in texts]
+        if not keys:
+            return np.empty((0, 0), dtype=np.float32)
+
+        # 変更なしのコーパスなら、メモリマップをそのまま返す
+        if self.vectors is not None and keys == self.keys:
+            print(f"Embeddingキャッシュ: {len(keys)}件すべてヒット")
+            return self.vectors
+
+        row_of = {k: i for i, k in enumerate(self.keys)}
+        missing = [i for i, k in enumerate(keys) if k not in row_of]
+        print(f"Embeddingキャッシュ: ヒット {len(keys) - len(missing)}件 / 新規 {len(missing)}件")
+
+        new_vecs = None
+        if missing:
+            # 同一テキストの重複チャンクは1回だけ埋め込む
+            uniq = list(dict.fromkeys(texts[i] for i in missing))
+            embs = np.asarray(embed_fn(uniq), dtype=np.float32)
+            by_text = {t: e for t, e in zip(uniq, embs)}
+            new_vecs = {keys[i]: by_text[texts[i]] for i in missing}
+
+        dim = (self.vectors.shape[1] if self.vectors is not None
+               else next(iter(new_vecs.values())).shape[0])
+        out = np.empty((len(keys), dim), dtype=np.float32)
+        hits = [i for i, k in enumerate(keys) if k in row_of]
+        if hits:
+            out[hits] = self.vectors[[row_of[keys[i]] for i in hits]]
+        for i in missing:
+            out[i] = new_vecs[keys[i]]
+
+        self.vectors = None  # 置き換え前にメモリマップを手放す（Windows対策）
+        self._save(keys, out)
+        self.keys = keys
+        self.vectors = np.load(self.vectors_path, mmap_mode="r")
+        return self.vectors
+# --- ここまでEmbeddingキャッシュ ----------
@@ -0,0 +1,36 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+import synth_corpus
+from neighbor_split import make_microchunks, make_microchunks_naive
+
+def timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description="make_microchunks（累積和）と旧実装の速度比較")
+    parser.add_argument("--lengths", default="250,500,1000,2000,4000", help="書き起こしの行数（カンマ区切り）")
+    parser.add_argument("--chunk-tokens", default="300,1000", help="チャンクのトークン数（カンマ区切り）")
+    parser.add_argument("--overlap-ratio", type=float, default=80 / 300, help="重なりのトークン数 / チャンクのトークン数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'行数':>6} {'chunk':>6} {'チャンク数':>8} {'旧実装':>10} {'新実装':>10} {'倍率':>7}")
+    for chunk_tokens in [int(c) for c in args.chunk_tokens.split(",")]:
+        params = {"chunk_tokens": chunk_tokens, "overlap_tokens": int(chunk_tokens * args.overlap_ratio)}
+        for n_lines in [int(n) for n in args.lengths.split(",")]:
+            lines, _blocks = synth_corpus.make_transcript(random.Random(args.seed), n_lines)
+            naive, t_naive = timed(make_microchunks_naive, lines, "bench", **params)
+            fast, t_fast = timed(make_microchunks, lines, "bench", **params)
+            if fast != naive:
+                raise SystemExit(f"チャンク境界が一致しません（行数 {n_lines}, chunk_tokens {chunk_tokens}）")
+            print(f"{len(lines):>6} {chunk_tokens:>6} {len(fast):>8} {t_naive * 1000:>8.1f}ms {t_fast * 1000:>8.1f}ms {t_naive / t_fast:>6.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,16 @@
-from sentence_transformers import SentenceTransformer, util
-from rank_bm25 import BM25Okapi
+import json
 import numpy as np
+import os
+import sys
 import tiktoken
-from typing import List, Dict, Tuple
+from bisect import bisect_right
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bm25_index import BM25Index
+from context_assembler import ChunkIndex, merge_intervals
+from corpus import line_store
+from vector_search import topk
 
 ENC = tiktoken.get_encoding("cl100k_base")  # ざっくりトークン見積もり
 
@@ -15,6 +23,22 @@ def smart_trim(text: str, max_tokens: int) -> str:
         return text
     return ENC.decode(toks[:max_tokens])
 
+def trim_lines(lines: List[str], max_tokens: int) -> Tuple[str, int]:
+    """
+    先頭から max_tokens に収まるところまで行単位で残す（1行目だけで超える場合はその行を切り詰める）
+    戻り値: (テキスト, 残した行数)
+    """
+    kept, used = [], 0
+    for line in lines:
+        n = len(ENC.encode(line)) + (1 if kept else 0)  # 改行の分
+        if used + n > max_tokens:
+            break
+        kept.append(line)
+        used += n
+    if not kept and lines:
+        return smart_trim(lines[0], max_tokens), 1
+    return "\n".join(kept), len(kept)
+
 # --- 1) チャンク化（行ごと） -----------
 def make_microchunks(
     lines: List[str],
@@ -27,6 +51,92 @@ def make_microchunks(
     行単位の会話を、約300トークンのマイクロチャンクに分割（80トークン重なり）。
     戻り値: [{doc_id, chunk_idx, text, start_line, end_line}]
     """
+    return list(iter_microchunks(lines, doc_id, chunk_tokens, overlap_tokens, min_tokens))
+
+def iter_microchunks(
+    lines: List[str],
+    doc_id: str,
+    chunk_tokens: int = 300,
+    overlap_tokens: int = 80,
+    min_tokens: int = 30
+) -> Iterator[Dict]:
+    """
+    make_microchunks_naive と同じ境界のチャンクを順に返す（各行のトークン化は1回だけ）。
+    前後に空白のない空でない行どうしを "\n" でつなぐと、トークナイザの前処理は各 "\n" の直後で必ず区切れるので
+        count_tokens("\n".join(lines[a:b+1])) = Σ_{a<=j<b} count_tokens(lines[j] + "\n") + count_tokens(lines[b])
+    が成り立つ。これを累積和で O(1) に求め、重なりの開始行は二分探索で求める。
+    この前提を満たさない行があれば旧実装に任せる
+    """
+    if any(not l or l != l.strip() for l in lines):
+        yield from make_microchunks_naive(lines, doc_id, chunk_tokens, overlap_tokens, min_tokens)
+        return
+
+    n = len(lines)
+    with_nl = [count_tokens(l + "\n") for l in lines]
+    alone = [count_tokens(l) for l in lines]
+    prefix = [0] * (n + 1)  # prefix[j] = Σ_{m<j} with_nl[m]
+    for j, t in enumerate(with_nl):
+        prefix[j + 1] = prefix[j] + t
+
+    def tokens(a, b):  # lines[a..b] を "\n" でつないだトークン数
+        return prefix[b] - prefix[a] + alone[b]
+
+    chunk_idx = 0
+    buf_start = None  # バッファ（lines[buf_start..i]）が空なら None
+    i = 0
+    while i < n:
+        if buf_start is None:
+            buf_start = i
+        if tokens(buf_start, i) >= chunk_tokens:
+            end_line = i
+            # 小さすぎる断片は少し先まで伸ばす
+            if tokens(buf_start, end_line) < min_tokens and i + 1 < n:
+                i += 1
+                end_line = i
+            yield {
+                "doc_id": doc_id,
+                "chunk_idx": chunk_idx,
+                "text": "\n".join(lines[buf_start:end_line + 1]),
+                "start_line": buf_start,
+                "end_line": end_line
+            }
+            chunk_idx += 1
+            # 末尾から overlap_tokens 以上になる最短の行範囲を次バッファの先頭に残す
+            # tokens(rev, end_line) >= overlap_tokens <=> prefix[rev] <= prefix[end_line] + alone[end_line] - overlap_tokens
+            target = prefix[end_line] + alone[end_line] - overlap_tokens
+            rev = bisect_right(prefix, target, buf_start, end_line + 1) - 1
+            buf_start = rev if rev >= buf_start else None
+        i += 1
+
+    # 残り
+    if buf_start is not None:
+        yield {
+            "doc_id": doc_id,
+            "chunk_idx": chunk_idx,
+            "text": "\n".join(lines[buf_start:]),
+            "start_line": buf_start,
+            "end_line": n - 1
+        }
+
+def iter_corpus_microchunks(paths: Iterable[str], **params) -> Iterator[Dict]:
+    """
+    複数の書き起こしtxtを順にチャンク化して流す（doc_id はファイル名から拡張子を除いたもの）
+    """
+    for path in paths:
+        doc_id = os.path.splitext(os.path.basename(path))[0]
+        yield from iter_microchunks(line_store.lines(path), doc_id, **params)
+
+def make_microchunks_naive(
+    lines: List[str],
+    doc_id: str,
+    chunk_tokens: int = 300,
+    overlap_tokens: int = 80,
+    min_tokens: int = 30
+) -> List[Dict]:
+    """
+    旧実装（1行足すごとにバッファ全体を再トークナイズする）。
+    make_microchunks の比較用と、前後に空白のある行・空行を含む入力のフォールバック用に残す
+    """
     chunks = []
     buf = []
     buf_start = 0
@@ -81,86 +191,193 @@ def make_microchunks(
     return chunks
 
 # --- 2) インデックス構築 ---------------
+INDEX_VERSION = 1  # 保存形式を変えたら上げる（古い保存物は読み込まずに作り直す）
+CHUNK_PARAMS = {"chunk_tokens": 300, "overlap_tokens": 80, "min_tokens": 30}  # make_microchunks の既定値
+
 class HybridIndex:
-    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
-        self.model = SentenceTransformer(model_name)
+    """
+    Dense（SentenceTransformer）と BM25 のハイブリッド検索
+    save() / load() で Dense行列（メモリマップ）・BM25の重み・チャンクを保存・再利用する。
+    埋め込みモデルは質問の埋め込みが必要になった時に初めて読み込むので、
+    保存済みの索引を読んで語彙だけで検索する（alpha=0）場合はモデルを読み込まない
+    """
+
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2", encode_fn=None):
+        self.model_name = model_name
+        self.encode_fn = encode_fn  # テキストのリスト -> 行列。省略時は SentenceTransformer（評価で埋め込みを揃える時に差し替える）
+        self._model = None
         self.chunks: List[Dict] = []
-        self.dense = None
+        self.chunk_params: Dict = dict(CHUNK_PARAMS)
+        self.dense = None  # 行ごとに正規化済みの float32 行列
         self.bm25 = None
+        self._chunk_index = None
+
+    @property
+    def chunk_index(self) -> ChunkIndex:
+        """
+        近傍拡張用の doc_id・chunk_idx 索引（最初に使う時に一度だけ作る）
+        """
+        if self._chunk_index is None:
+            self._chunk_index = ChunkIndex(self.chunks)
+        return self._chunk_index
 
-    def build(self, chunks: List[Dict]):
+    @property
+    def model(self):
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+            self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def encode(self, texts: List[str], show_progress_bar: bool = False) -> np.ndarray:
+        if self.encode_fn is not None:
+            return np.asarray(self.encode_fn(texts), dtype=np.float32)
+        return self.model.encode(
+            texts, batch_size=64, convert_to_numpy=True, show_progress_bar=show_progress_bar
+        ).astype(np.float32)
+
+    def build(self, chunks: List[Dict], chunk_params: Dict = None):
         self.chunks = chunks
+        self._chunk_index = None
+        if chunk_params is not None:
+            self.chunk_params = dict(chunk_params)
         corpus = [c["text"] for c in chunks]
         # Dense
-        self.dense = self.model.encode(
-            corpus, batch_size=64, convert_to_numpy=True, show_progress_bar=True
-        )
-        # BM25（超簡易トークナイズ）
-        tokenized = [c["text"].split() for c in chunks]
-        self.bm25 = BM25Okapi(tokenized)
+        dense = self.encode(corpus, show_progress_bar=True)
+        self.dense = dense / np.maximum(np.linalg.norm(dense, axis=1, keepdims=True), 1e-12)
+        # BM25（文字bigramの疎行列）
+        self.bm25 = BM25Index(corpus)
+
+    # --- 保存・読み込み ----------
+    def meta(self) -> Dict:
+        return {
+            "version": INDEX_VERSION,
+            "model_name": self.model_name,
+            "chunk_params": self.chunk_params,
+            "n_chunks": len(self.chunks),
+        }
+
+    def save(self, path: str):
+        """
+        path ディレクトリに dense.npy / BM25 / chunks.json を書き、最後に meta.json を書く
+        （meta.json がなければ書きかけとみなして load() しない）
+        """
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        tmp = os.path.join(path, "dense.tmp.npy")
+        np.save(tmp, np.asarray(self.dense, dtype=np.float32))
+        os.replace(tmp, os.path.join(path, "dense.npy"))
+        self.bm25.save(path)
+        tmp = os.path.join(path, "chunks.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.chunks, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(path, "chunks.json"))
+        tmp = meta_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.meta(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp, meta_path)
+
+    @classmethod
+    def load(cls, path: str, model_name: str = "all-MiniLM-L6-v2", chunk_params: Dict = None):
+        """
+        save() した索引を読む。形式・モデル名・チャンク化の設定が違えば None（作り直しが必要）
+        Dense行列とBM25の重みはメモリマップで開くので、コーパスが大きくてもすぐに読み終わる
+        """
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls(model_name)
+        if chunk_params is not None:
+            index.chunk_params = dict(chunk_params)
+        expected = index.meta()
+        for key in ("version", "model_name", "chunk_params"):
+            if meta.get(key) != expected[key]:
+                print(f"{path} は {key} が異なるため使えません（保存: {meta.get(key)} / 現在: {expected[key]}）")
+                return None
+        with open(os.path.join(path, "chunks.json"), encoding="utf-8") as f:
+            index.chunks = json.load(f)
+        index.dense = np.load(os.path.join(path, "dense.npy"), mmap_mode="r")
+        index.bm25 = BM25Index.load(path)
+        if not (len(index.chunks) == index.dense.shape[0] == len(index.bm25) == meta["n_chunks"]):
+            print(f"{path} の索引が壊れているため使えません")
+            return None
+        return index
+    # --- ここまで保存・読み込み ----------
 
     def hybrid_search(self, query: str, top_k: int = 30, alpha: float = 0.6) -> List[Tuple[Dict, float]]:
-        # BM25
-        bm25_scores = self.bm25.get_scores(query.split())
-        # Dense
-        qv = self.model.encode([query], convert_to_numpy=True)[0]
-        dense_scores = util.cos_sim(qv, self.dense).cpu().numpy().ravel()
-        # 0-1正規化
-        b = (bm25_scores - bm25_scores.min()) / (bm25_scores.ptp() + 1e-9)
-        d = (dense_scores - dense_scores.min()) / (dense_scores.ptp() + 1e-9)
-        score = alpha * d + (1 - alpha) * b
-        idx = np.argsort(score)[::-1][:top_k]
+        """
+        alpha * Dense + (1 - alpha) * BM25（それぞれ0-1正規化）の上位 top_k 件
+        alpha=0 なら語彙だけで検索し、埋め込みモデルを使わない
+        """
+        # BM25（全チャンクを疎行列・ベクトル積1回で採点）
+        bm25_scores = self.bm25.scores(query)
+        b = (bm25_scores - bm25_scores.min()) / (np.ptp(bm25_scores) + 1e-9)
+        if alpha == 0:
+            score = b
+        else:
+            # Dense（正規化済み行列との内積 = コサイン類似度）
+            qv = self.encode([query])[0]
+            dense_scores = self.dense @ (qv / max(np.linalg.norm(qv), 1e-12))
+            # 0-1正規化
+            d = (dense_scores - dense_scores.min()) / (np.ptp(dense_scores) + 1e-9)
+            score = alpha * d + (1 - alpha) * b
+        idx = topk(score[None, :], top_k)[0][0]
         return [(self.chunks[i], float(score[i])) for i in idx]
 
 # --- 3) 近傍拡張 ----------
 def stitch_neighbors(
     hits: List[Tuple[Dict, float]],
-    all_chunks: List[Dict],
+    all_chunks,
     window: int = 1,
-    max_tokens_per_stitch: int = 1000
+    max_tokens_per_stitch: int = 1000,
+    max_total_tokens: int = None
 ) -> List[Dict]:
     """
     ヒットしたチャンクの前後windowチャンクを連結して“塊”を作る。
-    同一doc_idでchunk_idxが近いものをまとめる。
+    all_chunks は ChunkIndex（HybridIndex.chunk_index など作り置きのもの）かチャンクのリスト。
+    同一doc_idで行範囲が重なる・隣接する窓は1つの塊にまとめるので、重なりのあるチャンクの行が二重に入らない。
+    塊はスコア（含まれるヒットの最大値）順。max_total_tokens を指定すると、合計がそれを超える塊は捨てる
+    max_tokens_per_stitch は窓1つあたりの上限で、まとめた塊には窓の数倍まで入れる（行単位で切り、end_line は残した最終行）
     """
-    # 索引: doc_id -> idx -> chunk
-    by_doc = {}
-    for c in all_chunks:
-        by_doc.setdefault(c["doc_id"], {})[c["chunk_idx"]] = c
-
-    stitched = []
-    seen = set()
-
-    for chunk, _score in hits:
-        doc = chunk["doc_id"]
-        idx = chunk["chunk_idx"]
-        key = (doc, idx)
-        if key in seen:
-            continue
-        # 窓を確定
-        start = idx - window
-        end = idx + window
-        parts = []
-        for k in range(start, end + 1):
-            if k in by_doc.get(doc, {}):
-                parts.append(by_doc[doc][k])
+    index = all_chunks if isinstance(all_chunks, ChunkIndex) else ChunkIndex(all_chunks)
 
+    # 窓を行区間にする: (doc_id, 開始行, 終了行+1, スコア)
+    windows = []
+    for chunk, score in hits:
+        parts = index.neighbors(chunk["doc_id"], chunk["chunk_idx"], window)
         if not parts:
             continue
+        windows.append((chunk["doc_id"], parts[0]["start_line"], parts[-1]["end_line"] + 1, score,
+                        parts[0]["chunk_idx"], parts[-1]["chunk_idx"]))
 
-        parts = sorted(parts, key=lambda x: x["chunk_idx"])
-        text = "\n".join([p["text"] for p in parts])
-        text = smart_trim(text, max_tokens=max_tokens_per_stitch)
-
+    stitched = []
+    used = 0
+    for doc, start, end, score in merge_intervals([w[:4] for w in windows]):
+        members = [w for w in windows if w[0] == doc and start <= w[1] < end]
+        text, n_kept = trim_lines(index.doc_lines[doc][start:end], max_tokens_per_stitch * len(members))
+        last = start + n_kept - 1
+        start_chunk = min(w[4] for w in members)
+        end_chunk = max(
+            (k for k in range(start_chunk, max(w[5] for w in members) + 1)
+             if k in index.by_doc[doc] and index.by_doc[doc][k]["start_line"] <= last),
+            default=start_chunk,
+        )
+        if max_total_tokens is not None:
+            n = count_tokens(text)
+            if stitched and used + n > max_total_tokens:
+                continue
+            used += n
         stitched.append({
             "doc_id": doc,
-            "start_chunk": parts[0]["chunk_idx"],
-            "end_chunk": parts[-1]["chunk_idx"],
-            "start_line": parts[0]["start_line"],
-            "end_line": parts[-1]["end_line"],
-            "text": text
+            "start_chunk": start_chunk,
+            "end_chunk": end_chunk,
+            "start_line": start,
+            "end_line": last,
+            "text": text,
+            "score": score
         })
-        for p in parts:
-            seen.add((doc, p["chunk_idx"]))
 
     return stitched
@@ -0,0 +1,110 @@
+import hashlib
+import random
+import threading
+import time
+from types import SimpleNamespace
+import numpy as np
+
+# --- ローカル用の偽OpenAIクライアント ----------
+class FakeAPIError(Exception):
+    """
+    openai の APIStatusError 相当（status_code を持つ）
+    """
+
+    def __init__(self, status_code, message="fake api error"):
+        super().__init__(f"{status_code}: {message}")
+        self.status_code = status_code
+
+def fake_embedding(text, dim=64):
+    """
+    テキストのハッシュから決まる正規化済みベクトル（同じ入力なら常に同じ値）
+    """
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    v = np.random.default_rng(seed).standard_normal(dim)
+    return v / np.linalg.norm(v)
+
+class _ChatCompletions:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, model, messages, stream=False, **kwargs):
+        self.client._call("chat")
+        content = self.client.chat_fn(messages)
+        prompt_tokens = sum(len(m["content"]) for m in messages)
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=len(content),
+            total_tokens=prompt_tokens + len(content),
+        )
+        if stream:
+            include_usage = (kwargs.get("stream_options") or {}).get("include_usage")
+            return self._stream(model, content, usage if include_usage else None)
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=content))],
+            usage=usage,
+        )
+
+    def _stream(self, model, content, usage=None):
+        step = self.client.stream_chunk
+        for i in range(0, len(content), step):
+            if self.client.stream_latency:
+                time.sleep(self.client.stream_latency)
+            delta = SimpleNamespace(role="assistant", content=content[i:i + step])
+            yield SimpleNamespace(model=model, choices=[SimpleNamespace(index=0, delta=delta)], usage=None)
+        if usage is not None:
+            # stream_options={"include_usage": True} のときは最後に choices が空で usage だけのチャンクが来る
+            yield SimpleNamespace(model=model, choices=[], usage=usage)
+
+class _Embeddings:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, model, input, **kwargs):
+        self.client._call("embeddings")
+        texts = [input] if isinstance(input, str) else list(input)
+        n_tokens = sum(len(t) for t in texts)
+        return SimpleNamespace(
+            model=model,
+            data=[SimpleNamespace(index=i, embedding=fake_embedding(t, self.client.embed_dim).tolist())
+                  for i, t in enumerate(texts)],
+            usage=SimpleNamespace(prompt_tokens=n_tokens, total_tokens=n_tokens),
+        )
+
+class FakeOpenAI:
+    """
+    openai モジュールの代わりに渡せるローカルクライアント（chat.completions / embeddings）
+    - chat_fn   : messages -> 応答テキスト
+    - latency   : 1呼び出しあたりの待ち秒数
+    - error_rate: この確率で error_status の FakeAPIError を送出（429 や 503 の再現用）
+    - stream_chunk / stream_latency: stream=True のとき何文字ずつ、何秒おきに返すか
+    呼び出し回数とエラー回数は calls / errors に記録する
+    """
+
+    def __init__(self, chat_fn=None, latency=0.0, error_rate=0.0, error_status=429,
+                 embed_dim=64, seed=0, stream_chunk=4, stream_latency=0.0):
+        self.chat_fn = chat_fn or (lambda messages: "（fake応答）")
+        self.latency = latency
+        self.stream_chunk = stream_chunk
+        self.stream_latency = stream_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.embed_dim = embed_dim
+        self.calls = {"chat": 0, "embeddings": 0}
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=_ChatCompletions(self))
+        self.embeddings = _Embeddings(self)
+
+    def _call(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise FakeAPIError(self.error_status)
+# --- ここまでローカル用の偽OpenAIクライアント ----------
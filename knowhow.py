@@ -0,0 +1,134 @@
+import argparse
+import os
+import sys
+
+# 重いモジュール（openai・numpy・各スクリプト）はサブコマンドの中で import する
+# （`python knowhow.py --help` はすぐ返る）
+
+def make_client(args):
+    if args.fake:
+        from fake_openai import FakeOpenAI
+        return FakeOpenAI(latency=0.2)
+    from openai_client import default_client
+    return default_client()
+
+# --- サブコマンド ----------
+def cmd_tag(args):
+    import add_tag
+    if args.check:
+        add_tag.check_all()
+        return
+    client = make_client(args)
+    if args.all:
+        add_tag.add_tag_all(concurrency=args.concurrency, client=client, force=args.force)
+    else:
+        add_tag.main(client)
+
+def cmd_ask_tag(args):
+    import tag2knowhow
+    client = make_client(args)
+    stream = tag2knowhow.STREAM and not args.no_stream
+    if args.question:
+        tag2knowhow.ask(args.question, stream, client)
+    else:
+        tag2knowhow.main(stream, client)
+
+def cmd_ask_rag(args):
+    import RAG2knowhow
+    client = make_client(args)
+    stream = RAG2knowhow.STREAM and not args.no_stream
+    if args.question:
+        RAG2knowhow.ask(RAG2knowhow.RAGCorpus(client), args.question, stream)
+    else:
+        RAG2knowhow.main(stream, client)
+
+def cmd_batch(args):
+    import batch_answer
+    argv = [args.input, "--output", args.output, "--route", args.route, "--concurrency", str(args.concurrency)]
+    batch_answer.main(argv, make_client(args))
+
+def cmd_tokens(args):
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "tools"))
+    import tokenChecker
+    argv = ["--model", args.model, "--top", str(args.top)]
+    if args.section:
+        argv.append("--section")
+    if args.limit is not None:
+        argv += ["--limit", str(args.limit)]
+    if args.workers is not None:
+        argv += ["--workers", str(args.workers)]
+    tokenChecker.main(argv)
+
+def cmd_index(args):
+    """
+    行オフセット索引・RAGのEmbeddingキャッシュ・工程分類器（・工程ダイジェスト）を作っておく
+    """
+    import glob
+    from corpus import line_store
+    client = make_client(args)
+    for fname in sorted(glob.glob("2024-10-*.txt")):
+        line_store.n_lines(fname)
+    print("行オフセット索引を更新しました")
+    if "rag" in args.targets:
+        import RAG2knowhow
+        RAG2knowhow.RAGCorpus(client)
+    if "tag" in args.targets:
+        import tag2knowhow
+        tag2knowhow.reload(client)
+        print("工程分類器を更新しました")
+    if "digest" in args.targets:
+        import phase_digest
+        from tag2knowhow import load_phase_tags
+        phase_digest.build_all(load_phase_tags(), client=client, force=args.force)
+# --- ここまでサブコマンド ----------
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="knowhow", description="作業会話ノウハウ抽出エージェント")
+    parser.add_argument("--fake", action="store_true", help="OpenAIの代わりにローカルの偽クライアントを使う")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("tag", help="書き起こしに工程タグを付ける（add_tag.py）")
+    p.add_argument("--all", action="store_true", help="ベースファイルの対話的なタグ分けを飛ばし、残りのファイルだけ並列にタグ分けする")
+    p.add_argument("--force", action="store_true", help="変更のないファイルもタグ分けし直す")
+    p.add_argument("--check", action="store_true", help="LLMを呼ばずに、保存済みのタグ分け結果の範囲・隙間・重なり・タグ・工程数を検証する")
+    p.add_argument("--concurrency", type=int, default=4)
+    p.set_defaults(func=cmd_tag)
+
+    for name, func, help_text in (
+        ("ask-tag", cmd_ask_tag, "工程タグ経由で回答する（tag2knowhow.py）"),
+        ("ask-rag", cmd_ask_rag, "RAGで回答する（RAG2knowhow.py）"),
+    ):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("question", nargs="?", help="省略すると対話モード")
+        p.add_argument("--no-stream", action="store_true", help="回答を生成し終えてからまとめて表示する")
+        p.set_defaults(func=func)
+
+    p = sub.add_parser("batch", help="JSONLの質問にまとめて回答し、JSONLで書き出す（batch_answer.py）")
+    p.add_argument("input", help="1行1件の質問（{\"id\": ..., \"question\": ...}）")
+    p.add_argument("-o", "--output", default="batch_answers.jsonl")
+    p.add_argument("--route", choices=("tag", "rag"), default="tag")
+    p.add_argument("--concurrency", type=int, default=8, help="回答生成の同時実行数")
+    p.set_defaults(func=cmd_batch)
+
+    p = sub.add_parser("tokens", help="工程ブロックのトークン数を調べる（tools/tokenChecker.py）")
+    p.add_argument("--model", default="text-embedding-3-large", help="トークナイザとコンテキスト長の基準にするモデル")
+    p.add_argument("--limit", type=int, default=None, help="コンテキスト長の上限（省略時はモデルの上限）")
+    p.add_argument("--workers", type=int, default=None, help="トークン数を数えるプロセス数（既定: CPU数）")
+    p.add_argument("--top", type=int, default=10)
+    p.add_argument("--section", action="store_true", help="回答時と同じ「【元ファイル】」見出し付きの文字列を数える")
+    p.set_defaults(func=cmd_tokens)
+
+    p = sub.add_parser("index", help="索引・Embeddingキャッシュ・工程分類器を事前に作る")
+    p.add_argument("--targets", default="rag,tag", help="rag / tag / digest をカンマ区切りで")
+    p.add_argument("--force", action="store_true", help="digest: 変更がなくても作り直す")
+    p.set_defaults(func=cmd_index)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    from tracing import serve_metrics_from_env
+    serve_metrics_from_env()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tracing import tracer
+
+RETRY_STATUS = {429, 500, 502, 503, 504}  # バックオフして再送するHTTPステータス
+RETRY_ERRORS = {"RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError"}
+
+# --- トークンバケット ----------
+class TokenBucket:
+    """
+    1分あたり rate_per_min だけ補充されるトークンバケット（上限は1分ぶん）
+    """
+
+    def __init__(self, rate_per_min):
+        self.capacity = float(rate_per_min)
+        self.rate = rate_per_min / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        amount = min(float(amount), self.capacity)  # 上限を超える要求は満杯になるまで待つ
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+class RateLimiter:
+    """
+    requests-per-minute と tokens-per-minute の両方を守るリミッタ（None は無制限）
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+    def acquire(self, n_tokens=0):
+        if self.requests:
+            self.requests.acquire(1)
+        if self.tokens and n_tokens:
+            self.tokens.acquire(n_tokens)
+# --- ここまでトークンバケット ----------
+
+# --- 指数バックオフ ----------
+def is_retryable(e):
+    """
+    429 / 5xx / 接続エラーなら再送してよい
+    """
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return status in RETRY_STATUS or type(e).__name__ in RETRY_ERRORS
+
+def _retry_after(e):
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def call_with_backoff(fn, max_retries=6, base_delay=1.0, max_delay=60.0, on_retry=None):
+    """
+    fn() を実行し、再送可能なエラーなら指数バックオフ（ジッタ付き）で再試行する
+    サーバが retry-after を返した場合はそれを優先する
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            tracer.record_retry()
+            if on_retry:
+                on_retry(attempt + 1, e, delay)
+            time.sleep(delay)
+# --- ここまで指数バックオフ ----------
+
+# --- 並列実行 ----------
+def run_concurrent(items, fn, concurrency=4, label=str):
+    """
+    items の各要素に fn を最大 concurrency 並列で適用し、{item: 結果} を返す
+    1件終わるごとに進捗を表示する。例外は結果として格納し、他の要素は続行する
+    各スレッドは呼び出し元のコンテキストで動かす（トレースのスパンが親子でつながるように）
+    """
+    results = {}
+    total = len(items)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        started = time.perf_counter()
+        futures = {pool.submit(contextvars.copy_context().run, fn, item): item for item in items}
+        for done, fut in enumerate(as_completed(futures), 1):
+            item = futures[fut]
+            try:
+                results[item] = fut.result()
+                status = "完了"
+            except Exception as e:
+                results[item] = e
+                status = f"失敗 ({type(e).__name__}: {e})"
+            print(f"[{done}/{total}] {label(item)} {status}  経過 {time.perf_counter() - started:.1f}秒")
+    return results
+# --- ここまで並列実行 ----------
@@ -0,0 +1,19 @@
+import unicodedata
+
+NGRAM = 2  # 文字n-gramの長さ（日本語は分かち書きしないので、文字bigramを語の代わりにする）
+
+# --- トークナイズ ----------
+def char_ngrams(text, n=NGRAM):
+    """
+    NFKC正規化・小文字化したテキストを空白で区切り、各区間の文字n-gramを返す
+    n文字未満の区間はそのまま1語にする
+    （bm25_index.py の語彙と context_packer.py の関連度で共有する）
+    """
+    grams = []
+    for run in unicodedata.normalize("NFKC", text).lower().split():
+        if len(run) < n:
+            grams.append(run)
+        else:
+            grams.extend(run[i:i + n] for i in range(len(run) - n + 1))
+    return grams
+# --- ここまでトークナイズ ----------
@@ -0,0 +1,19 @@
+import os
+
+_configured = False
+
+# --- OpenAIクライアント ----------
+def default_client():
+    """
+    .env の API_KEY を設定した openai モジュールを返す
+    openai・dotenv の import と設定は最初に呼ばれた時に一度だけ行う（import しただけでは何もしない）
+    """
+    global _configured
+    import openai
+    if not _configured:
+        from dotenv import load_dotenv
+        load_dotenv()
+        openai.api_key = os.getenv("API_KEY")
+        _configured = True
+    return openai
+# --- ここまでOpenAIクライアント ----------
@@ -0,0 +1,136 @@
+import numpy as np
+from corpus import line_store
+from embed_cache import EmbeddingCache, embed_texts
+from openai_client import default_client
+from tag_index import tag_index
+
+EMBED_MODEL = "text-embedding-3-large"
+PIECE_LINES = 20       # ブロックを何行ずつに区切って埋め込むか（Embeddingのトークン上限対策）
+MARGIN_THRESHOLD = 0.02 # 1位と2位の類似度の差がこれ未満ならLLMに任せる
+
+# --- ローカル工程分類器 ----------
+class PhaseClassifier:
+    """
+    タグ付け済みブロックのEmbeddingからタグごとのセントロイドを作り、質問を最も近いタグに分類する
+    1位と2位の差（マージン）が threshold 未満のときだけ LLM（tag_estimate）にフォールバックする
+    """
+
+    def __init__(self, tags, centroids, threshold=MARGIN_THRESHOLD, client=None):
+        self.tags = list(tags)
+        self.centroids = centroids
+        self.threshold = threshold
+        self.client = client or default_client()
+        self.n_queries = 0
+        self.n_fallback = 0
+
+    @classmethod
+    def build(cls, tags=None, threshold=MARGIN_THRESHOLD, client=None):
+        """
+        全 phase_blocks_*.json のブロックを PIECE_LINES 行ずつ埋め込み（Embeddingキャッシュ経由）、
+        タグごとに正規化ベクトルの平均をとる
+        """
+        tags = tags or tag_index.tags()
+        pieces, piece_tags = [], []
+        for tag in tags:
+            for src, s, e in tag_index.lookup(tag):
+                lines = line_store.lines(src + ".txt", s, e + 1)
+                for i in range(0, len(lines), PIECE_LINES):
+                    pieces.append("\n".join(lines[i:i + PIECE_LINES]))
+                    piece_tags.append(tag)
+        if not pieces:
+            raise ValueError("タグ付け済みのブロックが見つかりません。先に add_tag.py を実行してください。")
+
+        cache = EmbeddingCache(EMBED_MODEL, f"piece{PIECE_LINES}")
+        embs = np.asarray(cache.get_or_embed(pieces, lambda t: embed_texts(t, EMBED_MODEL, client)))
+        embs = embs / np.maximum(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12)
+
+        piece_tags = np.array(piece_tags)
+        known = [t for t in tags if (piece_tags == t).any()]
+        centroids = np.stack([embs[piece_tags == t].mean(axis=0) for t in known])
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+        return cls(known, centroids, threshold=threshold, client=client)
+
+    def embed(self, questions):
+        return embed_texts(list(questions), EMBED_MODEL, self.client)
+
+    def scores(self, q_embs):
+        q = np.atleast_2d(np.asarray(q_embs, dtype=np.float32))
+        q = q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+        return q @ self.centroids.T
+
+    def classify(self, q_emb):
+        """
+        LLMを使わない分類。戻り値: (タグ, 1位と2位のマージン)
+        """
+        return self.classify_batch(q_emb)[0]
+
+    def classify_batch(self, q_embs):
+        """
+        複数の質問をまとめて分類する（セントロイドとの行列積1回）。戻り値: [(タグ, マージン), ...]
+        """
+        sc = self.scores(q_embs)
+        if sc.shape[1] < 2:
+            return [(self.tags[0], float("inf")) for _ in range(sc.shape[0])]
+        top2 = np.argsort(-sc, axis=1)[:, :2]
+        rows = np.arange(sc.shape[0])
+        margins = sc[rows, top2[:, 0]] - sc[rows, top2[:, 1]]
+        return [(self.tags[i], float(m)) for i, m in zip(top2[:, 0], margins)]
+
+    def estimate(self, question, llm_fn, q_emb=None):
+        """
+        ローカル分類し、自信がなければ llm_fn(question) の結果を使う
+        戻り値: (タグ, "local" / "llm")
+        """
+        if q_emb is None:
+            q_emb = self.embed([question])[0]
+        tag, margin = self.classify(q_emb)
+        self.n_queries += 1
+        if margin >= self.threshold:
+            return tag, "local"
+        self.n_fallback += 1
+        return llm_fn(question), "llm"
+
+    @property
+    def fallback_rate(self):
+        return self.n_fallback / self.n_queries if self.n_queries else 0.0
+
+    def evaluate(self, questions, llm_fn, thresholds=(0.0, 0.01, 0.02, 0.03, 0.05, 0.08)):
+        """
+        ホールドアウトの質問集合で、LLMの推定を正解としたときの一致率とフォールバック率を測る
+        各しきい値について (フォールバック率, 最終的なLLMとの一致率) を返す
+        """
+        q_embs = self.embed(questions)
+        llm_tags = [llm_fn(q) for q in questions]
+        local = [self.classify(e) for e in q_embs]
+        report = {
+            "n_questions": len(questions),
+            "local_agreement": float(np.mean([t == l for (t, _), l in zip(local, llm_tags)])),
+            "thresholds": {},
+        }
+        for th in thresholds:
+            fallback = [m < th for _, m in local]
+            agree = [f or t == l for (t, _), f, l in zip(local, fallback, llm_tags)]
+            report["thresholds"][th] = {
+                "fallback_rate": float(np.mean(fallback)),
+                "agreement": float(np.mean(agree)),
+            }
+        return report
+# --- ここまでローカル工程分類器 ----------
+
+# --- 評価 ----------
+def main():
+    import argparse
+    import json
+    from tag2knowhow import load_phase_tags, tag_estimate
+
+    parser = argparse.ArgumentParser(description="ローカル工程分類器のLLMとの一致率・フォールバック率を測る")
+    parser.add_argument("questions", help="質問を1行1件で書いたテキストファイル")
+    args = parser.parse_args()
+
+    with open(args.questions, encoding="utf-8") as f:
+        questions = [l.strip() for l in f if l.strip()]
+    clf = PhaseClassifier.build(load_phase_tags())
+    print(json.dumps(clf.evaluate(questions, tag_estimate), ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+from add_tag import RPM_LIMIT, TPM_LIMIT
+from context_packer import lexical_relevance, pack_context, split_by_tokens
+from corpus import line_store
+from llm_pool import RateLimiter, call_with_backoff, run_concurrent
+from openai_client import default_client
+from tag_index import tag_index
+from tracing import tracer
+
+DIGEST_MODEL = "gpt-4.1"
+DIGEST_PATH = "phase_digests.json"  # 工程ごとのノウハウダイジェストの保存先
+DIGEST_INPUT_BUDGET = 60000         # ダイジェスト作成時に1工程から読む最大トークン数
+DIGEST_VERSION = 1                  # プロンプトや形式を変えたら上げる（全工程を作り直す）
+CONCURRENCY = 4
+EXCERPT_TOKENS = 1500               # 回答時に添える原文抜粋1件あたりの最大トークン数
+
+# --- 工程ごとの入力 ----------
+def tag_ranges(tag):
+    return [list(r) for r in tag_index.lookup(tag)]
+
+def tag_sections(tag):
+    """
+    工程の全ブロックを、行番号付きの「【元ファイル 行s-e】」セクションにする
+    """
+    sections = []
+    for src, s, e in tag_index.lookup(tag):
+        lines = line_store.lines(src + ".txt", s, e + 1)
+        body = "\n".join(f"{s + i}: {l}" for i, l in enumerate(lines))
+        sections.append(f"【{src} 行{s}-{e}】\n{body}")
+    return sections
+
+def tag_fingerprint(tag, sections):
+    h = hashlib.sha256(f"{DIGEST_VERSION}\0{DIGEST_MODEL}\0{tag}\0".encode("utf-8"))
+    for s in sections:
+        h.update(s.encode("utf-8"))
+    return h.hexdigest()
+# --- ここまで工程ごとの入力 ----------
+
+# --- ダイジェスト作成 ----------
+def build_digest(tag, sections, client=None, limiter=None):
+    """
+    1工程の全ペア分の会話から、共通手順・つまずき・引用（出典付き）をJSONで作る
+    """
+    client = client or default_client()
+    context, _info = pack_context(f"{tag}の工程の進め方と注意点", sections, DIGEST_INPUT_BUDGET, client=client)
+    prompt = f"""
+以下は複数ペアが同じ工程（タグ: {tag}）を実践した際の作業会話です（行頭の数字は元ファイルの行番号）。
+ペアを横断して、この工程のノウハウを次のJSON形式でまとめてください。
+
+{{
+  "summary": "工程の概要（2〜3文）",
+  "common_steps": ["多くのペアに共通する手順", ...],
+  "pitfalls": ["陥りやすいポイント・トラブルとその対処", ...],
+  "tips": ["明示的・非明示的なコツ", ...],
+  "quotes": [{{"text": "根拠になる発話", "source_file": "元ファイル名", "start_line": 0, "end_line": 0}}, ...]
+}}
+
+【作業会話】
+{context}
+"""
+
+    def request():
+        if limiter:
+            limiter.acquire(len(prompt))
+        return client.chat.completions.create(
+            model=DIGEST_MODEL,
+            messages=[
+                {"role": "system", "content": "あなたはデジタル工房機器作業のノウハウを整理するアナリストです。"},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={"type": "json_object"},
+        )
+
+    resp = call_with_backoff(request)
+    tracer.record_llm(DIGEST_MODEL, resp.usage)
+    digest = json.loads(resp.choices[0].message.content)
+
+    # 実在するブロック範囲を指していない引用は捨てる
+    ranges = tag_index.lookup(tag)
+    digest["quotes"] = [
+        q for q in digest.get("quotes", [])
+        if any(q.get("source_file") == src and s <= q.get("start_line", -1) <= q.get("end_line", -1) <= e
+               for src, s, e in ranges)
+    ]
+    return digest
+
+def load_digests(path=DIGEST_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def build_all(tags, client=None, concurrency=CONCURRENCY, force=False, path=DIGEST_PATH, rpm=RPM_LIMIT, tpm=TPM_LIMIT):
+    """
+    ブロックが変わった工程だけダイジェストを作り直して保存する
+    リクエスト数・トークン数の上限は add_tag.py と同じもの（Noneで無制限）
+    """
+    digests = {t: d for t, d in load_digests(path).items() if t in tags}
+    sections = {t: tag_sections(t) for t in tags}
+    fingerprints = {t: tag_fingerprint(t, sections[t]) for t in tags}
+    todo = [
+        t for t in tags
+        if sections[t] and (force or digests.get(t, {}).get("fingerprint") != fingerprints[t])
+    ]
+    print(f"ダイジェスト作成: {len(todo)}工程（変更なし {len(tags) - len(todo)}工程）")
+
+    limiter = RateLimiter(rpm=rpm, tpm=tpm)
+    results = run_concurrent(
+        todo, lambda t: build_digest(t, sections[t], client=client, limiter=limiter),
+        concurrency=concurrency,
+    )
+    for tag, result in results.items():
+        if isinstance(result, Exception):
+            continue
+        digests[tag] = {"fingerprint": fingerprints[tag], "ranges": tag_ranges(tag), "digest": result}
+
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(digests, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+    return digests
+# --- ここまでダイジェスト作成 ----------
+
+# --- 回答用の整形 ----------
+_loaded = {"mtime": None, "digests": {}}
+
+def current_digest(tag, path=DIGEST_PATH):
+    """
+    タグのダイジェストを返す。ダイジェスト作成後にブロック範囲か本文が変わっていれば None
+    （範囲が同じでも書き起こしが編集されていれば、作成時の指紋と一致しない）
+    """
+    if not os.path.exists(path):
+        return None
+    mtime = os.stat(path).st_mtime_ns
+    if _loaded["mtime"] != mtime:
+        _loaded.update(mtime=mtime, digests=load_digests(path))
+    entry = _loaded["digests"].get(tag)
+    if entry is None or [tuple(r) for r in entry["ranges"]] != list(tag_index.lookup(tag)):
+        return None
+    if entry["fingerprint"] != tag_fingerprint(tag, tag_sections(tag)):
+        return None
+    return entry["digest"]
+
+def digest_context(question, digest, sections, n_excerpts, counter):
+    """
+    ダイジェスト本文に、質問との関連度が高い原文抜粋を n_excerpts 件だけ添える
+    """
+    context = format_digest(digest)
+    ranked = sorted(sections, key=lambda s: -lexical_relevance(question, s))[:n_excerpts]
+    excerpts = [split_by_tokens(s, EXCERPT_TOKENS, counter)[0] for s in ranked]
+    if excerpts:
+        context += "\n\n【原文抜粋】\n" + "\n\n---\n\n".join(excerpts)
+    return context
+
+def format_digest(digest):
+    """
+    ダイジェストをプロンプトに入れるテキストにする
+    """
+    parts = [f"【概要】\n{digest.get('summary', '')}"]
+    for key, title in (("common_steps", "共通する手順"), ("pitfalls", "陥りやすいポイント"), ("tips", "コツ")):
+        items = digest.get(key) or []
+        if items:
+            parts.append(f"【{title}】\n" + "\n".join(f"・{x}" for x in items))
+    quotes = digest.get("quotes") or []
+    if quotes:
+        parts.append("【引用】\n" + "\n".join(
+            f"・「{q['text']}」（{q['source_file']} 行{q['start_line']}-{q['end_line']}）" for q in quotes
+        ))
+    return "\n\n".join(parts)
+# --- ここまで回答用の整形 ----------
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="phase_tags.txt の工程ごとにノウハウダイジェストを作る")
+    parser.add_argument("--force", action="store_true", help="変更がなくても全工程を作り直す")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    args = parser.parse_args()
+
+    with open("phase_tags.txt", encoding="utf-8") as f:
+        tags = [l.strip() for l in f if l.strip()]
+    build_all(tags, concurrency=args.concurrency, force=args.force)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import json
+import time
+import RAG2knowhow
+import tag2knowhow
+from corpus import line_store
+from tracing import serve_metrics_from_env, tracer
+
+LLM_CONCURRENCY = 4   # LLMへの同時リクエスト数の上限
+MAX_BODY = 1 << 20    # リクエストボディの上限（バイト）
+REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+# --- 回答サービス ----------
+class KnowhowService:
+    """
+    書き起こし・タグ付け結果・Embeddingを一度だけ読み込み、/ask に答え続けるサービス
+    LLMを呼ぶ処理はスレッドで動かし、同時実行数は llm_concurrency に抑える。
+    reload() は新しいコーパスを裏で作り終えてから差し替えるので、その間も回答できる
+    """
+
+    def __init__(self, client=None, routes=("tag", "rag"), llm_concurrency=LLM_CONCURRENCY):
+        self.client = client
+        self.routes = tuple(routes)
+        self.llm_concurrency = llm_concurrency
+        self.semaphore = asyncio.Semaphore(llm_concurrency)
+        self.rag = None
+        self.loaded_at = None
+        self.reloading = False
+        self.reload_task = None  # 実行中の reload()（参照を持っておかないとタスクが回収されうる）
+        self.counts = {"requests": 0, "errors": 0, "in_flight": 0}
+
+    def _load_sync(self):
+        # どちらの経路を作るよりも先に、書き起こしの行索引を読み直す
+        line_store.refresh()
+        rag = RAG2knowhow.RAGCorpus(self.client) if "rag" in self.routes else None
+        if "tag" in self.routes:
+            tag2knowhow.reload(self.client)
+        return rag
+
+    async def reload(self):
+        if self.reloading:
+            return False
+        self.reloading = True
+        try:
+            started = time.perf_counter()
+            rag = await asyncio.to_thread(self._load_sync)
+            self.rag = rag  # 読み込みが終わってから差し替える
+            self.loaded_at = time.time()
+            print(f"コーパスを読み込みました（{time.perf_counter() - started:.1f}秒）")
+        finally:
+            self.reloading = False
+        return True
+
+    async def ask(self, route, question):
+        if route == "rag":
+            rag = self.rag
+            async with self.semaphore:
+                answer, cached = await asyncio.to_thread(rag.answer, question, record=False)
+            return {"answer": answer, "cached": cached}
+        # prompt.txt / RAGresult.txt は1つしかないので、並列に答えるサービスからは記録しない
+        # 要約のLLM呼び出しも semaphore の1枠に収めるため、1件ずつ行う
+        async with self.semaphore:
+            answer, cached = await asyncio.to_thread(
+                tag2knowhow.answer, question, False, self.client, record=False, summary_workers=1,
+            )
+        return {"answer": answer, "cached": cached}
+
+    def health(self):
+        return {
+            "status": "ok" if self.loaded_at else "loading",
+            "routes": list(self.routes),
+            "loaded_at": self.loaded_at,
+            "reloading": self.reloading,
+            "chunks": len(self.rag.chunks) if self.rag else None,
+            "llm_concurrency": self.llm_concurrency,
+            **self.counts,
+        }
+
+    # --- HTTP ----------
+    async def dispatch(self, method, path, body):
+        path = path.split("?", 1)[0]
+        if path == "/health":
+            return 200, self.health()
+        if path == "/metrics":
+            return 200, tracer.prometheus_text()
+        if path == "/reload":
+            if method != "POST":
+                return 405, {"error": "POSTで呼び出してください"}
+            if self.reloading:
+                return 202, {"status": "already reloading"}
+            self.reload_task = asyncio.create_task(self.reload())
+            return 202, {"status": "reloading"}
+        if path == "/ask":
+            if method != "POST":
+                return 405, {"error": "POSTで呼び出してください"}
+            req = json.loads(body or b"{}")
+            if not isinstance(req, dict):
+                return 400, {"error": "リクエストボディはJSONオブジェクトにしてください"}
+            question = req.get("question") or ""
+            if not isinstance(question, str):
+                return 400, {"error": "question は文字列にしてください"}
+            question = question.strip()
+            route = req.get("route", "tag")
+            if not question:
+                return 400, {"error": "question が空です"}
+            if route not in self.routes:
+                return 400, {"error": f"route は {list(self.routes)} のいずれかです"}
+            if self.loaded_at is None:
+                return 503, {"error": "コーパスを読み込み中です"}
+            started = time.perf_counter()
+            result = await self.ask(route, question)
+            result.update(route=route, elapsed=time.perf_counter() - started)
+            return 200, result
+        return 404, {"error": f"{path} はありません"}
+
+    async def handle(self, reader, writer):
+        self.counts["requests"] += 1
+        self.counts["in_flight"] += 1
+        try:
+            try:
+                method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    status, payload = 413, {"error": "リクエストが大きすぎます"}
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = await self.dispatch(method.upper(), path, body)
+            except (ValueError, json.JSONDecodeError) as e:
+                status, payload = 400, {"error": str(e)}
+            except Exception as e:
+                status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+            if status >= 500:
+                self.counts["errors"] += 1
+            if isinstance(payload, str):
+                data, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                data, content_type = json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+            writer.write(
+                f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1") + data
+            )
+            await writer.drain()
+        finally:
+            self.counts["in_flight"] -= 1
+            writer.close()
+# --- ここまで回答サービス ----------
+
+async def serve(host, port, client=None, routes=("tag", "rag"), llm_concurrency=LLM_CONCURRENCY):
+    service = KnowhowService(client, routes, llm_concurrency)
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f"http://{host}:{port} で待ち受けます（/ask, /health, /reload, /metrics）")
+    await service.reload()
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="ノウハウ回答のHTTPサーバ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--routes", default="tag,rag", help="有効にする回答経路（カンマ区切り）")
+    parser.add_argument("--llm-concurrency", type=int, default=LLM_CONCURRENCY)
+    parser.add_argument("--fake", action="store_true", help="OpenAIの代わりにローカルの偽クライアントを使う")
+    parser.add_argument("--trace", help="処理段階ごとのスパンを書き出すJSONLファイル")
+    args = parser.parse_args()
+
+    tracer.configure(path=args.trace or tracer.path, metrics=True)  # /metrics のために常に集計する
+    serve_metrics_from_env()
+
+    client = None
+    if args.fake:
+        from fake_openai import FakeOpenAI
+        client = FakeOpenAI(latency=0.2)
+    asyncio.run(serve(args.host, args.port, client, args.routes.split(","), args.llm_concurrency))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import sys
+import time
+from tracing import tracer
+
+# --- ストリーミング出力 ----------
+def stream_chat(client, model, messages, out=sys.stdout, **kwargs):
+    """
+    stream=True でチャットを呼び出し、届いたトークンから順に out に書き出す
+    戻り値: (回答全文, {"ttft": 最初のトークンまでの秒数, "total": 全体の秒数})
+    """
+    started = time.perf_counter()
+    ttft = None
+    parts = []
+    if tracer.enabled:
+        kwargs.setdefault("stream_options", {"include_usage": True})  # 最後のチャンクでusageを受け取る
+    for chunk in client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs):
+        if getattr(chunk, "usage", None) is not None:
+            tracer.record_llm(model, chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if ttft is None:
+                ttft = time.perf_counter() - started
+            out.write(delta)
+            out.flush()
+            parts.append(delta)
+    out.write("\n")
+    return "".join(parts), {"ttft": ttft, "total": time.perf_counter() - started}
+
+def chat(client, model, messages, stream=False, out=sys.stdout, **kwargs):
+    """
+    stream の有無にかかわらず (回答全文, 計測値) を返す。stream=False のときは何も表示しない
+    """
+    if stream:
+        return stream_chat(client, model, messages, out=out, **kwargs)
+    started = time.perf_counter()
+    resp = client.chat.completions.create(model=model, messages=messages, **kwargs)
+    total = time.perf_counter() - started
+    tracer.record_llm(model, resp.usage)
+    return resp.choices[0].message.content, {"ttft": total, "total": total}
+
+def format_timing(timing):
+    ttft = "-" if timing["ttft"] is None else f"{timing['ttft']:.2f}秒"
+    return f"最初のトークンまで {ttft} / 全体 {timing['total']:.2f}秒"
+# --- ここまでストリーミング出力 ----------
@@ -1,25 +1,62 @@
-import openai
-import json
-import glob
-import os
-from dotenv import load_dotenv
+import sys
+from corpus import line_store
+from openai_client import default_client
+from tag_index import block_section, block_text, tag_index
+from phase_classifier import PhaseClassifier
+from answer_cache import AnswerCache
+from embed_cache import embed_texts
+from context_packer import pack_context
+from llm_pool import run_concurrent
+from phase_digest import current_digest, digest_context
+from token_cache import get_counter
+from streaming import chat, format_timing
+from tracing import tracer
 
-load_dotenv()
-api_key = os.getenv("API_KEY")
-openai.api_key = api_key
+USE_LOCAL_CLASSIFIER = True # Trueなら埋め込みによるローカル分類を先に試し、自信がない時だけLLMで推定
+EMBED_MODEL = "text-embedding-3-large"
+CHAT_MODEL = "gpt-4.1"
+ANSWER_CACHE_THRESHOLD = 0.92 # 過去の質問とのコサイン類似度がこれ以上なら、その回答を再利用
+CONTEXT_TOKEN_BUDGET = 60000  # 参考作業会話に使う最大トークン数（超えた分は関連度順に選び、残りは要約）
+USE_DIGEST = True   # phase_digests.json（phase_digest.pyで作成）があれば、ダイジェストをもとに回答
+DIGEST_EXCERPTS = 2 # ダイジェストに添える原文抜粋の件数
+STREAM = True       # Trueなら回答をトークンが届いた順に表示する
+SUMMARY_WORKERS = 8 # 予算に入らないブロックを要約する時の同時LLM呼び出し数
+
+_answer_cache = None
+phase_tags = None  # phase_tags.txt のタグ（最初に使う時に読む）
+
+def get_answer_cache():
+    """
+    回答キャッシュ（最初に使う時にディスクから読む）
+    """
+    global _answer_cache
+    if _answer_cache is None:
+        _answer_cache = AnswerCache(
+            "tag", threshold=ANSWER_CACHE_THRESHOLD,
+            extra=f"{CHAT_MODEL} {EMBED_MODEL} {CONTEXT_TOKEN_BUDGET} {USE_DIGEST} {DIGEST_EXCERPTS}",
+        )
+    return _answer_cache
 
 # phase_tags.txtのタグ読み込み
-with open("phase_tags.txt", encoding="utf-8") as f:
-    phase_tags = [l.strip() for l in f if l.strip()]
+def load_phase_tags():
+    with open("phase_tags.txt", encoding="utf-8") as f:
+        return [l.strip() for l in f if l.strip()]
+
+def get_phase_tags():
+    global phase_tags
+    if phase_tags is None:
+        phase_tags = load_phase_tags()
+    return phase_tags
 
 # --- 作業工程タグ推定関数 ----------
-def tag_estimate(question):
+def tag_estimate(question, client=None):
     """
     ユーザーの質問に対して、phase_tags.txtのタグから最も適切なものを選ぶ
     """
+    client = client or default_client()
 
     # タグ一覧を整形
-    tag_list_str = "・" + "\n・".join(phase_tags)
+    tag_list_str = "・" + "\n・".join(get_phase_tags())
     prompt = f"""
 あなたは現場作業の工程分析エージェントです。
 
@@ -32,7 +69,7 @@ def tag_estimate(question):
 出力形式：タグ名のみ1行で（例：「3Dプリンター準備」）
 """
 
-    response = openai.chat.completions.create(
+    response = client.chat.completions.create(
         model="gpt-4.1-nano",
         messages=[
             {"role": "system", "content": "あなたはデジタル工房機器作業の工程分析エージェントです。"},
@@ -41,24 +78,72 @@ def tag_estimate(question):
         #max_tokens=20,
         #temperature=0,
     )
+    tracer.record_llm("gpt-4.1-nano", response.usage)
     phase = response.choices[0].message.content.strip()
     return phase
+
+_classifier = None
+
+def estimate_phase(question, q_emb=None, client=None):
+    """
+    ローカル分類器でタグを推定し、1位と2位の差が小さい時だけ tag_estimate（LLM）に任せる
+    戻り値: (タグ, "local" / "llm")
+    """
+    global _classifier
+    if not USE_LOCAL_CLASSIFIER:
+        return tag_estimate(question, client), "llm"
+    if _classifier is None:
+        _classifier = PhaseClassifier.build(get_phase_tags(), client=client)
+    return _classifier.estimate(question, lambda q: tag_estimate(q, client), q_emb=q_emb)
+
+def estimate_phases(questions, q_embs, client=None, concurrency=4):
+    """
+    estimate_phase の一括版。ローカル分類は行列積1回で済ませ、自信のない質問だけ LLM に並列で問い合わせる
+    戻り値: [(タグ, "local" / "llm"), ...]
+    LLM の推定に失敗した質問はローカル分類の1位を使う（ローカル分類を使わない設定なら (None, "error")）
+    """
+    global _classifier
+    if USE_LOCAL_CLASSIFIER:
+        if _classifier is None:
+            _classifier = PhaseClassifier.build(get_phase_tags(), client=client)
+        local = _classifier.classify_batch(q_embs)
+        _classifier.n_queries += len(questions)
+        unsure = [i for i, (_tag, margin) in enumerate(local) if margin < _classifier.threshold]
+        _classifier.n_fallback += len(unsure)
+    else:
+        local = [(None, 0.0)] * len(questions)
+        unsure = list(range(len(questions)))
+    llm = run_concurrent(unsure, lambda i: tag_estimate(questions[i], client), concurrency,
+                         label=lambda i: f"タグ推定 {questions[i][:20]}")
+    results = []
+    for i, (tag, _margin) in enumerate(local):
+        if i not in llm:
+            results.append((tag, "local"))
+        elif isinstance(llm[i], Exception):
+            results.append((tag, "local") if tag is not None else (None, "error"))
+        else:
+            results.append((llm[i], "llm"))
+    return results
+
+def reload(client=None):
+    """
+    phase_tags.txt・タグ索引・書き起こし・工程分類器を読み直す
+    新しい分類器を作り終えてから差し替えるので、読み直し中も回答を続けられる
+    """
+    global phase_tags, _classifier
+    tags = load_phase_tags()
+    line_store.refresh()
+    tag_index.refresh(force=True)
+    classifier = PhaseClassifier.build(tags, client=client) if USE_LOCAL_CLASSIFIER else None
+    phase_tags, _classifier = tags, classifier
 # --- ここまで作業工程タグ推定関数 ----------
 
 # --- タグ -> ブロック取得関数 ----------
 def tag2block(tag):
     """
-    全 phase_blocks_*.json を走査し、該当タグのブロックを集める
-    """
-    blocks = []
-    for fname in sorted(glob.glob("phase_blocks_*.json")):
-        with open(fname, encoding="utf-8") as f:
-            block_list = json.load(f)
-        for b in block_list:
-            if b["tag"] == tag:
-                b["source_file"] = fname.replace("phase_blocks_", "").replace(".json", "")
-                blocks.append(b)
-    return blocks
+    読み込み済みのタグ索引から、全 phase_blocks_*.json の該当タグのブロックを集める
+    """
+    return tag_index.blocks(tag)
 # --- ここまでタグ -> ブロック取得関数 ----------
 
 # --- ブロック -> テキスト関数 ----------
@@ -66,61 +151,145 @@ def block2text(block):
     """
     ブロックのテキストを抽出（元txtファイルから抜粋）
     """
-    txtfile = block["source_file"] + ".txt"
-    with open(txtfile, encoding="utf-8") as f:
-        lines = [l.strip() for l in f if l.strip()]
-    return "\n".join(lines[block["start_line"]:block["end_line"]+1])
+    return block_text(block)
 # --- ここまでブロック -> テキスト関数 ----------
 
 # --- 回答生成関数 ----------
-def generate_answer(question):
+def generate_answer(question, stream=False, client=None, out=sys.stdout, record=True, summary_workers=SUMMARY_WORKERS):
     """
     質問→タグ推定→該当工程の全9ペアの会話ブロックを集めて回答生成
+    stream=True なら回答を生成しながら out に表示する
+    record=False なら prompt.txt への記録と時間の表示をしない（並列に呼ぶ時用）
+    summary_workers はコンテキストの要約で同時に投げるLLM呼び出しの数（呼び出し側で同時実行数を抑える時は1にする）
+    各段階の時間とLLMのトークン数は tracing のスパン（tag.*）に記録する
+    """
+    return answer(question, stream, client, out, record, summary_workers)[0]
+
+def answer(question, stream=False, client=None, out=sys.stdout, record=True, summary_workers=SUMMARY_WORKERS):
+    """
+    generate_answer と同じ。戻り値: (回答, キャッシュから返したか)
     """
-    tag = tag_estimate(question)
-    print(f"\n推定されたタグ：{tag}\n")
+    with tracer.span("tag.answer", stream=stream) as span:
+        return _generate_answer(question, stream, client or default_client(), out, span, record, summary_workers)
 
-    blocks = tag2block(tag)
-    if not blocks:
+def _generate_answer(question, stream, client, out, span, record, summary_workers):
+    # 似た質問に回答済みならキャッシュから返す
+    with tracer.span("tag.embed_query"):
+        q_emb = embed_texts([question], EMBED_MODEL, client)[0]
+    with tracer.span("tag.cache_lookup"):
+        cached = get_answer_cache().lookup(q_emb)
+    if cached is not None:
+        span.set(cached=True)
+        return cached, True
+
+    with tracer.span("tag.estimate_phase") as s:
+        tag, method = estimate_phase(question, q_emb, client)
+        s.set(tag=tag, method=method)
+    print(f"\n推定されたタグ：{tag}（{'ローカル分類' if method == 'local' else 'LLM'}）\n")
+
+    with tracer.span("tag.load_blocks") as s:
+        # 該当ブロックのテキストを、トークン予算内に収まるよう連結
+        context_blocks = tag_sections(tag)
+        s.set(blocks=len(context_blocks))
+    if not context_blocks:
         print("該当タグの会話データが見つかりませんでした。")
-        return
+        return None, False
 
-    # すべての該当ブロックのテキストを連結
-    context_blocks = []
-    for b in blocks:
-        block_txt = block2text(b)
-        context_blocks.append(f"【{b['source_file']}】\n{block_txt}")
-    context = "\n\n---\n\n".join(context_blocks)
+    with tracer.span("tag.build_context") as s:
+        context, source_desc, info = build_context(question, tag, context_blocks, client, summary_workers)
+        s.set(**info)
+    if info["digest"]:
+        print("コンテキスト: 工程ダイジェストを使用")
+    else:
+        print(f"コンテキスト: {info['tokens']}トークン（原文 {info['raw']}件 / 要約 {info['summarized']}件 / 全 {info['sections']}件）")
 
-    prompt = f"""
+    prompt = build_prompt(question, source_desc, context)
+    if record:
+        with open("prompt.txt", "w", encoding="utf-8") as f:
+            f.write(prompt)
+
+    if stream:
+        out.write("\n=== 回答 ===\n\n")
+    answer, timing = chat_answer(prompt, stream, client, out)
+    if record:
+        with open("prompt.txt", "a", encoding="utf-8") as f:
+            f.write(f"\n【回答】（{format_timing(timing)}）\n{answer}\n")
+        print(f"\n（{format_timing(timing)}）")
+    get_answer_cache().store(question, q_emb, answer)
+    return answer, False
+
+def tag_sections(tag):
+    """
+    該当タグの全ブロックを、コンテキストに入れる「【元ファイル】」見出し付きのセクションにする
+    """
+    return [block_section(b) for b in tag2block(tag)]
+
+def build_context(question, tag, context_blocks, client, summary_workers=SUMMARY_WORKERS):
+    """
+    工程ダイジェストがあればダイジェスト＋原文抜粋、なければ原文を予算内に詰めたコンテキストを作る
+    戻り値: (コンテキスト, プロンプトに入れる出典の説明, 情報)
+    """
+    digest = current_digest(tag) if USE_DIGEST else None
+    if digest is not None:
+        # 事前に作った工程ダイジェスト＋関連の高い原文抜粋だけを渡す
+        context = digest_context(question, digest, context_blocks, DIGEST_EXCERPTS, get_counter())
+        source_desc = f"以下は9ペア分の、同じ工程（タグ: {tag}）での作業会話から事前にまとめたノウハウと、原文の抜粋です。"
+        return context, source_desc, {"digest": True}
+    context, info = pack_context(question, context_blocks, CONTEXT_TOKEN_BUDGET, client=client, max_workers=summary_workers)
+    source_desc = f"以下は9ペア分の、同じ工程（タグ: {tag}）での実際の作業会話の抜粋です。"
+    return context, source_desc, {"digest": False, **info}
+
+def build_prompt(question, source_desc, context):
+    return f"""
 あなたは現場作業のノウハウサポートAIです。
 
 ユーザーからの質問：
 「{question}」
 
-以下は9ペア分の、同じ工程（タグ: {tag}）での実際の作業会話の抜粋です。
+{source_desc}
 これらを参考にして、ユーザーの質問に対しアドバイスしてください。作業会話からわかる、今後起こりうる問題について、先回りして示すなどしてもかまいません。
 
 【参考作業会話】
 {context}
 """
-    with open("prompt.txt", "w", encoding="utf-8") as f:
-        f.write(prompt)
 
-    response = openai.chat.completions.create(
-        model="gpt-4.1",
-        messages=[
-            {"role": "system", "content": "あなたはデジタル工房機器作業のノウハウを伝えるサポートAIです。"},
-            {"role": "user", "content": prompt}
-        ],
-        #max_tokens=800,
-        #temperature=0.3,
-    )
-    return response.choices[0].message.content
+def chat_answer(prompt, stream=False, client=None, out=sys.stdout):
+    """
+    プロンプトから回答を生成する。戻り値: (回答, 時間の計測結果)
+    """
+    with tracer.span("tag.chat") as s:
+        answer, timing = chat(
+            client or default_client(),
+            CHAT_MODEL,
+            [
+                {"role": "system", "content": "あなたはデジタル工房機器作業のノウハウを伝えるサポートAIです。"},
+                {"role": "user", "content": prompt}
+            ],
+            stream=stream,
+            out=out,
+            #max_tokens=800,
+            #temperature=0.3,
+        )
+        s.set(ttft_ms=None if timing["ttft"] is None else round(timing["ttft"] * 1000, 3))
+    return answer, timing
 # --- ここまで回答生成関数 ----------
 
 # --- メイン処理 ----------
-def main():
+def ask(question, stream=STREAM, client=None):
+    """
+    質問1件に回答して表示する
+    """
+    text, from_cache = answer(question, stream=stream, client=client)
+    if from_cache:
+        print("\n=== 回答（キャッシュ） ===\n")
+        print(text)
+    elif not stream or text is None:
+        print("\n=== 回答 ===\n")
+        print(text)
+    print(f"\n回答キャッシュ: {get_answer_cache().stats()}")
+    return text
+
+def main(stream=STREAM, client=None):
     while True:
         question = input("ご質問はありますか？（終了するには'exit'と入力）：\n")
         if question.lower() == 'exit':                                                                                             
@@ -128,9 +297,7 @@ def main():
         elif not question.strip():
             print("質問が入力されていません。")
         else:
-            answer = generate_answer(question)
-            print("\n=== 回答 ===\n")
-            print(answer)
+            ask(question, stream, client)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
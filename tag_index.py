@@ -0,0 +1,111 @@
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from corpus import line_store
+
+BLOCKS_PATTERN = "phase_blocks_*.json"
+
+def source_of(json_path):
+    """
+    phase_blocks_<元ファイル名>.json から元ファイル名（拡張子なし）を取り出す
+    """
+    return os.path.basename(json_path).replace("phase_blocks_", "").replace(".json", "")
+
+# --- ブロック -> テキスト ----------
+def block_text(block):
+    """
+    ブロックのテキスト（元txtファイルの start_line〜end_line 行）
+    """
+    return line_store.text(block["source_file"] + ".txt", block["start_line"], block["end_line"] + 1)
+
+def block_section(block):
+    """
+    回答のコンテキストに入れる形（「【元ファイル】」見出し付き）
+    tools/tokenChecker.py --section もこの文字列を数えるので、そのトークン数キャッシュは回答時の予算計算にそのまま使われる
+    """
+    return f"【{block['source_file']}】\n{block_text(block)}"
+# --- ここまでブロック -> テキスト ----------
+
+# --- タグ -> ブロック転置索引 ----------
+class TagIndex:
+    """
+    全 phase_blocks_*.json を一度だけ読み込み、タグごとに (元ファイル, start_line, end_line) を保持する
+    更新時刻が変わったjsonだけを読み直す。確認は check_interval 秒に一度で、
+    それ以外の検索ではディスクにアクセスしない
+    """
+
+    def __init__(self, pattern=BLOCKS_PATTERN, check_interval=5.0):
+        self.pattern = pattern
+        self.check_interval = check_interval
+        self._files = {}   # json_path -> (mtime_ns, {tag: ((start, end), ...)})
+        self._by_tag = {}  # tag -> ((source, start, end), ...)
+        self._last_check = None
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """
+        jsonの追加・削除・更新を反映する。変更があれば True
+        """
+        with self._lock:
+            return self._refresh(force)
+
+    def _refresh(self, force):
+        now = time.monotonic()
+        if not force and self._last_check is not None and (
+            self.check_interval is None or now - self._last_check < self.check_interval
+        ):
+            return False
+        self._last_check = now
+
+        changed = False
+        paths = sorted(glob.glob(self.pattern))
+        for path in set(self._files) - set(paths):
+            del self._files[path]
+            changed = True
+        for path in paths:
+            mtime = os.stat(path).st_mtime_ns
+            cached = self._files.get(path)
+            if cached is not None and cached[0] == mtime:
+                continue
+            with open(path, encoding="utf-8") as f:
+                block_list = json.load(f)
+            ranges = {}
+            for b in block_list:
+                ranges.setdefault(sys.intern(b["tag"]), []).append((b["start_line"], b["end_line"]))
+            self._files[path] = (mtime, {t: tuple(r) for t, r in ranges.items()})
+            changed = True
+
+        if changed:
+            by_tag = {}
+            for path in sorted(self._files):
+                source = sys.intern(source_of(path))
+                for tag, ranges in self._files[path][1].items():
+                    by_tag.setdefault(tag, []).extend((source, s, e) for s, e in ranges)
+            self._by_tag = {t: tuple(r) for t, r in by_tag.items()}
+        return changed
+
+    def lookup(self, tag):
+        """
+        タグに該当する (元ファイル, start_line, end_line) のタプル列
+        """
+        self.refresh()
+        return self._by_tag.get(tag, ())
+
+    def blocks(self, tag):
+        """
+        tag2block互換のブロック辞書リスト（毎回新しい辞書を返す）
+        """
+        return [
+            {"start_line": s, "end_line": e, "tag": tag, "source_file": src}
+            for src, s, e in self.lookup(tag)
+        ]
+
+    def tags(self):
+        self.refresh()
+        return list(self._by_tag)
+
+tag_index = TagIndex()  # スクリプト間で共有する既定の索引
+# --- ここまでタグ -> ブロック転置索引 ----------
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import threading
+import tiktoken
+from concurrent.futures import ProcessPoolExecutor
+
+CACHE_DIR = ".token_cache"  # トークン数キャッシュの保存先
+ENCODING = "o200k_base"     # gpt-4.1 系のエンコーディング
+PARALLEL_MIN = 256          # count_many で未計測のテキストがこれ以上あればプロセスプールで数える
+PARALLEL_BATCH = 64         # プロセスプールに1回で渡すテキスト数
+
+# モデル -> (エンコーディング, コンテキスト長の上限トークン数)
+MODELS = {
+    "gpt-4.1": ("o200k_base", 1047576),
+    "gpt-4.1-mini": ("o200k_base", 1047576),
+    "gpt-4o": ("o200k_base", 128000),
+    "gpt-4o-mini": ("o200k_base", 128000),
+    "text-embedding-3-large": ("cl100k_base", 8191),
+    "text-embedding-3-small": ("cl100k_base", 8191),
+}
+
+def encoding_for_model(model):
+    return MODELS[model][0] if model in MODELS else tiktoken.encoding_for_model(model).name
+
+def context_limit(model):
+    if model not in MODELS:
+        raise ValueError(f"{model} のコンテキスト長がわかりません（{', '.join(MODELS)} のいずれかか、上限を直接指定してください）")
+    return MODELS[model][1]
+
+# --- プロセスプール用 ----------
+_worker_encs = {}
+
+def _count_batch(encoding, texts):
+    """
+    別プロセスで texts のトークン数を数える（エンコーダはプロセスごとに一度だけ作る）
+    """
+    if encoding not in _worker_encs:
+        _worker_encs[encoding] = tiktoken.get_encoding(encoding)
+    enc = _worker_encs[encoding]
+    return [len(enc.encode(t)) for t in texts]
+# --- ここまでプロセスプール用 ----------
+
+# --- トークン数キャッシュ ----------
+class TokenCounter:
+    """
+    テキスト本文のハッシュをキーにトークン数を覚えておくカウンタ
+    save() でディスクに書き出し、次回起動時に読み込む
+    """
+
+    def __init__(self, encoding=ENCODING, cache_dir=CACHE_DIR):
+        self.encoding = encoding
+        self.path = os.path.join(cache_dir, f"{encoding}.json")
+        self._enc = None
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.counts = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                self.counts = json.load(f)
+
+    @property
+    def enc(self):
+        if self._enc is None:
+            self._enc = tiktoken.get_encoding(self.encoding)
+        return self._enc
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def count(self, text, cache=True):
+        """
+        text のトークン数（cache=False なら記録しない。行単位など細かい計測用）
+        """
+        if not cache:
+            return len(self.enc.encode(text))
+        k = self.key(text)
+        n = self.counts.get(k)
+        if n is None:
+            n = len(self.enc.encode(text))
+            with self._lock:
+                self.counts[k] = n
+                self._dirty = True
+        return n
+
+    def count_many(self, texts, workers=None):
+        """
+        texts それぞれのトークン数のリスト（count() と同じキャッシュを使う）
+        未計測のテキストが PARALLEL_MIN 件以上あれば、workers プロセスで並列に数えてから登録する
+        （workers=1 なら常にこのプロセスで数える。None なら CPU 数）
+        """
+        keys = [self.key(t) for t in texts]
+        missing = {}
+        for k, t in zip(keys, texts):
+            if k not in self.counts:
+                missing.setdefault(k, t)
+        if missing:
+            todo = list(missing.items())
+            workers = workers or os.cpu_count() or 1
+            if len(todo) < PARALLEL_MIN or workers <= 1:
+                counted = [len(self.enc.encode(t)) for _k, t in todo]
+            else:
+                batches = [[t for _k, t in todo[i:i + PARALLEL_BATCH]] for i in range(0, len(todo), PARALLEL_BATCH)]
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    counted = [n for ns in pool.map(_count_batch, [self.encoding] * len(batches), batches) for n in ns]
+            self.update({k: n for (k, _t), n in zip(todo, counted)})
+        return [self.counts[k] for k in keys]
+
+    def update(self, counts):
+        """
+        {key: トークン数} をまとめて登録する（別プロセスで数えた結果の取り込み用）
+        """
+        with self._lock:
+            self.counts.update(counts)
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.counts, f)
+            os.replace(tmp, self.path)
+            self._dirty = False
+
+_counters = {}
+
+def get_counter(encoding=ENCODING):
+    """
+    エンコーディングごとに共有するカウンタ
+    """
+    if encoding not in _counters:
+        _counters[encoding] = TokenCounter(encoding)
+    return _counters[encoding]
+# --- ここまでトークン数キャッシュ ----------
@@ -0,0 +1,196 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import synth_corpus
+
+BASE_FILES = 9          # 実コーパスのペア数（倍率 1 のファイル数）
+SCALES = [10, 100, 1000]
+SCENARIOS = ["startup", "latency", "throughput", "tagging"]
+
+# --- 偽LLMの応答 ----------
+def fake_chat(messages):
+    """
+    プロンプトの種類に応じて、各スクリプトが解釈できる決まった応答を返す
+    """
+    prompt = messages[-1]["content"]
+    tags = re.findall(r"^・(.+)$", prompt, re.M)
+    m = re.search(r"タグ数は必ず(\d+)個", prompt)
+    total = re.search(r"全(\d+)行", prompt)
+    if tags and "【会話データ】" in prompt:
+        # add_tag: 書き起こし全体を工程数（窓の場合はタグ数）で等分し、プロンプトに含まれる行だけを返す
+        rows = [int(n) for n in re.findall(r"^(\d+): ", prompt, re.M)]
+        n_lines = int(total.group(1)) if total else len(rows)
+        count = int(m.group(1)) if m else len(tags)
+        blocks = []
+        for i in rows:
+            k = i * count // n_lines
+            if blocks and blocks[-1]["k"] == k:
+                blocks[-1]["end_line"] = i
+            else:
+                blocks.append({"k": k, "start_line": i, "end_line": i, "tag": tags[k % len(tags)]})
+        return json.dumps({"blocks": [{key: b[key] for key in ("start_line", "end_line", "tag")} for b in blocks]},
+                          ensure_ascii=False)
+    if "[タグ一覧]" in prompt:
+        # tag_estimate: 質問の文字数で決まるタグを返す
+        question = prompt.split("[ユーザーの質問]", 1)[-1]
+        return tags[len(question) % len(tags)]
+    return "（fake応答）ノズルの温度とベッドの水平を先に確認しておくと、印刷中のトラブルを防げます。" * 3
+
+def percentiles(values):
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p / 100 * len(values)))]
+    return {
+        "n": len(values),
+        "mean_ms": 1000 * sum(values) / len(values),
+        "p50_ms": 1000 * pick(50),
+        "p90_ms": 1000 * pick(90),
+        "p99_ms": 1000 * pick(99),
+    }
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1 << 20) if sys.platform == "darwin" else rss / 1024, 1)
+
+def timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+# --- 1倍率分の計測（別プロセスで実行） ----------
+def run_scale(scale, args):
+    """
+    作業ディレクトリに合成コーパスを作り、各シナリオを計測して結果の辞書を返す
+    各スクリプトはカレントディレクトリのファイルを読むので、chdirしてから import する
+    """
+    from fake_openai import FakeOpenAI
+
+    result = {"scale": scale}
+    with tempfile.TemporaryDirectory(prefix="knowhow_bench_") as work:
+        info, result["generate_s"] = timed(
+            synth_corpus.generate, work, BASE_FILES * scale, args.lines, args.seed
+        )
+        result.update(info)
+        os.chdir(work)
+        client = FakeOpenAI(chat_fn=fake_chat, latency=args.latency, embed_dim=args.embed_dim)
+        questions = synth_corpus.make_questions(args.questions, args.seed + 1)
+
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            import RAG2knowhow
+            import tag2knowhow
+            result["import_s"] = time.perf_counter() - started
+
+            # 起動: 初回（Embeddingを全件作る）と2回目（キャッシュから読む）
+            rag, result["rag_startup_cold_s"] = timed(RAG2knowhow.RAGCorpus, client)
+            rag, result["rag_startup_warm_s"] = timed(RAG2knowhow.RAGCorpus, client)
+            result["n_chunks"] = len(rag.chunks)
+            _, result["tag_startup_cold_s"] = timed(tag2knowhow.reload, client)
+            _, result["tag_startup_warm_s"] = timed(tag2knowhow.reload, client)
+
+            # 回答キャッシュに当たらないようにして、毎回パイプライン全体を通す
+            rag.answer_cache.threshold = 2.0
+            tag2knowhow.get_answer_cache().threshold = 2.0
+            routes = {
+                "rag": lambda q: rag.answer(q),
+                "tag": lambda q: tag2knowhow.generate_answer(q, client=client),
+            }
+
+            if "latency" in args.scenarios:
+                for name, fn in routes.items():
+                    times = [timed(fn, q)[1] for q in questions]
+                    result[f"{name}_latency"] = percentiles(times)
+
+            if "throughput" in args.scenarios:
+                for name, fn in routes.items():
+                    with ThreadPoolExecutor(args.concurrency) as pool:
+                        _, elapsed = timed(lambda: list(pool.map(fn, questions)))
+                    result[f"{name}_throughput_qps"] = len(questions) / elapsed
+
+            if "tagging" in args.scenarios:
+                import add_tag
+                tagged, result["tagging_s"] = timed(
+                    add_tag.add_tag_all, concurrency=args.concurrency, rpm=None, tpm=None,
+                    client=client, force=True,
+                )
+                result["tagging_failed"] = sum(1 for r in tagged.values() if not isinstance(r, list))
+                assert result["tagging_failed"] == 0, f"タグ分けに失敗したファイルがあります: {result['tagging_failed']}件"
+
+        result["llm_calls"] = dict(client.calls)
+        result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+# --- 倍率ごとにプロセスを分けて実行 ----------
+def main():
+    parser = argparse.ArgumentParser(description="合成コーパスと偽LLMによる全体ベンチマーク")
+    parser.add_argument("--scales", default=",".join(map(str, SCALES)), help=f"コーパスの倍率（1倍 = {BASE_FILES}ファイル）")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="startupは常に計測")
+    parser.add_argument("--lines", type=int, default=400, help="1ファイルあたりの行数")
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0, help="偽LLMの1呼び出しあたりの待ち秒数")
+    parser.add_argument("--embed-dim", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.scenarios = args.scenarios.split(",")
+
+    if args.worker is not None:
+        print(json.dumps(run_scale(args.worker, args), ensure_ascii=False))
+        return
+
+    # 倍率ごとに別プロセスで計測する（import・メモリのピークを前の倍率と混ぜない）
+    results = []
+    for scale in [int(s) for s in args.scales.split(",")]:
+        print(f"倍率 {scale}（{BASE_FILES * scale}ファイル）を計測中...")
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", str(scale)] + sys.argv[1:],
+            capture_output=True, text=True, encoding="utf-8",
+        )
+        if proc.returncode != 0:
+            print(proc.stderr)
+            results.append({"scale": scale, "error": proc.stderr.strip().splitlines()[-1:]})
+            continue
+        r = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(r)
+        print(f"  行数 {r['n_lines']} / チャンク {r['n_chunks']} / 起動 rag {r['rag_startup_cold_s']:.2f}s"
+              f"（2回目 {r['rag_startup_warm_s']:.2f}s） tag {r['tag_startup_cold_s']:.2f}s / ピークメモリ {r['peak_rss_mb']}MB")
+        for name in ("rag", "tag"):
+            if f"{name}_latency" in r:
+                lat = r[f"{name}_latency"]
+                print(f"  {name}: p50 {lat['p50_ms']:.1f}ms p90 {lat['p90_ms']:.1f}ms p99 {lat['p99_ms']:.1f}ms", end="")
+            if f"{name}_throughput_qps" in r:
+                print(f" / {r[f'{name}_throughput_qps']:.1f} 件/秒", end="")
+            print()
+        if "tagging_s" in r:
+            print(f"  tagging: {r['tagging_s']:.2f}s（失敗 {r['tagging_failed']}件）")
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k != "worker"},
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"{args.out} に保存しました")
+
+if __name__ == "__main__":
+    main()
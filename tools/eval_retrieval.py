@@ -0,0 +1,319 @@
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import unicodedata
+import zlib
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "experiments"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+EMBED_MODEL = "text-embedding-3-large"
+LEXICAL_DIM = 1024   # --embed lexical のベクトル次元
+KS = (1, 3, 5, 10)   # recall@k を出す k
+STRATEGIES = ("block", "lines", "hybrid")
+
+# --- 埋め込み ----------
+def lexical_embedding(texts, dim=LEXICAL_DIM):
+    """
+    文字bigramを dim 次元にハッシュした正規化済みベクトル（APIなしで語の重なりを反映する評価用の埋め込み）
+    """
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        t = unicodedata.normalize("NFKC", text).lower()
+        for a, b in zip(t, t[1:]):
+            h = zlib.crc32((a + b).encode("utf-8"))
+            out[i, h % dim] += 1.0 if (h >> 16) & 1 else -1.0
+    return out / np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+
+def make_embedder(kind):
+    """
+    (テキストのリスト, 保存先の名前) -> 正規化済み行列 の関数
+    Embeddingキャッシュは get_or_embed に渡したテキストだけを残すので、質問・ブロック・チャンクなど
+    テキストの組ごとに別の名前（"eval-questions" など）で保存する
+    - lexical: 文字bigramのハッシュ（オフライン・決定的）
+    - cache  : Embeddingキャッシュにあるものだけを使う（無ければエラー。オフラインで実モデルの結果を再現する）
+    - openai : Embeddingキャッシュを引き、無いものだけAPIで埋め込んでキャッシュする
+    """
+    if kind == "lexical":
+        return lambda texts, store=None: lexical_embedding(texts)
+    from embed_cache import EmbeddingCache, embed_texts
+    caches = {}
+
+    def missing(texts):
+        raise RuntimeError(f"Embeddingキャッシュにないテキストが {len(texts)} 件あります（--embed openai で一度作ってください）")
+
+    def embed(texts, store):
+        if store not in caches:
+            caches[store] = EmbeddingCache(EMBED_MODEL, store)
+        fn = missing if kind == "cache" else (lambda t: embed_texts(t, EMBED_MODEL))
+        v = np.asarray(caches[store].get_or_embed(list(texts), fn), dtype=np.float32)
+        return v / np.maximum(np.linalg.norm(v, axis=1, keepdims=True), 1e-12)
+    return embed
+# --- ここまで埋め込み ----------
+
+# --- 正解データ ----------
+def load_line_tags():
+    """
+    phase_blocks_*.json から {txtファイル: 行ごとのタグID配列} とタグ一覧を作る（タグのない行は -1）
+    """
+    from corpus import line_store
+    from tag_index import source_of
+    tags, line_tags = [], {}
+    for path in sorted(glob.glob("phase_blocks_*.json")):
+        txt = source_of(path) + ".txt"
+        with open(path, encoding="utf-8") as f:
+            blocks = json.load(f)
+        arr = np.full(line_store.n_lines(txt), -1, dtype=np.int32)
+        for b in blocks:
+            if b["tag"] not in tags:
+                tags.append(b["tag"])
+            arr[b["start_line"]:b["end_line"] + 1] = tags.index(b["tag"])
+        line_tags[txt] = arr
+    return tags, line_tags
+
+def unit_tag(line_tags, txt, start, end):
+    """
+    行区間 [start, end] で最も多いタグID
+    """
+    ids = line_tags[txt][start:end + 1]
+    ids = ids[ids >= 0]
+    return int(np.bincount(ids).argmax()) if len(ids) else -1
+
+def sample_questions(tags, line_tags, n, seed=0):
+    """
+    ラベル付きの質問がない時の代用: タグ付きブロックから発話を1行ずつ抜き出し、そのタグを正解にする
+    （本文そのものなので語彙一致に有利。方式間の相対比較に使い、絶対値は --questions で測る）
+    """
+    from corpus import line_store
+    rng = random.Random(seed)
+    candidates = [(txt, i) for txt, arr in line_tags.items() for i in np.flatnonzero(arr >= 0)]
+    questions = []
+    for txt, i in rng.sample(candidates, min(n, len(candidates))):
+        line = line_store.lines(txt, int(i), int(i) + 1)[0]
+        questions.append({"question": line.split(":", 1)[-1].strip(), "tag": tags[line_tags[txt][i]]})
+    return questions
+# --- ここまで正解データ ----------
+
+# --- 指標 ----------
+def rank_metrics(ranked_tags, gold, topn, ks=KS):
+    """
+    1問分の検索結果（上位 max(KS, topn) 件）のタグID列から、recall@k・逆順位・precision（コンテキストに入る上位 topn 件）を出す
+    recall@k は上位k件に正解工程の単位が1つでもあれば 1（正解工程の単位は多数あるので、全件再現率ではなく的中率）
+    """
+    hits = [t == gold for t in ranked_tags]
+    first = hits.index(True) + 1 if True in hits else None
+    out = {f"recall@{k}": float(first is not None and first <= k) for k in ks}
+    out["rr"] = 1.0 / first if first else 0.0
+    out["precision"] = float(np.mean(hits[:topn])) if hits else 0.0
+    return out
+
+def summarize(per_query, latencies, prompt_tokens):
+    keys = per_query[0].keys()
+    out = {k: round(float(np.mean([q[k] for q in per_query])), 4) for k in keys}
+    out["mrr"] = out.pop("rr")
+    lat = sorted(latencies)
+    out["latency_p50_ms"] = round(1000 * lat[len(lat) // 2], 3)
+    out["latency_p90_ms"] = round(1000 * lat[min(len(lat) - 1, int(len(lat) * 0.9))], 3)
+    out["prompt_tokens"] = round(float(np.mean(prompt_tokens)), 1)
+    return out
+
+def nbytes(*arrays):
+    return sum(a.nbytes for a in arrays)
+# --- ここまで指標 ----------
+
+# --- 各方式 ----------
+def eval_block(questions, q_embs, gold, line_tags, embed, counter, args):
+    """
+    experiments/RAG_butTokenOver.py: 工程ブロック1つを1単位として埋め込む
+    """
+    from tag_index import block_text
+    from vector_search import VectorSearch
+    from tokenChecker import load_blocks
+
+    started = time.perf_counter()
+    blocks = load_blocks()
+    texts = [block_text(b) for b in blocks]
+    embs = embed(texts, "eval-blocks")
+    engine = VectorSearch(embs)
+    build_s = time.perf_counter() - started
+    unit_tags = [unit_tag(line_tags, b["source_file"] + ".txt", b["start_line"], b["end_line"]) for b in blocks]
+    memory = nbytes(engine.matrix) + sum(len(t.encode("utf-8")) for t in texts)
+
+    rows = []
+    for topn in args.topn:
+        per_query, lat, tokens = [], [], []
+        for qi in range(len(questions)):
+            t0 = time.perf_counter()
+            idx, _sc = engine.search(q_embs[qi], max(topn, *KS))
+            context = "\n---\n".join(texts[i] for i in idx[:topn])
+            lat.append(time.perf_counter() - t0)
+            tokens.append(counter.count(context, cache=False))
+            per_query.append(rank_metrics([unit_tags[i] for i in idx], gold[qi], topn))
+        rows.append({"strategy": "block", "params": {"TOPN": topn}, "units": len(blocks),
+                     "build_s": round(build_s, 3), "index_mb": round(memory / 2**20, 2),
+                     **summarize(per_query, lat, tokens)})
+    return rows
+
+def eval_lines(questions, q_embs, gold, line_tags, embed, counter, args):
+    """
+    RAG2knowhow.py: GROUP_SIZE 行ずつのチャンク＋前後 MARGIN 行（重なりはまとめる）
+    """
+    import RAG2knowhow
+    from context_assembler import assemble_context
+    from corpus import line_store
+    from vector_search import VectorSearch
+
+    rows = []
+    for group_size in args.group_sizes:
+        started = time.perf_counter()
+        chunks, meta = RAG2knowhow.load_chunks(group_size=group_size)
+        engine = VectorSearch(embed(chunks, f"eval-lines{group_size}"))
+        build_s = time.perf_counter() - started
+        unit_tags = [unit_tag(line_tags, f, s, e) for f, s, e, _n in meta]
+        memory = nbytes(engine.matrix) + sum(len(t.encode("utf-8")) for t in chunks)
+        for topn in args.topn:
+            for margin in args.margins:
+                per_query, lat, tokens = [], [], []
+                for qi in range(len(questions)):
+                    t0 = time.perf_counter()
+                    idx, sc = engine.search(q_embs[qi], max(topn, *KS))
+                    spans = []
+                    for i, score in zip(idx[:topn], sc[:topn]):
+                        f, s, e, n = meta[i]
+                        spans.append((f, max(0, s - margin), min(n, e + margin + 1), float(score)))
+                    context, _info = assemble_context(spans, line_store.text, budget=RAG2knowhow.CONTEXT_TOKEN_BUDGET,
+                                                      counter=counter)
+                    lat.append(time.perf_counter() - t0)
+                    tokens.append(counter.count(context, cache=False))
+                    per_query.append(rank_metrics([unit_tags[i] for i in idx], gold[qi], topn))
+                rows.append({"strategy": "lines", "params": {"GROUP_SIZE": group_size, "TOPN": topn, "MARGIN": margin},
+                             "units": len(chunks), "build_s": round(build_s, 3), "index_mb": round(memory / 2**20, 2),
+                             **summarize(per_query, lat, tokens)})
+    return rows
+
+def eval_hybrid(questions, q_embs, gold, line_tags, embed, counter, args):
+    """
+    experiments/neighbor_split.py: 約300トークンのマイクロチャンク＋Dense/BM25ハイブリッド＋近傍拡張
+    """
+    import neighbor_split
+
+    started = time.perf_counter()
+    paths = sorted(glob.glob("2024-10-*.txt"))
+    chunks = list(neighbor_split.iter_corpus_microchunks(paths))
+    index = neighbor_split.HybridIndex(encode_fn=lambda texts: embed(texts, "eval-hybrid"))
+    index.build(chunks)
+    chunk_index = index.chunk_index
+    build_s = time.perf_counter() - started
+    unit_tags = {(c["doc_id"], c["chunk_idx"]): unit_tag(line_tags, c["doc_id"] + ".txt", c["start_line"], c["end_line"])
+                 for c in chunks}
+    w = index.bm25.weights
+    memory = nbytes(index.dense, w.data, w.indices, w.indptr) + sum(len(c["text"].encode("utf-8")) for c in chunks)
+
+    # 質問の埋め込みは他の方式と同じものを使う（検索時間に埋め込みの時間を含めない）
+    q_of = {q["question"]: q_embs[i] for i, q in enumerate(questions)}
+    index.encode_fn = lambda texts: np.stack([q_of[t] for t in texts])
+
+    rows = []
+    for alpha in args.alphas:
+        for topn in args.topn:
+            per_query, lat, tokens = [], [], []
+            for qi, q in enumerate(questions):
+                t0 = time.perf_counter()
+                hits = index.hybrid_search(q["question"], top_k=max(topn, *KS), alpha=alpha)
+                stitched = neighbor_split.stitch_neighbors(hits[:topn], chunk_index)
+                lat.append(time.perf_counter() - t0)
+                tokens.append(sum(counter.count(s["text"], cache=False) for s in stitched))
+                per_query.append(rank_metrics([unit_tags[c["doc_id"], c["chunk_idx"]] for c, _s in hits], gold[qi], topn))
+            rows.append({"strategy": "hybrid", "params": {"alpha": alpha, "TOPN": topn}, "units": len(chunks),
+                         "build_s": round(build_s, 3), "index_mb": round(memory / 2**20, 2),
+                         **summarize(per_query, lat, tokens)})
+    return rows
+
+EVALUATORS = {"block": eval_block, "lines": eval_lines, "hybrid": eval_hybrid}
+# --- ここまで各方式 ----------
+
+def print_table(rows):
+    cols = [f"recall@{k}" for k in KS] + ["mrr", "precision", "prompt_tokens", "latency_p50_ms", "build_s", "index_mb"]
+    width = {c: max(len(c), 6) + 2 for c in cols}
+    print(f"\n{'strategy':<8} {'params':<32}" + "".join(f"{c:>{width[c]}}" for c in cols))
+    for r in rows:
+        params = " ".join(f"{k}={v}" for k, v in r["params"].items())
+        print(f"{r['strategy']:<8} {params:<32}" + "".join(f"{r[c]:>{width[c]}}" for c in cols))
+
+def evaluate(questions, args):
+    """
+    カレントディレクトリのコーパスで各方式・各パラメータを評価し、結果の行リストを返す
+    """
+    from token_cache import get_counter
+    tags, line_tags = load_line_tags()
+    if not questions:
+        questions = sample_questions(tags, line_tags, args.n_questions, args.seed)
+    questions = [q for q in questions if q["tag"] in tags]
+    gold = [tags.index(q["tag"]) for q in questions]
+    embed = make_embedder(args.embed)
+    q_embs = embed([q["question"] for q in questions], "eval-questions")
+    counter = get_counter()
+    print(f"質問 {len(questions)}件 / 工程 {len(tags)}個 / 書き起こし {len(line_tags)}件 / 埋め込み {args.embed}")
+
+    rows = []
+    for name in args.strategies:
+        started = time.perf_counter()
+        rows.extend(EVALUATORS[name](questions, q_embs, gold, line_tags, embed, counter, args))
+        print(f"{name}: {time.perf_counter() - started:.1f}秒")
+    return rows
+
+def csv_arg(cast):
+    return lambda s: [cast(x) for x in s.split(",") if x]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="工程タグを正解として、検索方式ごとの精度とコストを比べる")
+    parser.add_argument("--questions", help="{\"question\": ..., \"tag\": ...} のJSONL（省略時は本文から抜き出す）")
+    parser.add_argument("--n-questions", type=int, default=200)
+    parser.add_argument("--synthetic", type=int, default=None, metavar="N_FILES",
+                        help="一時ディレクトリに合成コーパスを作って評価する（質問もテンプレートから作る）")
+    parser.add_argument("--embed", choices=("lexical", "cache", "openai"), default="lexical")
+    parser.add_argument("--strategies", type=csv_arg(str), default=list(STRATEGIES))
+    parser.add_argument("--group-sizes", type=csv_arg(int), default=[2, 4, 8])
+    parser.add_argument("--margins", type=csv_arg(int), default=[0, 3])
+    parser.add_argument("--topn", type=csv_arg(int), default=[5, 10])
+    parser.add_argument("--alphas", type=csv_arg(float), default=[0.0, 0.6, 1.0])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="eval_retrieval.json")
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output)
+
+    questions = None
+    if args.questions:
+        with open(args.questions, encoding="utf-8") as f:
+            questions = [json.loads(l) for l in f if l.strip()]
+
+    if args.synthetic:
+        import synth_corpus
+        with tempfile.TemporaryDirectory(prefix="knowhow_eval_") as work:
+            synth_corpus.generate(work, args.synthetic, seed=args.seed)
+            questions = questions or synth_corpus.make_labeled_questions(args.n_questions, args.seed + 1)
+            cwd = os.getcwd()
+            os.chdir(work)
+            try:
+                rows = evaluate(questions, args)
+            finally:
+                os.chdir(cwd)
+    else:
+        rows = evaluate(questions, args)
+
+    print_table(rows)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False, indent=2)
+    print(f"\n{output} に書き出しました")
+
+if __name__ == "__main__":
+    main()
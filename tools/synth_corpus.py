@@ -0,0 +1,103 @@
+import json
+import os
+import random
+
+# 合成コーパスの工程（phase_tags.txt）と、工程ごとの発話テンプレート
+PHASES = {
+    "事前準備": [
+        "今日は{obj}を作ります", "データはUSBに入れてきました", "まず作業台を片付けましょう",
+        "{obj}のサイズはどれくらいにしますか", "材料は{mat}でいいですか",
+    ],
+    "3Dプリンター準備": [
+        "ベッドの水平を確認します", "ノズルの温度を{temp}度に上げます", "{mat}のフィラメントをセットします",
+        "フィラメントが出てこないですね", "ノズルが詰まっているかもしれません", "一度抜いて入れ直しましょう",
+    ],
+    "スライス設定": [
+        "インフィルは{pct}%にします", "サポートは必要ですか", "レイヤー高さは0.2mmで",
+        "印刷時間は{hour}時間と出ています", "ブリムを付けておくと剥がれにくいです",
+    ],
+    "印刷作業": [
+        "印刷を開始します", "最初の層がきれいに乗っています", "端が少し反ってきました",
+        "糸引きが出ていますね", "一旦止めますか", "このまま様子を見ましょう",
+    ],
+    "仕上げ・片付け": [
+        "ベッドが冷えるまで待ちます", "スクレーパーで剥がします", "サポートをニッパーで取ります",
+        "やすりで表面を整えます", "フィラメントを戻して片付けます",
+    ],
+}
+FILLERS = {
+    "obj": ["スマホスタンド", "キーホルダー", "ケーブルクリップ", "名札"],
+    "mat": ["PLA", "PETG", "TPU"],
+    "temp": ["200", "210", "230"],
+    "pct": ["10", "15", "20"],
+    "hour": ["1", "2", "3"],
+}
+BASE_TXT = "2024-10-02_13_11_31.txt"  # add_tag.py の base_txt と同じ名前
+
+def utterance(rng, phase):
+    text = rng.choice(PHASES[phase])
+    return text.format(**{k: rng.choice(v) for k, v in FILLERS.items()})
+
+def make_transcript(rng, n_lines):
+    """
+    工程の順に発話を並べた書き起こしと、その工程ブロックを返す
+    """
+    phases = list(PHASES)
+    # 各工程の行数をランダムに配分（最低2行）
+    weights = [rng.uniform(0.5, 1.5) for _ in phases]
+    sizes = [max(2, int(n_lines * w / sum(weights))) for w in weights]
+    lines, blocks = [], []
+    for phase, size in zip(phases, sizes):
+        start = len(lines)
+        for i in range(size):
+            lines.append(f"{'AB'[i % 2]}: {utterance(rng, phase)}")
+        blocks.append({"start_line": start, "end_line": len(lines) - 1, "tag": phase})
+    return lines, blocks
+
+def generate(out_dir, n_files, n_lines=400, seed=0):
+    """
+    out_dir に 2024-10-*.txt と phase_blocks_*.json、phase_tags.txt を作る
+    1件目は add_tag.py の base_txt と同じ名前にする
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    names = [BASE_TXT] + [f"2024-10-{i:06d}.txt" for i in range(1, n_files)]
+    total = 0
+    for name in names:
+        lines, blocks = make_transcript(rng, n_lines)
+        total += len(lines)
+        with open(os.path.join(out_dir, name), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        with open(os.path.join(out_dir, f"phase_blocks_{os.path.splitext(name)[0]}.json"), "w", encoding="utf-8") as f:
+            json.dump(blocks, f, ensure_ascii=False)
+    with open(os.path.join(out_dir, "phase_tags.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(PHASES) + "\n")
+    return {"n_files": len(names), "n_lines": total}
+
+def make_questions(n, seed=1):
+    """
+    工程のテンプレートから作業者の質問を作る（言い回し違いの重複を含む）
+    """
+    return [q["question"] for q in make_labeled_questions(n, seed)]
+
+def make_labeled_questions(n, seed=1):
+    """
+    make_questions と同じ質問に、元にした工程を正解タグとして付ける: [{"question", "tag"}, ...]
+    """
+    rng = random.Random(seed)
+    forms = ["{}ときはどうすればいいですか？", "{}んですが、注意点は？", "{}場合のコツを教えてください"]
+    questions = []
+    for _ in range(n):
+        phase = rng.choice(list(PHASES))
+        questions.append({"question": rng.choice(forms).format(utterance(rng, phase).rstrip("ね")), "tag": phase})
+    return questions
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="合成の作業会話コーパスを作る")
+    parser.add_argument("out_dir")
+    parser.add_argument("--files", type=int, default=9)
+    parser.add_argument("--lines", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.out_dir, args.files, args.lines, args.seed))
@@ -1,56 +1,126 @@
+import argparse
+import csv
 import glob
+import heapq
 import json
-import tiktoken
-import pandas as pd
-
-MODEL_NAME = "text-embedding-3-large"
-enc = tiktoken.encoding_for_model(MODEL_NAME)
-
-def count_tokens(text):
-    return len(enc.encode(text))
-
-def get_block_text(block):
-    txtfile = block["source_file"] + ".txt"
-    with open(txtfile, encoding="utf-8") as f:
-        lines = [l.strip() for l in f if l.strip()]
-    return "\n".join(lines[block["start_line"]:block["end_line"]+1])
-
-# 全工程ブロックを集める
-all_blocks = []
-for fname in sorted(glob.glob("phase_blocks_*.json")):
-    with open(fname, encoding="utf-8") as f:
-        blocks = json.load(f)
-    for b in blocks:
-        b["source_file"] = fname.replace("phase_blocks_", "").replace(".json", "")
-        all_blocks.append(b)
-
-# トークン数計算
-token_report = []
-for idx, block in enumerate(all_blocks):
-    txt = get_block_text(block)
-    n_tok = count_tokens(txt)
-    token_report.append({
-        "block_id": idx,
-        "source_file": block["source_file"],
-        "tag": block["tag"],
-        "start_line": block["start_line"],
-        "end_line": block["end_line"],
-        "char_len": len(txt),
-        "token_len": n_tok,
-    })
-
-# トークン数順にソートして上位を出力
-token_report = sorted(token_report, key=lambda x: -x["token_len"])
-
-print("トークン数が多い順にTOP10：")
-for b in token_report[:10]:
-    print(f"{b['source_file']} [{b['tag']}]: {b['start_line']}-{b['end_line']} chars={b['char_len']} tokens={b['token_len']}")
-
-# 全ブロックの最大値も出力
-max_block = token_report[0]
-print(f"\n最大トークン数ブロック:\n{max_block}")
-
-# CSV保存
-df = pd.DataFrame(token_report)
-df.to_csv("block_token_report.csv", index=False, encoding="utf-8-sig")
-print("\nblock_token_report.csvに詳細レポート出力済み")
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from tag_index import BLOCKS_PATTERN, block_section, block_text, source_of
+
+MODEL_NAME = "text-embedding-3-large"  # 既定ではEmbeddingの入力上限（8191トークン）に収まるかを調べる
+REPORT_CSV = "block_token_report.csv"
+FIELDS = ["block_id", "source_file", "tag", "start_line", "end_line", "char_len", "token_len"]
+
+def load_blocks(pattern=BLOCKS_PATTERN):
+    """
+    全工程ブロックを集める
+    """
+    all_blocks = []
+    for fname in sorted(glob.glob(pattern)):
+        with open(fname, encoding="utf-8") as f:
+            blocks = json.load(f)
+        for b in blocks:
+            b["source_file"] = source_of(fname)
+            all_blocks.append(b)
+    return all_blocks
+
+def distribution(values):
+    """
+    件数・合計・平均・中央値・90パーセンタイル・最大
+    """
+    v = sorted(values)
+    n = len(v)
+    return {
+        "blocks": n,
+        "total": sum(v),
+        "mean": round(sum(v) / n, 1),
+        "p50": v[(n - 1) // 2],
+        "p90": v[min(n - 1, int(n * 0.9))],
+        "max": v[-1],
+    }
+
+def print_distributions(title, groups):
+    print(f"\n{title}：")
+    print(f"{'':<24}{'blocks':>8}{'total':>10}{'mean':>10}{'p50':>8}{'p90':>8}{'max':>8}")
+    for key in sorted(groups):
+        d = distribution(groups[key])
+        print(f"{key:<24}{d['blocks']:>8}{d['total']:>10}{d['mean']:>10}{d['p50']:>8}{d['p90']:>8}{d['max']:>8}")
+
+def main(argv=None):
+    from token_cache import context_limit, encoding_for_model, get_counter
+
+    parser = argparse.ArgumentParser(description="工程ブロックのトークン数を調べる")
+    parser.add_argument("--model", default=MODEL_NAME, help="トークナイザとコンテキスト長の基準にするモデル")
+    parser.add_argument("--limit", type=int, default=None, help="コンテキスト長の上限（省略時はモデルの上限）")
+    parser.add_argument("--section", action="store_true",
+                        help="ブロック本文ではなく、回答時と同じ「【元ファイル】」見出し付きの文字列を数える（char_len / token_len もその値になる）")
+    parser.add_argument("--workers", type=int, default=None, help="トークン数を数えるプロセス数（既定: CPU数）")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--csv", default=REPORT_CSV)
+    args = parser.parse_args(argv)
+    try:
+        limit = args.limit if args.limit is not None else context_limit(args.model)
+    except ValueError as e:
+        parser.error(str(e))
+
+    all_blocks = load_blocks()
+    if not all_blocks:
+        print("phase_blocks_*.json がありません")
+        return
+
+    # トークン数計算（既定はブロック本文。--section なら回答時と同じ見出し付きの文字列。
+    # 数え済みのものはキャッシュから返り、未計測のものだけをプロセスプールで数える）
+    counter = get_counter(encoding_for_model(args.model))
+    sections = [(block_section if args.section else block_text)(b) for b in all_blocks]
+    token_lens = counter.count_many(sections, workers=args.workers)
+    counter.save()
+
+    # CSVには1行ずつ書き出し、集計に必要な値だけを残す
+    top = []
+    by_tag, by_file, over = {}, {}, []
+    with open(args.csv, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for idx, (block, section, n_tok) in enumerate(zip(all_blocks, sections, token_lens)):
+            row = {
+                "block_id": idx,
+                "source_file": block["source_file"],
+                "tag": block["tag"],
+                "start_line": block["start_line"],
+                "end_line": block["end_line"],
+                "char_len": len(section),
+                "token_len": n_tok,
+            }
+            writer.writerow(row)
+            heapq.heappush(top, (n_tok, -idx, row))
+            if len(top) > args.top:
+                heapq.heappop(top)
+            by_tag.setdefault(block["tag"], []).append(n_tok)
+            by_file.setdefault(block["source_file"], []).append(n_tok)
+            if n_tok > limit:
+                over.append(row)
+
+    # トークン数順に上位を出力
+    top = [row for _n, _i, row in sorted(top, key=lambda x: (-x[0], -x[1]))]
+    print(f"トークン数が多い順にTOP{args.top}（{args.model}）：")
+    for b in top:
+        print(f"{b['source_file']} [{b['tag']}]: {b['start_line']}-{b['end_line']} chars={b['char_len']} tokens={b['token_len']}")
+
+    # 全ブロックの最大値も出力
+    if top:
+        print(f"\n最大トークン数ブロック:\n{top[0]}")
+
+    print_distributions("タグごとのトークン数", by_tag)
+    print_distributions("ファイルごとのトークン数", by_file)
+    total = distribution(token_lens)
+    print(f"\n全体: {total['blocks']}ブロック / 合計 {total['total']}トークン / 最大 {total['max']}トークン")
+    print(f"コンテキスト長 {limit} トークンを超えるブロック: {len(over)}件")
+    for b in over:
+        print(f"  {b['source_file']} [{b['tag']}]: {b['start_line']}-{b['end_line']} tokens={b['token_len']}")
+
+    print(f"\n{args.csv}に詳細レポート出力済み")
+
+if __name__ == "__main__":
+    main()
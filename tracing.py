@@ -0,0 +1,228 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRACE_ENV = "KNOWHOW_TRACE"                # スパンを書き出すJSONLのパス（未設定なら計測しない）
+METRICS_PORT_ENV = "KNOWHOW_METRICS_PORT"  # 設定するとこのポートで /metrics（Prometheus形式）を公開
+# USD / 100万トークン（入力, 出力）。価格改定があれば更新する
+PRICES = {
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+
+_current = contextvars.ContextVar("knowhow_span", default=None)
+
+def llm_cost(model, prompt_tokens, completion_tokens):
+    price_in, price_out = PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+# --- スパン ----------
+class Span:
+    """
+    1処理段階の計測（経過時間・属性・LLM呼び出しのトークン数と料金・再送回数）
+    with で囲んだ範囲を計測し、終了時に JSONL へ1行書き出す。入れ子にすると parent_id でつながる
+    """
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.llm_calls = []
+        self.retries = 0
+        parent = _current.get()
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.span_id = uuid.uuid4().hex[:8]
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        self.start = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._started
+        _current.reset(self._token)
+        record = {
+            "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+            "name": self.name, "start": self.start, "duration_ms": round(duration * 1000, 3),
+        }
+        if self.attrs:
+            record["attrs"] = self.attrs
+        if self.llm_calls:
+            record["llm"] = self.llm_calls
+        if self.retries:
+            record["retries"] = self.retries
+        if exc_type is not None:
+            record["error"] = f"{exc_type.__name__}: {exc}"
+        self.tracer._finish(record, duration)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def llm(self, model, prompt_tokens=0, completion_tokens=0):
+        self.llm_calls.append({
+            "model": model, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "cost_usd": round(llm_cost(model, prompt_tokens, completion_tokens), 6),
+        })
+
+    def retry(self):
+        self.retries += 1
+
+class _NullSpan:
+    """
+    計測しないときの空のスパン（何もしない）
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+    def llm(self, model, prompt_tokens=0, completion_tokens=0):
+        pass
+
+    def retry(self):
+        pass
+
+NULL_SPAN = _NullSpan()
+# --- ここまでスパン ----------
+
+# --- トレーサ ----------
+class Tracer:
+    """
+    スパンを JSONL に書き出し、段階ごと・モデルごとの累計を Prometheus 形式で返す
+    path も metrics も指定しなければ span() は NULL_SPAN を返すだけなので、計測のコストはほぼない
+    """
+
+    def __init__(self, path=None, metrics=False):
+        self.configure(path, metrics)
+
+    def configure(self, path=None, metrics=False):
+        if getattr(self, "_file", None) is not None:
+            self._file.close()
+        self.path = path
+        self.metrics = metrics
+        self.enabled = bool(path or metrics)
+        self._file = None
+        self._lock = threading.Lock()
+        self._stages = {}  # name -> [回数, 秒数合計, エラー数]
+        self._llm = {}     # model -> [呼び出し数, 入力トークン, 出力トークン, 料金]
+        self._retries = 0
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attrs)
+
+    def current(self):
+        return _current.get() or NULL_SPAN
+
+    def record_llm(self, model, usage):
+        """
+        LLM呼び出し1回分の usage（prompt_tokens / completion_tokens）を今のスパンに記録する
+        """
+        if not self.enabled:
+            return
+        prompt = getattr(usage, "prompt_tokens", 0) or 0
+        completion = getattr(usage, "completion_tokens", 0) or 0
+        self.current().llm(model, prompt, completion)
+        with self._lock:
+            stats = self._llm.setdefault(model, [0, 0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += prompt
+            stats[2] += completion
+            stats[3] += llm_cost(model, prompt, completion)
+
+    def record_retry(self):
+        if not self.enabled:
+            return
+        self.current().retry()
+        with self._lock:
+            self._retries += 1
+
+    def _finish(self, record, duration):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            stats = self._stages.setdefault(record["name"], [0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] += "error" in record
+            if self.path:
+                if self._file is None:
+                    self._file = open(self.path, "a", encoding="utf-8")
+                self._file.write(line + "\n")
+                self._file.flush()
+
+    def prometheus_text(self):
+        with self._lock:
+            stages = {k: list(v) for k, v in self._stages.items()}
+            llm = {k: list(v) for k, v in self._llm.items()}
+            retries = self._retries
+        lines = [
+            "# HELP knowhow_stage_seconds 処理段階ごとの経過時間",
+            "# TYPE knowhow_stage_seconds summary",
+        ]
+        for name, (count, total, _errors) in sorted(stages.items()):
+            lines.append(f'knowhow_stage_seconds_count{{stage="{name}"}} {count}')
+            lines.append(f'knowhow_stage_seconds_sum{{stage="{name}"}} {total:.6f}')
+        lines += ["# TYPE knowhow_stage_errors_total counter"]
+        lines += [f'knowhow_stage_errors_total{{stage="{n}"}} {s[2]}' for n, s in sorted(stages.items())]
+        lines += ["# TYPE knowhow_llm_calls_total counter"]
+        lines += [f'knowhow_llm_calls_total{{model="{m}"}} {s[0]}' for m, s in sorted(llm.items())]
+        lines += ["# TYPE knowhow_llm_tokens_total counter"]
+        for model, (_calls, prompt, completion, _cost) in sorted(llm.items()):
+            lines.append(f'knowhow_llm_tokens_total{{model="{model}",kind="prompt"}} {prompt}')
+            lines.append(f'knowhow_llm_tokens_total{{model="{model}",kind="completion"}} {completion}')
+        lines += ["# TYPE knowhow_llm_cost_usd_total counter"]
+        lines += [f'knowhow_llm_cost_usd_total{{model="{m}"}} {s[3]:.6f}' for m, s in sorted(llm.items())]
+        lines += ["# TYPE knowhow_llm_retries_total counter", f"knowhow_llm_retries_total {retries}"]
+        return "\n".join(lines) + "\n"
+# --- ここまでトレーサ ----------
+
+# --- /metrics エンドポイント ----------
+def serve_metrics(port, host="127.0.0.1"):
+    """
+    別スレッドで GET /metrics に Prometheus 形式のテキストを返すサーバを立てる
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            data = tracer.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+def serve_metrics_from_env():
+    """
+    KNOWHOW_METRICS_PORT が設定されていれば /metrics を公開する（設定がなければ None）
+    import 時にはポートを開かない。サブプロセスやプールの子プロセスが同じポートを取り合わないよう、
+    エントリポイント（knowhow.py / server.py）から1回だけ呼ぶ
+    """
+    port = os.getenv(METRICS_PORT_ENV)
+    return serve_metrics(int(port)) if port else None
+# --- ここまで /metrics エンドポイント ----------
+
+tracer = Tracer(os.getenv(TRACE_ENV) or None, metrics=bool(os.getenv(METRICS_PORT_ENV)))
@@ -0,0 +1,64 @@
+import numpy as np
+
+QUERY_BLOCK = 64  # バッチ検索で一度に行列積に載せる質問数（メモリ使用量の上限）
+
+# --- 上位k件選択 ----------
+def topk(scores, k):
+    """
+    スコア行列 (n_query, n_item) から各行の上位k件を部分選択で取り出す
+    戻り値: (indices, scores) いずれも (n_query, k)、スコア降順
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty.astype(scores.dtype)
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+# --- ここまで上位k件選択 ----------
+
+# --- 厳密検索 ----------
+class VectorSearch:
+    """
+    正規化済み float32 行列を保持し、コサイン類似度の上位k件を返す検索エンジン
+    1件でも複数件でも、質問ベクトルとの行列積1回でスコアを出す
+    """
+
+    def __init__(self, embeddings):
+        mat = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        self.matrix = mat / np.maximum(norms, 1e-12)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @staticmethod
+    def _normalize(queries):
+        q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        return q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+
+    def search(self, query, k):
+        """
+        1件の質問ベクトルに対する上位k件 (indices, scores)
+        """
+        idx, sc = self.search_batch([query], k)
+        return idx[0], sc[0]
+
+    def search_batch(self, queries, k):
+        """
+        N件の質問ベクトルをまとめて検索する
+        戻り値: (indices, scores) いずれも (N, k)
+        """
+        q = self._normalize(queries)
+        k = min(k, len(self))
+        indices = np.empty((q.shape[0], k), dtype=np.int64)
+        scores = np.empty((q.shape[0], k), dtype=np.float32)
+        for s in range(0, q.shape[0], QUERY_BLOCK):
+            block = q[s:s + QUERY_BLOCK] @ self.matrix.T
+            indices[s:s + QUERY_BLOCK], scores[s:s + QUERY_BLOCK] = topk(block, k)
+        return indices, scores
+# --- ここまで厳密検索 ----------